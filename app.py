@@ -1,43 +1,73 @@
 import os
 import time
+import uuid
+import asyncio
 import logging
-import json
 import hashlib
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 from threading import Lock
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from flask import Flask, request, jsonify, render_template, send_from_directory, Response, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from apscheduler.schedulers.background import BackgroundScheduler
-import requests
 
 from core.extensions import db
 from core.models import SystemConfig, Token, RequestLog
 from core import services
+from core.browser_client import BrowserServiceClient, BrowserBusy
+from core.token_pool import token_pool, request_kind
+from core.shared_state import shared_state
+from core.token_refresher import token_refresher
+from core.refresh_scheduler import scheduler_from_env
+from core.hedging import policy_from_env
+from core.log_writer import log_writer
+from core.response_cache import response_cache, cache_key
+from core.models_cache import ModelListCache
+from core.page_warmer import PageWarmer
+from core.direct_transport import transport_from_env
 
 # Browser Service Config
 BROWSER_SERVICE_URL = os.environ.get("BROWSER_SERVICE_URL", "http://localhost:5006")
+# Worker threads for the production server; each in-flight request holds one
+APP_THREADS = int(os.environ.get('APP_THREADS', 64))
+hedge_policy = policy_from_env()
+# Runs hedged attempts; the request thread waits on whichever finishes first
+_attempt_executor = ThreadPoolExecutor(max_workers=APP_THREADS, thread_name_prefix='attempt')
 _browser_initialized = False
-
-def _browser_proxy_request(url, method, payload, token_obj=None, retry_on_auth_fail=True):
-    # token_obj is now the Token model instance, not just the zai_token string
+browser_client = BrowserServiceClient.from_env()
+# Opens a browser page for each active token at startup and after every refresh
+page_warmer = PageWarmer(browser_client, f"{BROWSER_SERVICE_URL}/warm")
+# ZAI_TRANSPORT=direct: call zai.is from here with headers minted by the browser service
+direct_transport = transport_from_env(browser_client, f"{BROWSER_SERVICE_URL}/credentials")
+
+def _browser_proxy_request(url, method, payload, token_obj=None, retry_on_auth_fail=True, request_id=None):
+    # token_obj is a TokenRecord from the in-memory token pool; request_id lets /proxy/cancel abort it.
+    # The result carries auth_rejected=True only when a fresh re-login was still refused with 401/403.
     if not token_obj: return None
     
+    if direct_transport.enabled:
+        # Falls back to the browser below when the minted header is missing, expired or rejected
+        res = direct_transport.request(token_obj, url, method, payload)
+        if res is not None: return res
+
     # Extract params
     zai_token = token_obj.zai_token
-    cookies = json.loads(token_obj.cookies_json) if token_obj.cookies_json else None
+    cookies = token_obj.cookies
     
     try:
         logger.info(f"Proxying request to browser service: {url} (method: {method}, has_cookies: {cookies is not None})")
-        # BYPASS PROXY for localhost communication
-        resp = requests.post(f"{BROWSER_SERVICE_URL}/proxy", json={
+        resp = browser_client.post(f"{BROWSER_SERVICE_URL}/proxy", {
             'url': url,
             'method': method,
             'payload': payload,
             'token': zai_token,
-            'cookies': cookies
-        }, timeout=120, proxies={'http': None, 'https': None})
+            'token_id': token_obj.id,
+            'cookies': cookies,
+            'request_id': request_id
+        })
         
         if resp.status_code == 200:
             data = resp.json()
@@ -49,19 +79,68 @@ def _browser_proxy_request(url, method, payload, token_obj=None, retry_on_auth_f
                 # Attempt to refresh token
                 success, msg = services.update_token_info(token_obj.id)
                 if success:
+                    # The refresh updated the pool record in place
                     logger.info(f"Token {token_obj.id} refreshed successfully. Retrying request...")
-                    # Reload token from DB to get new values
-                    db.session.refresh(token_obj)
-                    return _browser_proxy_request(url, method, payload, token_obj, retry_on_auth_fail=False)
+                    retried = _browser_proxy_request(url, method, payload, token_obj, retry_on_auth_fail=False, request_id=request_id)
+                    if retried and retried.get('status') in (401, 403): retried['auth_rejected'] = True
+                    return retried
                 else:
                     logger.error(f"Failed to auto-refresh token {token_obj.id}: {msg}")
             
             return data
             
+    except BrowserBusy:
+        # The browser service is saturated, not this token: let the caller back off
+        raise
     except Exception as e:
         logger.error(f"Browser proxy request failed: {e}")
     return None
 
+def _browser_proxy_stream(url, payload, token_obj=None, retry_on_auth_fail=True):
+    # Returns (upstream_status, response, auth_rejected) where response is an open streaming
+    # requests.Response relaying the upstream body chunk by chunk, or None on failure.
+    # auth_rejected is True only when a fresh re-login was still refused with 401/403.
+    if not token_obj: return None
+
+    zai_token = token_obj.zai_token
+    cookies = token_obj.cookies
+
+    try:
+        logger.info(f"Streaming request via browser service: {url} (has_cookies: {cookies is not None})")
+        resp = browser_client.post(f"{BROWSER_SERVICE_URL}/proxy/stream", {
+            'url': url,
+            'method': 'POST',
+            'payload': payload,
+            'token': zai_token,
+            'token_id': token_obj.id,
+            'cookies': cookies
+        }, stream=True)
+
+        if resp.status_code != 200 or 'X-Upstream-Status' not in resp.headers:
+            logger.error(f"Browser stream request failed ({resp.status_code}): {resp.text[:500]}")
+            resp.close()
+            return None
+
+        status = int(resp.headers['X-Upstream-Status'])
+        if retry_on_auth_fail and status in [401, 403]:
+            logger.warning(f"Auth failure ({status}) detected for token {token_obj.id}. Attempting auto-refresh...")
+            success, msg = services.update_token_info(token_obj.id)
+            if success:
+                logger.info(f"Token {token_obj.id} refreshed successfully. Retrying request...")
+                resp.close()
+                retried = _browser_proxy_stream(url, payload, token_obj, retry_on_auth_fail=False)
+                if retried and retried[0] in (401, 403): return retried[0], retried[1], True
+                return retried
+            logger.error(f"Failed to auto-refresh token {token_obj.id}: {msg}")
+
+        return status, resp, False
+
+    except BrowserBusy:
+        raise
+    except Exception as e:
+        logger.error(f"Browser stream request failed: {e}")
+    return None
+
 # Initialize App
 app = Flask(__name__, static_folder='static', template_folder='static')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI', 'sqlite:///zai2api.db')
@@ -69,6 +148,7 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-me')
 
 db.init_app(app)
+log_writer.init_app(app)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -83,7 +163,7 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    config = SystemConfig.query.first()
+    config = services.get_config()
     if config and str(config.id) == user_id:
         return User(id=str(config.id), username=config.admin_username)
     return None
@@ -135,17 +215,45 @@ def init_db():
             config = SystemConfig(admin_username='admin', admin_password_hash=generate_password_hash('admin'))
             db.session.add(config)
             db.session.commit()
-        try:
-            seconds = int(getattr(config, 'token_refresh_interval', 3600) or 3600)
-            scheduler.reschedule_job('token_refresher', trigger='interval', seconds=seconds)
-        except: pass
-
-def scheduled_refresh():
-    with app.app_context(): services.refresh_all_tokens()
+        services.invalidate_config()
+        token_pool.load(Token.query.all())
+        # Warm latency/error scores from recent history, oldest first
+        recent = RequestLog.query.with_entities(RequestLog.token_email, RequestLog.duration, RequestLog.status_code).order_by(RequestLog.id.desc()).limit(2000).all()
+        token_pool.seed(reversed(recent))
+    # Started only now: the scheduler polls the tables created above
+    if os.environ.get('GATEWAY_WORKER') != '1': expiry_scheduler.start()
+
+_pool_load_lock = Lock()
+
+def _ensure_token_pool():
+    # Reloads when another gateway process changed a token
+    if token_pool.loaded and not token_pool.stale: return
+    with _pool_load_lock:
+        if not token_pool.loaded or token_pool.stale: token_pool.load(Token.query.all())
+
+def _poll_token_changes():
+    # Picks up tokens changed by other gateway processes
+    with app.app_context(): _ensure_token_pool()
+
+def _track_token_expiry(token_id, record):
+    if record is None: return expiry_scheduler.untrack(token_id)
+    # Tokens with no known expiry are refreshed right away
+    expiry_scheduler.track(token_id, record.at_expires or record.jwt_expires or 0.0, active=record.is_active)
+
+def _auto_refresh_enabled():
+    # The admin panel's at_auto_refresh_enabled switch
+    with app.app_context(): return services.get_config().at_auto_refresh_enabled is not False
+
+# Each token is refreshed shortly before its own at_expires instead of on a fixed sweep
+expiry_scheduler = scheduler_from_env(lambda token_ids: token_refresher.run(app, token_ids), poll=_poll_token_changes, enabled=_auto_refresh_enabled)
 
 scheduler = BackgroundScheduler()
-scheduler.add_job(scheduled_refresh, 'interval', seconds=3600, id='token_refresher')
-scheduler.start()
+# Worker processes started by run_gateway_workers leave scheduled jobs to the parent
+if os.environ.get('GATEWAY_WORKER') != '1':
+    scheduler.start()
+    token_pool.listeners.append(_track_token_expiry)
+    if os.environ.get('BROWSER_PREWARM', '0') == '1':
+        token_pool.listeners.append(page_warmer.on_token_change)
 
 @app.route('/login')
 def login_page(): return send_from_directory('static', 'login.html')
@@ -158,7 +266,7 @@ def index(): return send_from_directory('static', 'login.html')
 def api_login():
     data = request.json
     username, password = data.get('username'), data.get('password')
-    config = SystemConfig.query.first()
+    config = services.get_config()
     if config and config.admin_username == username and check_password_hash(config.admin_password_hash, password):
         user = User(id=str(config.id), username=config.admin_username)
         login_user(user)
@@ -197,14 +305,20 @@ def api_stats():
     total_errors = Token.query.with_entities(db.func.sum(Token.error_count)).scalar() or 0
     return jsonify({'total_tokens': total_tokens, 'active_tokens': active_tokens, 'today_images': 0, 'total_images': total_images, 'today_videos': 0, 'total_videos': total_videos, 'today_errors': 0, 'total_errors': total_errors})
 
+@app.route('/api/metrics', methods=['GET'])
+@api_auth_required
+def api_metrics():
+    return jsonify({'browser_transport': browser_client.stats(), 'token_pool': token_pool.stats(), 'request_log': log_writer.stats(), 'response_cache': response_cache.stats(), 'models_cache': models_cache.stats(), 'reauth': services.reauth_flight.stats(), 'hedging': hedge_policy.stats(), 'page_warmer': page_warmer.stats(), 'direct_transport': direct_transport.stats()})
+
 @app.route('/api/tokens', methods=['GET'])
 @api_auth_required
 def get_tokens():
     tokens = Token.query.all()
-    config = SystemConfig.query.first()
+    config = services.get_config()
     result = []
     for t in tokens:
-        result.append({'id': t.id, 'email': t.email, 'is_active': t.is_active, 'at_expires': _dt_iso(t.at_expires), 'credits': t.credits, 'user_paygate_tier': t.user_paygate_tier, 'current_project_name': t.current_project_name, 'current_project_id': t.current_project_id, 'image_count': t.image_count, 'video_count': t.video_count, 'error_count': t.error_count, 'remark': t.remark, 'image_enabled': t.image_enabled, 'video_enabled': t.video_enabled, 'image_concurrency': t.image_concurrency, 'video_concurrency': t.video_concurrency, 'zai_token': t.zai_token, 'st': t.discord_token})
+        record = token_pool.get(t.id)
+        result.append({'id': t.id, 'email': t.email, 'is_active': t.is_active, 'at_expires': _dt_iso(t.at_expires), 'credits': t.credits, 'user_paygate_tier': t.user_paygate_tier, 'current_project_name': t.current_project_name, 'current_project_id': t.current_project_id, 'image_count': t.image_count, 'video_count': t.video_count, 'error_count': t.error_count, 'remark': t.remark, 'image_enabled': t.image_enabled, 'video_enabled': t.video_enabled, 'image_concurrency': t.image_concurrency, 'video_concurrency': t.video_concurrency, 'zai_token': t.zai_token, 'st': t.discord_token, 'inflight': record.inflight if record else 0, 'latency_ewma': round(record.ewma_latency, 3) if record and record.ewma_latency is not None else None, 'error_ewma': round(record.ewma_error, 3) if record else 0.0, 'circuit': token_pool.circuit(record) if record else None})
     return jsonify({'tokens': result, 'config': {'token_refresh_interval': config.token_refresh_interval if config else 3600}})
 
 @app.route('/api/tokens', methods=['POST'])
@@ -216,6 +330,7 @@ def add_token():
     token = Token(discord_token=st, remark=data.get('remark'), current_project_id=data.get('project_id'), current_project_name=data.get('project_name'), image_enabled=data.get('image_enabled', True), video_enabled=data.get('video_enabled', True), image_concurrency=data.get('image_concurrency', -1), video_concurrency=data.get('video_concurrency', -1))
     db.session.add(token)
     db.session.commit()
+    token_pool.upsert(token)
     success, msg = services.update_token_info(token.id)
     return jsonify({'success': True, 'message': msg if not success else None})
 
@@ -226,146 +341,441 @@ def handle_token(id):
     if request.method == 'DELETE':
         db.session.delete(token)
         db.session.commit()
+        token_pool.remove(id)
         return jsonify({'success': True})
     data = request.json
     for key in ['st', 'remark', 'project_id', 'project_name', 'image_enabled', 'video_enabled', 'image_concurrency', 'video_concurrency']:
         if key in data: setattr(token, key if key != 'st' else 'discord_token', data[key])
     db.session.commit()
+    token_pool.upsert(token)
+    # A new Discord token deserves a fresh login attempt
+    if 'st' in data: services.reauth_flight.forget(id)
     return jsonify({'success': True})
 
 @app.route('/api/tokens/refresh-all', methods=['POST'])
 @api_auth_required
 def refresh_all_tokens_endpoint():
+    # Runs in the background; poll GET for progress
     try:
-        services.refresh_all_tokens(force=True)
-        return jsonify({'success': True, 'message': '所有 Token 刷新请求已发送'})
+        job = services.refresh_all_tokens(force=True, background=True)
+        return jsonify({'success': True, 'message': f"已开始后台刷新 {job['total']} 个 Token", 'job': job})
     except Exception as e: return jsonify({'success': False, 'message': str(e)})
 
+@app.route('/api/tokens/refresh-all', methods=['GET'])
+@api_auth_required
+def refresh_all_status():
+    return jsonify({'success': True, 'job': token_refresher.status()})
+
 @app.route('/api/tokens/<int:id>/test', methods=['POST'])
 @api_auth_required
 def test_token(id):
-    success, msg = services.update_token_info(id)
+    # An explicit test always logs in again rather than reusing a recent result
+    success, msg = services.update_token_info(id, force=True)
     token = Token.query.get(id)
     if success: return jsonify({'success': True, 'status': 'success', 'email': token.email})
     return jsonify({'success': False, 'message': msg})
 
+# --- Admin Settings ---
+
+_CONFIG_FIELDS = {'error_ban_threshold': int, 'error_retry_count': int, 'token_refresh_interval': int, 'stream_conversion_enabled': bool, 'debug_enabled': bool, 'at_auto_refresh_enabled': bool, 'proxy_enabled': bool, 'proxy_url': str, 'cache_enabled': bool, 'cache_timeout': int, 'cache_base_url': str, 'image_timeout': int, 'video_timeout': int}
+
+def _save_config(changes):
+    config = SystemConfig.query.first()
+    interval_changed = 'token_refresh_interval' in changes and changes['token_refresh_interval'] != config.token_refresh_interval
+    refresh_enabled = changes.get('at_auto_refresh_enabled') and not config.at_auto_refresh_enabled
+    for key, value in changes.items(): setattr(config, key, value)
+    db.session.commit()
+    services.invalidate_config()
+    if interval_changed and config.token_refresh_interval: _apply_refresh_interval(config.token_refresh_interval)
+    if refresh_enabled: expiry_scheduler.wake()
+
+def _apply_refresh_interval(interval):
+    # A shorter interval takes effect now: no token may wait past now + interval.
+    # Stored on the tokens so other processes and the admin panel see it too.
+    cap = datetime.now() + timedelta(seconds=interval)
+    tokens = Token.query.filter(Token.is_active == True, Token.at_expires > cap).all()
+    for token in tokens: token.at_expires = cap
+    db.session.commit()
+    for token in tokens: token_pool.upsert(token)
+    if tokens: logger.info(f"Refresh interval set to {interval}s: {len(tokens)} tokens now expire by {cap.isoformat()}")
+
+@app.route('/api/admin/config', methods=['GET', 'POST'])
+@api_auth_required
+def admin_config():
+    if request.method == 'GET':
+        config = services.get_config()
+        result = {'admin_username': config.admin_username, 'api_key': config.api_key}
+        result.update({key: getattr(config, key) for key in _CONFIG_FIELDS})
+        return jsonify(result)
+    data = request.json or {}
+    try:
+        changes = {key: (cast(data[key]) if data[key] is not None else None) for key, cast in _CONFIG_FIELDS.items() if key in data}
+    except (TypeError, ValueError) as e: return jsonify({'success': False, 'message': f'Invalid value: {e}'}), 400
+    _save_config(changes)
+    return jsonify({'success': True})
+
+@app.route('/api/admin/debug', methods=['POST'])
+@api_auth_required
+def admin_debug():
+    data = request.json or {}
+    changes = {'debug_enabled': bool(data.get('enabled'))}
+    if data.get('token_refresh_interval'):
+        try: changes['token_refresh_interval'] = int(data['token_refresh_interval'])
+        except (TypeError, ValueError): return jsonify({'success': False, 'message': 'Invalid token_refresh_interval'}), 400
+    _save_config(changes)
+    return jsonify({'success': True})
+
+@app.route('/api/admin/apikey', methods=['POST'])
+@api_auth_required
+def admin_apikey():
+    new_api_key = (request.json or {}).get('new_api_key')
+    if not new_api_key: return jsonify({'success': False, 'message': 'Missing API Key'}), 400
+    _save_config({'api_key': new_api_key})
+    return jsonify({'success': True})
+
+@app.route('/api/admin/password', methods=['POST'])
+@api_auth_required
+def admin_password():
+    data = request.json or {}
+    config = services.get_config()
+    if not check_password_hash(config.admin_password_hash, data.get('old_password') or ''):
+        return jsonify({'success': False, 'detail': '旧密码错误'}), 400
+    if not data.get('new_password'): return jsonify({'success': False, 'detail': '新密码不能为空'}), 400
+    changes = {'admin_password_hash': generate_password_hash(data['new_password'])}
+    if data.get('username'): changes['admin_username'] = data['username']
+    _save_config(changes)
+    return jsonify({'success': True})
+
 # --- OpenAI Compatible Proxy ---
 
-_rr_lock = Lock()
-_rr_index = 0
-
-def _get_token_candidates():
-    global _rr_index
-    tokens = Token.query.filter_by(is_active=True).order_by(Token.id.asc()).all()
-    valid_tokens = [t for t in tokens if t.zai_token and not str(t.zai_token).startswith('SESSION')]
-    if not valid_tokens: return []
-    with _rr_lock:
-        start = _rr_index % len(valid_tokens)
-        _rr_index = (start + 1) % len(valid_tokens)
-    return valid_tokens[start:] + valid_tokens[:start]
-
-def _mark_token_error(token: Token, config: SystemConfig, reason: str):
-    token.error_count = int(token.error_count or 0) + 1
-    token.remark = (reason or '')[:1000]
-    if token.error_count >= (config.error_ban_threshold or 3):
+def _get_token_candidates(kind=None):
+    _ensure_token_pool()
+    candidates = token_pool.candidates(kind)
+    if not candidates: candidates = _relogin_expired(kind)
+    return candidates
+
+def _relogin_expired(kind=None):
+    # With auto-refresh off or failing, an expired JWT would otherwise keep its
+    # token out of rotation until an admin steps in. Concurrent requests share
+    # each login through reauth_flight, and a failed one is not retried for a while.
+    for record in token_pool.expired():
+        success, msg = services.update_token_info(record.id)
+        if success: return token_pool.candidates(kind)
+        logger.warning(f"Re-login of expired token {record.id} failed: {msg}")
+    return []
+
+def _mark_token_error(record, config, reason: str, auth_rejected=False):
+    token = db.session.get(Token, record.id)
+    if not token:
+        token_pool.remove(record.id)
+        return
+    # Incremented in SQL so concurrent gateway processes never lose a count
+    Token.query.filter_by(id=record.id).update({'error_count': db.func.coalesce(Token.error_count, 0) + 1})
+    db.session.refresh(token)
+    if auth_rejected:
+        # Refused even after a successful re-login: only this bans a token for good.
+        # A failed or skipped re-login, or a bare 403 (often a Cloudflare challenge), may be transient.
         token.is_active = False
         token.remark = f"Auto-banned: {(reason or '')[:950]}"
+    else:
+        # Anything else may be transient; error_ban_threshold consecutive failures open the circuit
+        breaker = token_pool.record_failure(record, config.error_ban_threshold or 3)
+        open_for = breaker[2] - time.time() if breaker else 0
+        token.remark = f"Circuit open for {int(open_for)}s: {(reason or '')[:950]}" if open_for > 0 else (reason or '')[:1000]
     db.session.commit()
+    token_pool.upsert(token)
+
+def _clear_token_errors(record):
+    token_pool.record_success(record)
+    if not record.error_count: return
+    Token.query.filter_by(id=record.id).update({'error_count': 0})
+    db.session.commit()
+    token_pool.update(record.id, error_count=0)
+
+def _log_request(token, status_code, duration):
+    # Buffered; written in bulk by the background log writer
+    log_writer.submit(operation="chat/completions", token_email=token.email, discord_token=_mask_token(token.discord_token), zai_token=_mask_token(token.zai_token), status_code=status_code, duration=duration)
+
+def _chat_with_token(token, payload, want_stream, config, start_time, lease, attempt=None):
+    # Returns a Response on success, or None to fail over to the next token.
+    # attempt is set for hedged requests; a cancelled attempt is not the token's fault.
+    logger.info(f"Using token {token.id} for request... (Stream requested: {want_stream})")
+    attempt_start = time.time()
+    if want_stream:
+        streamed = _browser_proxy_stream("https://zai.is/api/v1/chat/completions", payload, token_obj=token)
+        if not streamed:
+            logger.error("Browser stream proxy returned None")
+            token_pool.observe(token, time.time() - attempt_start, ok=False)
+            _mark_token_error(token, config, 'Browser proxy failed')
+            return None
+
+        status, upstream, auth_rejected = streamed
+        _log_request(token, status, time.time() - start_time)
+        # Time to first byte is the latency signal for streamed requests
+        token_pool.observe(token, time.time() - attempt_start, ok=status < 400)
+
+        if status >= 400:
+            body = upstream.text
+            upstream.close()
+            logger.error(f"Browser stream proxy error body: {body[:500]}")
+            _mark_token_error(token, config, body, auth_rejected)
+            return None
+
+        _clear_token_errors(token)
+
+        # The token stays busy until the client has received the whole stream
+        lease.handed_off = True
+        def relay_stream():
+            try:
+                for chunk in upstream.iter_content(chunk_size=None):
+                    if chunk: yield chunk
+            finally:
+                upstream.close()
+                lease.release()
+
+        return Response(stream_with_context(relay_stream()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    res = _browser_proxy_request("https://zai.is/api/v1/chat/completions", "POST", payload, token_obj=token, request_id=attempt.request_id if attempt else None)
+    if attempt and attempt.cancelled:
+        logger.info(f"Hedged attempt on token {token.id} cancelled")
+        return None
+    
+    if res:
+        logger.info(f"Browser proxy response status: {res.get('status')}")
+        if res.get('status', 0) >= 400:
+            logger.error(f"Browser proxy error body: {res.get('body')}")
+    else:
+        logger.error("Browser proxy returned None")
+
+    if not res or 'error' in res:
+        error_msg = res.get('error', 'Browser proxy failed') if res else 'Network Error'
+        token_pool.observe(token, time.time() - attempt_start, ok=False)
+        _mark_token_error(token, config, error_msg)
+        return None
+    
+    # Result is {status, body}
+    _log_request(token, res.get('status'), time.time() - start_time)
+    token_pool.observe(token, time.time() - attempt_start, ok=res.get('status', 0) < 400)
+
+    if res.get('status', 0) >= 400:
+        _mark_token_error(token, config, str(res.get('body')), res.get('auth_rejected', False))
+        return None
+
+    _clear_token_errors(token)
+    hedge_policy.observe(time.time() - attempt_start)
+    
+    return jsonify(res.get('body'))
+
+def _chat_sequential(candidates, kind, payload, want_stream, config, start_time):
+    # Tries candidates one after another; returns (response or None, whether any token was tried)
+    attempted = False
+    for token in candidates:
+        lease = token_pool.acquire(token, kind)
+        if lease is None: continue
+        attempted = True
+        try:
+            response = _chat_with_token(token, payload, want_stream, config, start_time, lease)
+        finally:
+            if not lease.handed_off: lease.release()
+        if response is not None: return response, True
+    return None, attempted
+
+def _run_attempt(token, lease, payload, config, start_time, attempt):
+    with app.app_context():
+        try:
+            return _chat_with_token(token, payload, False, config, start_time, lease, attempt)
+        finally:
+            lease.release()
+
+def _cancel_attempt(attempt):
+    attempt.cancelled = True
+    try:
+        browser_client.post(f"{BROWSER_SERVICE_URL}/proxy/cancel", {'request_id': attempt.request_id, 'token': attempt.token.zai_token, 'token_id': attempt.token.id}).close()
+    except Exception as e:
+        logger.warning(f"Failed to cancel hedged attempt {attempt.request_id}: {e}")
+
+def _chat_hedged(candidates, kind, payload, config, start_time):
+    """Like _chat_sequential, but a request that outlives the hedge deadline is duplicated
+    on the next token; the first good response wins and the other attempt is cancelled."""
+    hedge_policy.record_request()
+    remaining = iter(candidates)
+    pending = {}
+    attempted = hedged = False
+
+    def launch(is_hedge=False):
+        for token in remaining:
+            lease = token_pool.acquire(token, kind)
+            if lease is None: continue
+            attempt = SimpleNamespace(request_id=uuid.uuid4().hex, token=token, cancelled=False, hedge=is_hedge)
+            pending[_attempt_executor.submit(_run_attempt, token, lease, payload, config, start_time, attempt)] = attempt
+            return True
+        return False
+
+    attempted = launch()
+    while pending:
+        done, _ = wait(pending, timeout=None if hedged else hedge_policy.delay(), return_when=FIRST_COMPLETED)
+        if not done:
+            # Past the deadline with no answer: one hedge per request, within budget
+            hedged = True
+            if hedge_policy.try_hedge() and launch(is_hedge=True):
+                logger.info(f"Hedging request on a second token after {time.time() - start_time:.1f}s")
+            continue
+        for future in done:
+            attempt = pending.pop(future)
+            try:
+                response = future.result()
+            except BrowserBusy:
+                # The other attempt may still answer
+                if pending: continue
+                raise
+            if response is None: continue
+            for loser in pending.values(): _attempt_executor.submit(_cancel_attempt, loser)
+            if attempt.hedge: hedge_policy.record_win()
+            return response, True
+        # Every finished attempt failed; fail over if nothing else is still running
+        if not pending: launch()
+    return None, attempted
+
+def _response_cacheable(payload, config):
+    # Only deterministic requests, or clients that opt in explicitly
+    if not config.cache_enabled: return False
+    cache_control = request.headers.get('Cache-Control', '').lower()
+    if 'no-cache' in cache_control or 'no-store' in cache_control: return False
+    if request.headers.get('X-Response-Cache', '').lower() in ('1', 'on', 'true'): return True
+    return payload.get('temperature') == 0
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def proxy_chat_completions():
     start_time = time.time()
-    config = SystemConfig.query.first()
+    config = services.get_config()
     auth_header = request.headers.get('Authorization')
     if not auth_header or auth_header.split(' ')[1] != config.api_key: return jsonify({'error': 'Invalid API Key'}), 401
     
     payload = request.get_json(silent=True) or {}
     
     # Check if client wants stream
-    want_stream = payload.get('stream', False)
-    
-    # FORCE stream=False for backend because browser execution blocks anyway
-    payload['stream'] = False
-    
-    candidates = _get_token_candidates()
-    if not candidates: return jsonify({'error': 'No active tokens available'}), 503
+    want_stream = bool(payload.get('stream', False))
 
-    for token in candidates:
-        logger.info(f"Using token {token.id} for request... (Stream requested: {want_stream})")
-        res = _browser_proxy_request("https://zai.is/api/v1/chat/completions", "POST", payload, token_obj=token)
-        
-        if res:
-            logger.info(f"Browser proxy response status: {res.get('status')}")
-            if res.get('status', 0) >= 400:
-                logger.error(f"Browser proxy error body: {res.get('body')}")
-        else:
-            logger.error("Browser proxy returned None")
+    # Streaming requests are relayed chunk by chunk through the browser service
+    payload['stream'] = want_stream
 
-        if not res or 'error' in res:
-            error_msg = res.get('error', 'Browser proxy failed') if res else 'Network Error'
-            _mark_token_error(token, config, error_msg)
-            continue
-        
-        # Result is {status, body}
-        duration = time.time() - start_time
-        log = RequestLog(operation="chat/completions", token_email=token.email, discord_token=_mask_token(token.discord_token), zai_token=_mask_token(token.zai_token), status_code=res.get('status'), duration=duration)
-        db.session.add(log)
-        db.session.commit()
+    key = cache_key(payload) if not want_stream and _response_cacheable(payload, config) else None
+    if key:
+        cached = response_cache.get(key)
+        if cached is not None:
+            response = jsonify(cached)
+            response.headers['X-Response-Cache'] = 'HIT'
+            return response
 
-        if res.get('status', 0) >= 400:
-            _mark_token_error(token, config, str(res.get('body')))
-            continue
-
-        token.error_count = 0
-        db.session.commit()
-        
-        response_body = res.get('body')
-        
-        # If client wanted stream, convert JSON response to SSE stream
-        if want_stream:
-            def generate_stream():
-                # Simulate a stream by emitting the full content as one chunk (or you could split it if you wanted to be fancy)
-                # But typically one chunk is enough for clients to process.
-                
-                # Check if it's a valid OpenAI-like response
-                if isinstance(response_body, dict) and 'choices' in response_body:
-                    # Construct a delta chunk
-                    chunk = response_body.copy()
-                    chunk['object'] = 'chat.completion.chunk'
-                    # Transform message to delta
-                    if chunk['choices']:
-                        msg = chunk['choices'][0].get('message', {})
-                        chunk['choices'][0]['delta'] = msg
-                        if 'message' in chunk['choices'][0]:
-                            del chunk['choices'][0]['message']
-                        chunk['choices'][0]['finish_reason'] = 'stop'
-                    
-                    yield f"data: {json.dumps(chunk)}\n\n"
-                    yield "data: [DONE]\n\n"
-                else:
-                    # Fallback for errors or unknown formats
-                    yield f"data: {json.dumps(response_body)}\n\n"
-                    yield "data: [DONE]\n\n"
-
-            return Response(stream_with_context(generate_stream()), mimetype='text/event-stream')
-
-        return jsonify(response_body)
+    kind = request_kind(payload.get('model'))
+    candidates = _get_token_candidates(kind)
+    if not candidates:
+        if token_pool.candidates(rotate=False): return jsonify({'error': 'All tokens are at their concurrency limit'}), 429
+        return jsonify({'error': 'No active tokens available'}), 503
 
+    try:
+        if hedge_policy.enabled and not want_stream and kind == 'chat':
+            response, attempted = _chat_hedged(candidates, kind, payload, config, start_time)
+        else:
+            response, attempted = _chat_sequential(candidates, kind, payload, want_stream, config, start_time)
+    except BrowserBusy as e:
+        return jsonify({'error': 'Browser service is overloaded, retry later'}), 429, {'Retry-After': str(e.retry_after)}
+    if response is not None:
+        if key:
+            body = response.get_json(silent=True)
+            if isinstance(body, dict) and body.get('choices'): response_cache.put(key, body, config.cache_timeout)
+            response.headers['X-Response-Cache'] = 'MISS'
+        return response
+
+    if not attempted: return jsonify({'error': 'All tokens are at their concurrency limit'}), 429
     return jsonify({'error': 'All candidates failed'}), 503
 
 @app.route('/v1/models', methods=['GET'])
 def proxy_models():
-    config = SystemConfig.query.first()
+    config = services.get_config()
     auth_header = request.headers.get('Authorization')
     if not auth_header or auth_header.split(' ')[1] != config.api_key: return jsonify({'error': 'Invalid API Key'}), 401
-    token = Token.query.filter_by(is_active=True).first()
-    if not token: return jsonify({"object": "list", "data": []})
-    
-    res = _browser_proxy_request("https://zai.is/api/v1/models", "GET", None, token_obj=token)
-    if res and res.get('status') == 200:
-        return jsonify(res.get('body'))
+    _ensure_token_pool()
+    candidates = token_pool.candidates(rotate=False)
+    if not candidates: return jsonify({"object": "list", "data": []})
+    models = models_cache.get()
+    if models is not None:
+        return jsonify(models)
     return jsonify({"error": "Failed to fetch models"}), 500
 
+def _fetch_models():
+    # Runs on request threads and background refreshes, so it brings its own context
+    with app.app_context():
+        _ensure_token_pool()
+        candidates = token_pool.candidates(rotate=False)
+        if not candidates: return None
+        res = _browser_proxy_request("https://zai.is/api/v1/models", "GET", None, token_obj=candidates[0])
+        if res and res.get('status') == 200: return res.get('body')
+        return None
+
+models_cache = ModelListCache(_fetch_models, ttl=float(os.environ.get('MODELS_CACHE_TTL', 300)))
+
+def scheduled_models_refresh():
+    # Keep a list that clients have asked for fresh, so they rarely see a stale one
+    if models_cache.stats()['cached']: models_cache.refresh()
+
+scheduler.add_job(scheduled_models_refresh, 'interval', seconds=models_cache.ttl, id='models_refresher')
+
+def _gateway_config(bind):
+    from hypercorn.config import Config
+    config = Config()
+    config.bind = [bind]
+    config.keep_alive_timeout = 75
+    # Requests with inline base64 images can be large
+    config.wsgi_max_body_size = 64 * 1024 * 1024
+    return config
+
+async def serve_gateway(bind, threads=64, shutdown_trigger=None, sockets=None):
+    """Serve the Flask app under Hypercorn; each request runs on a pool thread, so a long completion never blocks other clients."""
+    from concurrent.futures import ThreadPoolExecutor
+    from hypercorn.asyncio import serve
+    from hypercorn.asyncio.run import worker_serve
+    from hypercorn.utils import wrap_app
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=threads, thread_name_prefix='gateway'))
+    config = _gateway_config(bind)
+    if sockets is None:
+        await serve(app, config, shutdown_trigger=shutdown_trigger, mode='wsgi')
+    else:
+        # Worker process accepting on sockets opened by the parent
+        await worker_serve(wrap_app(app, config.wsgi_max_body_size, 'wsgi'), config, sockets=sockets, shutdown_trigger=shutdown_trigger)
+
+def _gateway_worker(bind, threads, sockets, shutdown_event):
+    from functools import partial
+    from hypercorn.utils import check_multiprocess_shutdown_event
+    asyncio.run(serve_gateway(bind, threads, shutdown_trigger=partial(check_multiprocess_shutdown_event, shutdown_event, asyncio.sleep), sockets=sockets))
+
+def run_gateway_workers(bind, workers, threads):
+    """Run several gateway processes on one port; they coordinate token routing through the shared state backend."""
+    import multiprocessing
+    import signal
+    sockets = _gateway_config(bind).create_sockets()
+    ctx = multiprocessing.get_context('spawn')
+    shutdown_event = ctx.Event()
+    # Workers serve requests only; scheduled jobs stay in this process
+    os.environ['GATEWAY_WORKER'] = '1'
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    processes = [ctx.Process(target=_gateway_worker, args=(bind, threads, sockets, shutdown_event)) for _ in range(workers)]
+    for process in processes: process.start()
+    for name in ('SIGINT', 'SIGTERM'):
+        signal.signal(getattr(signal, name), lambda *args: shutdown_event.set())
+    for process in processes: process.join()
+
 if __name__ == '__main__':
     init_db()
-    app.run(host='0.0.0.0', port=5003, debug=True, use_reloader=False, threaded=False, processes=1)
+    port = int(os.environ.get('APP_PORT', 5003))
+    if os.environ.get('APP_SERVER', 'production') == 'dev':
+        app.run(host='0.0.0.0', port=port, debug=True, use_reloader=False, threaded=True)
+    else:
+        workers = int(os.environ.get('APP_WORKERS', 1))
+        if workers > 1:
+            if not shared_state.shared: raise SystemExit("APP_WORKERS > 1 requires SHARED_STATE_PATH so the workers share token routing state")
+            logger.info(f"Serving on 0.0.0.0:{port} with {workers} processes x {APP_THREADS} worker threads")
+            run_gateway_workers(f"0.0.0.0:{port}", workers, APP_THREADS)
+        else:
+            logger.info(f"Serving on 0.0.0.0:{port} with {APP_THREADS} worker threads")
+            asyncio.run(serve_gateway(f"0.0.0.0:{port}", threads=APP_THREADS))
@@ -1,68 +1,349 @@
-from flask import Flask, jsonify, request
-from playwright.sync_api import sync_playwright
+from quart import Quart, jsonify, request, Response
+from playwright.async_api import async_playwright
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+import asyncio
+import gzip
 import json
+import math
 import time
 import logging
 import os
-import threading
-import queue
 import uuid
 
 # Config
 PORT = int(os.environ.get('PORT', 5006))
 # Remote debugging port for local Chrome
 CDP_URL = "http://127.0.0.1:9222"
+# Upper bound for a single proxied request (seconds)
+REQUEST_TIMEOUT = float(os.environ.get('BROWSER_REQUEST_TIMEOUT', 120))
+# Max concurrent fetches multiplexed through one warm page
+PAGE_CONCURRENCY = max(1, int(os.environ.get('BROWSER_PAGE_CONCURRENCY', 8)))
+# Admission control: proxy requests running at once, how many may wait for a
+# turn, and the longest a request waits before it is turned away with 429
+MAX_ACTIVE = max(1, int(os.environ.get('BROWSER_MAX_ACTIVE', 64)))
+QUEUE_DEPTH = max(0, int(os.environ.get('BROWSER_QUEUE_DEPTH', 256)))
+QUEUE_MAX_WAIT = float(os.environ.get('BROWSER_QUEUE_MAX_WAIT', 30))
+# Warm pages kept open at once (least recently used go first), and how long an unused page lives
+MAX_PAGES = max(1, int(os.environ.get('BROWSER_MAX_PAGES', 32)))
+PAGE_IDLE_TTL = float(os.environ.get('BROWSER_PAGE_IDLE_TTL', 900))
+# Longest a new page waits for a readiness signal before serving anyway
+PAGE_READY_TIMEOUT = float(os.environ.get('BROWSER_PAGE_READY_TIMEOUT', 10))
+# Spare contexts kept after their page closes, each reused only by the token that had it
+IDLE_CONTEXTS = max(0, int(os.environ.get('BROWSER_IDLE_CONTEXTS', 4)))
+# The only Chrome profile cookies copied into per-token contexts
+CLOUDFLARE_COOKIES = ('cf_clearance', '__cf_bm', '__cflb', '_cfuvid')
+# How long a captured x-zai-darkknight header is handed out for direct requests
+DK_TTL = float(os.environ.get('BROWSER_DK_TTL', 300))
+# Pages opened at once by /warm
+WARM_CONCURRENCY = max(1, int(os.environ.get('BROWSER_WARM_CONCURRENCY', 4)))
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = Quart(__name__)
 
-# Global Queues
-request_queue = queue.Queue()
-response_queues = {} 
+# Per-request chunk queues for streaming proxy requests
+stream_queues = {}
+# Strong references to fire-and-forget tasks until they finish
+background_tasks = set()
 
-# Global State for Worker
+# Global State, only ever touched from the event loop. Pages are keyed by
+# token id (the JWT only for callers that send no id), oldest use first.
 worker_state = {
     "cookies": None,
-    "pages": {} 
+    "playwright": None,
+    # One CDP connection to Chrome, shared by every page
+    "browser": None,
+    "browser_lock": asyncio.Lock(),
+    "cdp_stats": {'connects': 0, 'disconnects': 0, 'contexts_created': 0, 'contexts_reused': 0},
+    # Every page has a BrowserContext of its own so tokens never share cookies or
+    # site storage; page key -> spare context, oldest first
+    "idle_contexts": OrderedDict(),
+    "pages": OrderedDict(),
+    "page_locks": {},
+    "page_slots": {},
+    "inflight": {},
+    "page_stats": {'created': 0, 'evicted_lru': 0, 'evicted_idle': 0, 'dropped': 0, 'not_ready': 0, 'warmed': 0},
+    "warm_slots": asyncio.Semaphore(WARM_CONCURRENCY),
+    # Pages app.py wants kept warm (the last /warm set) are exempt from idle eviction
+    "pinned": set(),
+    "warming": set()
 }
 
-def browser_worker():
-    """Single dedicated thread for all Playwright interactions using CDP connection"""
-    logger.info("Browser Worker Thread Started (CDP Connection Mode)")
-    
-    # ENSURE NO PROXY for CDP connection
-    os.environ["NO_PROXY"] = "localhost,127.0.0.1,*"
-    
-    with sync_playwright() as p:
-        while True:
-            try:
-                req = request_queue.get()
-                req_id, req_type, data = req
-                
-                logger.info(f"Worker processing request {req_id} ({req_type})")
-                
-                result = None
-                try:
-                    if req_type == 'init':
-                        result = _handle_init(data)
-                    elif req_type == 'proxy':
-                        result = _handle_proxy(p, data)
-                    else:
-                        result = {'error': 'unknown request type'}
-                except Exception as e:
-                    logger.error(f"Worker error processing {req_id}: {e}")
-                    result = {'error': str(e)}
-                
-                if req_id in response_queues:
-                    response_queues[req_id].put(result)
-                
-                request_queue.task_done()
-                
-            except Exception as e:
-                logger.error(f"Critical Worker Loop Error: {e}")
-                time.sleep(1)
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+class AdmissionQueue:
+    """Caps how many proxy requests run at once and how many may queue for a turn.
+
+    Waiters are served in arrival order. A request is turned away when the
+    queue is full, when it has waited max_wait seconds, or when its caller's
+    deadline passes first, so no browser time is spent on an answer nobody
+    is waiting for. A caller that disconnects leaves the queue at once.
+    """
+
+    def __init__(self, max_active=64, max_queue=256, max_wait=30.0):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters = deque()
+        # EWMA of how long an admitted request holds its slot, for Retry-After
+        self._service_time = None
+        self._stats = {'admitted': 0, 'queued': 0, 'rejected_full': 0, 'expired': 0}
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def retry_after(self):
+        """Whole seconds until the current backlog should have drained."""
+        service = self._service_time or 1.0
+        backlog = math.ceil(service * (self.waiting + 1) / self.max_active)
+        return max(1, min(backlog, math.ceil(self.max_wait) or 1))
+
+    async def acquire(self, deadline=None):
+        """Wait for a slot; deadline is the caller's time.monotonic() give-up time."""
+        if self.active < self.max_active and not self._waiters:
+            self.active += 1
+            self._stats['admitted'] += 1
+            return
+        if self.waiting >= self.max_queue:
+            self._stats['rejected_full'] += 1
+            raise Overloaded('queue full', self.retry_after())
+        wait = self.max_wait
+        if deadline is not None: wait = min(wait, deadline - time.monotonic())
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self._stats['queued'] += 1
+        try:
+            await asyncio.wait_for(future, max(wait, 0))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Handed a slot just as we gave up: pass it on
+                self.release()
+            elif future in self._waiters:
+                self._waiters.remove(future)
+            if isinstance(e, asyncio.CancelledError): raise
+            self._stats['expired'] += 1
+            raise Overloaded('queue wait exceeded', self.retry_after())
+        self._stats['admitted'] += 1
+
+    def release(self, held=None):
+        """Free a slot held for held seconds; the first live waiter takes it over."""
+        if held is not None:
+            self._service_time = held if self._service_time is None else 0.8 * self._service_time + 0.2 * held
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, deadline=None):
+        await self.acquire(deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self):
+        result = dict(self._stats)
+        result.update(active=self.active, waiting=self.waiting, max_active=self.max_active, max_queue=self.max_queue)
+        result['service_time'] = round(self._service_time, 3) if self._service_time is not None else None
+        return result
+
+admission = AdmissionQueue(MAX_ACTIVE, QUEUE_DEPTH, QUEUE_MAX_WAIT)
+
+# Each fetch registers an AbortController under its request id so that
+# /proxy/cancel can stop it (used for the losing side of a hedged request).
+PROXY_JS = """
+    async ({url, method, payload, token, reqId}) => {
+        const headers = {
+            'Authorization': 'Bearer ' + token,
+            'Content-Type': 'application/json'
+        };
+        if (window._latestDK) headers['x-zai-darkknight'] = window._latestDK;
+
+        const controller = new AbortController();
+        window.__zaiAborts = window.__zaiAborts || {};
+        window.__zaiAborts[reqId] = controller;
+        const options = {
+            method: method,
+            headers: headers,
+            signal: controller.signal
+        };
+        if (payload && method !== 'GET') options.body = JSON.stringify(payload);
+
+        try {
+            const resp = await fetch(url, options);
+            let body = await resp.text();
+            try { body = JSON.parse(body); } catch (e) {}
+
+            return {
+                status: resp.status,
+                body: body
+            };
+        } catch (e) {
+            if (e.name === 'AbortError') return {status: 499, body: null, cancelled: true};
+            throw e;
+        } finally {
+            delete window.__zaiAborts[reqId];
+        }
+    }
+"""
+
+CANCEL_JS = """
+    (reqId) => {
+        const controller = window.__zaiAborts && window.__zaiAborts[reqId];
+        if (controller) controller.abort();
+        return !!controller;
+    }
+"""
+
+# A page is ready once zai.is has signed one of its own API calls with
+# x-zai-darkknight, or a models fetch has gone through. Retries until then.
+READY_JS = """
+    async (timeoutMs) => {
+        const deadline = Date.now() + timeoutMs;
+        while (true) {
+            if (window._latestDK) return 'darkknight';
+            try {
+                const resp = await fetch('/api/v1/models');
+                if (window._latestDK) return 'darkknight';
+                if (resp.ok) return 'models';
+            } catch (e) {}
+            if (Date.now() >= deadline) return null;
+            await new Promise(r => setTimeout(r, 250));
+        }
+    }
+"""
+
+# Hands the page's credentials to app.py's direct transport. A header older
+# than half its lifetime is replaced by having the app sign a fresh request.
+CREDENTIALS_JS = """
+    async (maxAgeMs) => {
+        if (!window._latestDK || Date.now() - window._latestDKAt > maxAgeMs / 2) {
+            try { await fetch('/api/v1/models'); } catch (e) {}
+        }
+        return {
+            darkknight: window._latestDK,
+            ageMs: window._latestDK ? Date.now() - window._latestDKAt : null,
+            userAgent: navigator.userAgent
+        };
+    }
+"""
+
+# Reads the fetch body chunk by chunk and hands every chunk back to Python
+# as it arrives, instead of buffering the whole completion in the page.
+# Registers its AbortController like PROXY_JS, so a stalled stream can be stopped.
+STREAM_JS = """
+    async ({url, method, payload, token, reqId}) => {
+        const push = window.__zaiStreamPush;
+        const headers = {
+            'Authorization': 'Bearer ' + token,
+            'Content-Type': 'application/json'
+        };
+        if (window._latestDK) headers['x-zai-darkknight'] = window._latestDK;
+
+        const controller = new AbortController();
+        window.__zaiAborts = window.__zaiAborts || {};
+        window.__zaiAborts[reqId] = controller;
+        const options = {
+            method: method,
+            headers: headers,
+            signal: controller.signal
+        };
+        if (payload && method !== 'GET') options.body = JSON.stringify(payload);
+
+        try {
+            const resp = await fetch(url, options);
+            if (!(await push(reqId, 'status', resp.status))) return resp.status;
+
+            const reader = resp.body.getReader();
+            const decoder = new TextDecoder();
+            while (true) {
+                const {done, value} = await reader.read();
+                if (done) break;
+                const text = decoder.decode(value, {stream: true});
+                if (text && !(await push(reqId, 'chunk', text))) {
+                    // Caller disconnected, stop pulling from upstream
+                    await reader.cancel();
+                    return resp.status;
+                }
+            }
+            const tail = decoder.decode();
+            if (tail) await push(reqId, 'chunk', tail);
+            return resp.status;
+        } catch (e) {
+            if (e.name === 'AbortError') return 499;
+            throw e;
+        } finally {
+            delete window.__zaiAborts[reqId];
+        }
+    }
+"""
+
+async def _get_playwright():
+    if worker_state["playwright"] is None:
+        # ENSURE NO PROXY for CDP connection
+        os.environ["NO_PROXY"] = "localhost,127.0.0.1,*"
+        worker_state["playwright"] = await async_playwright().start()
+        logger.info("Playwright started (CDP Connection Mode)")
+    return worker_state["playwright"]
+
+async def _get_browser():
+    browser = worker_state["browser"]
+    if browser is not None and browser.is_connected():
+        return browser
+    async with worker_state["browser_lock"]:
+        browser = worker_state["browser"]
+        if browser is not None and browser.is_connected():
+            return browser
+        p = await _get_playwright()
+        logger.info(f"Connecting to existing Chrome via CDP at {CDP_URL}...")
+        # CONNECT instead of LAUNCH
+        browser = await p.chromium.connect_over_cdp(CDP_URL)
+        browser.on("disconnected", _on_browser_disconnected)
+        worker_state["browser"] = browser
+        worker_state["cdp_stats"]['connects'] += 1
+        return browser
+
+def _on_browser_disconnected(browser):
+    if worker_state["browser"] is not browser: return
+    # Chrome restarted or the socket dropped: its pages are gone too, the next request reconnects
+    logger.warning("CDP connection to Chrome lost")
+    worker_state["browser"] = None
+    worker_state["cdp_stats"]['disconnects'] += 1
+    worker_state["idle_contexts"] = OrderedDict((k, c) for k, c in worker_state["idle_contexts"].items() if c.browser is not browser)
+    for key in list(worker_state["pages"]):
+        if worker_state["pages"][key].get('browser') is browser:
+            del worker_state["pages"][key]
+            worker_state["page_stats"]['dropped'] += 1
+
+@app.before_serving
+async def _start_page_sweeper():
+    task = asyncio.create_task(_sweep_idle_pages())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+@app.after_serving
+async def _shutdown_playwright():
+    for task in list(background_tasks): task.cancel()
+    for key in list(worker_state["pages"]): await _close_page(key)
+    while worker_state["idle_contexts"]:
+        try: await worker_state["idle_contexts"].popitem()[1].close()
+        except: pass
+    if worker_state["playwright"] is not None:
+        await worker_state["playwright"].stop()
+        worker_state["playwright"] = None
 
 def _handle_init(data):
     cookies = data.get('cookies')
@@ -71,141 +352,498 @@ def _handle_init(data):
         return {'status': 'ready'}
     return {'error': 'no cookies'}
 
-def _get_or_create_page(p, jwt_token, req_cookies):
-    if jwt_token in worker_state["pages"]:
-        entry = worker_state["pages"][jwt_token]
+def _on_stream_push(req_id, kind, value):
+    """Called from the page for every streaming event; returns False once the caller is gone."""
+    q = stream_queues.get(req_id)
+    if q is None:
+        return False
+    q.put_nowait((kind, value))
+    return True
+
+def _page_key(data):
+    # A refreshed JWT keeps using its token's page instead of orphaning it
+    token_id = data.get('token_id')
+    return f"id:{token_id}" if token_id is not None else data.get('token')
+
+def _cached_page(key):
+    entry = worker_state["pages"].get(key)
+    if not entry:
+        return None
+    if entry['page'].is_closed():
+        del worker_state["pages"][key]
+        return None
+    worker_state["pages"].move_to_end(key)
+    entry['last_used'] = time.monotonic()
+    return entry['page']
+
+async def _close_page(key):
+    entry = worker_state["pages"].pop(key, None)
+    if not worker_state["inflight"].get(key):
+        worker_state["inflight"].pop(key, None)
+        worker_state["page_slots"].pop(key, None)
+        lock = worker_state["page_locks"].get(key)
+        if lock and not lock.locked(): del worker_state["page_locks"][key]
+    if entry:
+        try: await entry['page'].close()
+        except: pass
+        await _release_context(key, entry['context'])
+    return entry is not None
+
+def _is_cloudflare_cookie(name):
+    return name in CLOUDFLARE_COOKIES or name.startswith(('cf_', '__cf'))
+
+async def _token_context(browser, key):
+    """A context of its own for one token's page, reusing the token's spare one when there is one."""
+    shared = browser.contexts[0] if browser.contexts else None
+    # Clearing cookies leaves zai.is localStorage and IndexedDB behind, where
+    # the front end keeps its login, so a spare never passes to another token
+    context = worker_state["idle_contexts"].pop(key, None)
+    if context is not None and context.browser is not browser:
+        context = None
+    if context is None:
+        context = await browser.new_context()
+        worker_state["cdp_stats"]['contexts_created'] += 1
+    else:
+        worker_state["cdp_stats"]['contexts_reused'] += 1
+    # Start from the Chrome profile's Cloudflare cookies only; any other profile
+    # cookie (e.g. another account's session) must not leak into this token's context
+    if shared is not None and shared is not context:
+        profile_cookies = [c for c in await shared.cookies() if _is_cloudflare_cookie(c['name'])]
+        if profile_cookies: await context.add_cookies(profile_cookies)
+    return context
+
+async def _release_context(key, context):
+    try:
+        browser = context.browser
+        if IDLE_CONTEXTS and browser is not None and browser.is_connected():
+            await context.clear_cookies()
+            worker_state["idle_contexts"][key] = context
+            worker_state["idle_contexts"].move_to_end(key)
+            context = None
+            if len(worker_state["idle_contexts"]) > IDLE_CONTEXTS:
+                context = worker_state["idle_contexts"].popitem(last=False)[1]
+        if context is not None: await context.close()
+    except Exception as e:
+        logger.warning(f"Failed to release browser context: {e}")
+
+async def _drop_page(key):
+    if await _close_page(key): worker_state["page_stats"]['dropped'] += 1
+
+# Playwright errors raised once the page, its context or the browser is gone
+PAGE_CLOSED_ERRORS = ('Target closed', 'Target page, context or browser has been closed', 'Browser has been closed', 'Connection closed')
+
+async def _drop_if_dead(key, page, e):
+    # Several requests share one page, so a failed fetch (a JS error) must not
+    # close it under the others; only a page that is really gone is dropped
+    if page is None: return
+    if page.is_closed() or any(marker in str(e) for marker in PAGE_CLOSED_ERRORS):
+        await _drop_page(key)
+
+def _idle_keys(older_than=None):
+    # Least recently used first; pages with requests in flight are never evicted,
+    # and pinned pages never expire for being idle
+    for key, entry in worker_state["pages"].items():
+        if worker_state["inflight"].get(key): continue
+        if older_than is not None and entry['last_used'] > older_than: break
+        if older_than is not None and key in worker_state["pinned"]: continue
+        yield key
+
+def _eviction_order():
+    # Idle pages, least recently used first, with pages kept warm for app.py last
+    idle = list(_idle_keys())
+    pinned = worker_state["pinned"]
+    return [key for key in idle if key not in pinned] + [key for key in idle if key in pinned]
+
+async def _evict_for_new_page():
+    excess = len(worker_state["pages"]) - MAX_PAGES + 1
+    if excess <= 0: return
+    victims = _eviction_order()[:excess]
+    if len(victims) < excess:
+        logger.warning(f"Page cache over its limit of {MAX_PAGES}: every page is busy")
+    for key in victims:
+        logger.info(f"[{str(key)[:6]}] Evicting least recently used page")
+        await _close_page(key)
+        worker_state["page_stats"]['evicted_lru'] += 1
+
+async def _close_idle_pages():
+    for key in list(_idle_keys(older_than=time.monotonic() - PAGE_IDLE_TTL)):
+        logger.info(f"[{str(key)[:6]}] Closing page idle for over {PAGE_IDLE_TTL:.0f}s")
+        await _close_page(key)
+        worker_state["page_stats"]['evicted_idle'] += 1
+
+async def _sweep_idle_pages():
+    while True:
+        await asyncio.sleep(max(min(PAGE_IDLE_TTL / 4, 60), 1))
+        await _close_idle_pages()
+
+async def _get_or_create_page(key, req_cookies):
+    page = _cached_page(key)
+    if page:
+        await _refresh_cookies(key, req_cookies)
+        return page
+
+    # Concurrent first requests for one token must not open several pages
+    lock = worker_state["page_locks"].setdefault(key, asyncio.Lock())
+    async with lock:
+        page = _cached_page(key)
+        if page:
+            return page
+        return await _create_page(key, req_cookies)
+
+async def _refresh_cookies(key, req_cookies):
+    # A re-login hands the token new cookies while its page stays open
+    entry = worker_state["pages"].get(key)
+    if not entry or entry['cookies'] == req_cookies: return
+    entry['cookies'] = req_cookies
+    await entry['context'].add_cookies([{"name": k, "value": v, "domain": "zai.is", "path": "/"} for k, v in req_cookies.items()])
+
+@asynccontextmanager
+async def _page_slot(key):
+    # The page's fetch is asynchronous, so several requests can run on one
+    # page at once; the semaphore only caps how many.
+    slots = worker_state["page_slots"].get(key)
+    if slots is None:
+        slots = worker_state["page_slots"][key] = asyncio.Semaphore(PAGE_CONCURRENCY)
+    async with slots:
+        worker_state["inflight"][key] = worker_state["inflight"].get(key, 0) + 1
+        try:
+            yield
+        finally:
+            worker_state["inflight"][key] -= 1
+
+async def _page_metrics():
+    async def js_heap(entry):
         try:
-            if not entry['page'].is_closed():
-                entry['last_used'] = time.time()
-                return entry['page']
-        except:
-            del worker_state["pages"][jwt_token]
-
-    logger.info(f"[{jwt_token[:6]}] Connecting to existing Chrome via CDP...")
-    
+            return await asyncio.wait_for(entry['page'].evaluate("performance.memory ? performance.memory.usedJSHeapSize : 0"), timeout=2)
+        except Exception:
+            return 0
+    entries = list(worker_state["pages"].values())
+    heaps = await asyncio.gather(*(js_heap(entry) for entry in entries))
+    now = time.monotonic()
+    result = dict(worker_state["page_stats"])
+    result.update(pages=len(entries), max_pages=MAX_PAGES, idle_ttl=PAGE_IDLE_TTL, busy_pages=sum(1 for n in worker_state["inflight"].values() if n))
+    result['js_heap_bytes'] = sum(heaps)
+    result['oldest_idle'] = round(max((now - entry['last_used'] for entry in entries), default=0), 1)
+    return result
+
+async def _wait_until_ready(page, label):
+    start = time.monotonic()
     try:
-        # CONNECT instead of LAUNCH
-        browser = p.chromium.connect_over_cdp(CDP_URL)
-        # Use existing context or create new one if needed. 
-        # Ideally we use the default context of the opened browser to share everything.
-        context = browser.contexts[0] if browser.contexts else browser.new_context()
-        
+        signal = await asyncio.wait_for(page.evaluate(READY_JS, PAGE_READY_TIMEOUT * 1000), timeout=PAGE_READY_TIMEOUT + 5)
+    except Exception as e:
+        logger.warning(f"[{label}] Readiness check failed: {e}")
+        signal = None
+    if signal:
+        logger.info(f"[{label}] Page ready ({signal}) after {time.monotonic() - start:.2f}s")
+    else:
+        worker_state["page_stats"]['not_ready'] += 1
+        logger.warning(f"[{label}] No readiness signal after {PAGE_READY_TIMEOUT:.0f}s, serving anyway")
+    return signal
+
+async def _warm_page(key, req_cookies):
+    try:
+        async with worker_state["warm_slots"]:
+            # Warming only pushes out idle pages nobody asked to keep warm
+            if key not in worker_state["pages"] and len(worker_state["pages"]) >= MAX_PAGES:
+                if not any(k not in worker_state["pinned"] for k in _idle_keys()): return
+            await _get_or_create_page(key, req_cookies)
+            worker_state["page_stats"]['warmed'] += 1
+    except Exception as e:
+        logger.warning(f"[{str(key)[:6]}] Pre-warming failed: {e}")
+    finally:
+        worker_state["warming"].discard(key)
+
+async def _create_page(key, req_cookies):
+    await _evict_for_new_page()
+    label = str(key)[:6]
+    logger.info(f"[{label}] Opening page...")
+
+    context = page = None
+    try:
+        browser = await _get_browser()
+        context = await _token_context(browser, key)
+
         # Inject cookies
         p_cookies = [{"name": k, "value": v, "domain": "zai.is", "path": "/"} for k, v in req_cookies.items()]
-        context.add_cookies(p_cookies)
-        
-        page = context.new_page()
-        
-        page.add_init_script("""
+        await context.add_cookies(p_cookies)
+
+        page = await context.new_page()
+        await page.expose_function("__zaiStreamPush", _on_stream_push)
+
+        await page.add_init_script("""
             window._latestDK = null;
+            window._latestDKAt = 0;
             const originalFetch = window.fetch;
             window.fetch = async function(...args) {
                 const req = new Request(...args);
                 const dk = req.headers.get('x-zai-darkknight');
-                if (dk) window._latestDK = dk;
+                if (dk) {
+                    window._latestDK = dk;
+                    window._latestDKAt = Date.now();
+                }
                 return originalFetch(...args);
             };
         """)
-        
-        page.on("console", lambda msg: logger.info(f"[{jwt_token[:6]}] Console: {msg.text}"))
-        
-        logger.info(f"[{jwt_token[:6]}] Navigating to chat...")
-        page.goto("https://zai.is/chat", wait_until="domcontentloaded", timeout=30000)
-        
-        # Warm up
-        page.wait_for_timeout(3000)
-        try:
-            page.evaluate("fetch('/api/v1/models').catch(e => {})")
-        except: pass
-        
-        worker_state["pages"][jwt_token] = {
+
+        page.on("console", lambda msg: logger.info(f"[{label}] Console: {msg.text}"))
+
+        logger.info(f"[{label}] Navigating to chat...")
+        await page.goto("https://zai.is/chat", wait_until="domcontentloaded", timeout=30000)
+
+        await _wait_until_ready(page, label)
+
+        worker_state["pages"][key] = {
             'browser': browser,
-            'context': context, # Don't close context on cleanup if it's shared
+            'context': context,
             'page': page,
-            'last_used': time.time()
+            'cookies': req_cookies,
+            'last_used': time.monotonic()
         }
+        worker_state["page_stats"]['created'] += 1
         return page
-        
+
     except Exception as e:
         logger.error(f"Failed to connect to CDP: {e}")
+        # A half-built page would otherwise hold its context open
+        if page is not None:
+            try: await page.close()
+            except: pass
+        if context is not None: await _release_context(key, context)
         raise Exception(f"Could not connect to Chrome on {CDP_URL}. Please ensure Chrome is running with --remote-debugging-port=9222")
 
-def _handle_proxy(p, data):
+async def _handle_proxy(data):
     url = data.get('url')
     method = data.get('method', 'GET')
     payload = data.get('payload')
     jwt_token = data.get('token')
     req_cookies = data.get('cookies') or worker_state["cookies"]
-    
+
     if not req_cookies or not jwt_token:
         return {'error': 'missing cookies or token'}
-        
+
+    req_id = data.get('request_id') or str(uuid.uuid4())
+    key = _page_key(data)
+    page = None
     try:
-        page = _get_or_create_page(p, jwt_token, req_cookies)
-        
-        result = page.evaluate("""
-            async ({url, method, payload, token}) => {
-                const headers = {
-                    'Authorization': 'Bearer ' + token,
-                    'Content-Type': 'application/json'
-                };
-                if (window._latestDK) headers['x-zai-darkknight'] = window._latestDK;
-                
-                const options = {
-                    method: method,
-                    headers: headers
-                };
-                if (payload && method !== 'GET') options.body = JSON.stringify(payload);
-                
-                const resp = await fetch(url, options);
-                let body = await resp.text();
-                try { body = JSON.parse(body); } catch (e) {}
-                
-                return {
-                    status: resp.status,
-                    body: body
-                };
-            }
-        """, {'url': url, 'method': method, 'payload': payload, 'token': jwt_token})
-        
-        return result
+        page = await _get_or_create_page(key, req_cookies)
+        async with _page_slot(key):
+            return await page.evaluate(PROXY_JS, {'url': url, 'method': method, 'payload': payload, 'token': jwt_token, 'reqId': req_id})
     except Exception as e:
         logger.error(f"Proxy execution error: {e}")
-        # Only clear cache if page is truly dead
-        if jwt_token in worker_state["pages"]:
-            try: worker_state["pages"][jwt_token]['page'].close() 
-            except: pass
-            del worker_state["pages"][jwt_token]
+        await _drop_if_dead(key, page, e)
+        return {'error': str(e)}
+
+async def _handle_proxy_stream(req_id, data):
+    url = data.get('url')
+    method = data.get('method', 'POST')
+    payload = data.get('payload')
+    jwt_token = data.get('token')
+    req_cookies = data.get('cookies') or worker_state["cookies"]
+
+    if not req_cookies or not jwt_token:
+        _on_stream_push(req_id, 'error', 'missing cookies or token')
+        return
+
+    key = _page_key(data)
+    page = None
+    try:
+        page = await _get_or_create_page(key, req_cookies)
+        async with _page_slot(key):
+            try:
+                await asyncio.wait_for(page.evaluate(STREAM_JS, {'url': url, 'method': method, 'payload': payload, 'token': jwt_token, 'reqId': req_id}), timeout=REQUEST_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                # Left alone, the page would keep waiting on a stalled upstream
+                # and hold this slot, its inflight count and an admission slot
+                await _abort_fetch(page, req_id)
+                raise
+        _on_stream_push(req_id, 'end', None)
+    except asyncio.TimeoutError:
+        logger.warning(f"Stream {req_id} still open after {REQUEST_TIMEOUT:.0f}s, aborted")
+        _on_stream_push(req_id, 'error', 'timeout')
+    except Exception as e:
+        logger.error(f"Stream proxy execution error: {e}")
+        await _drop_if_dead(key, page, e)
+        _on_stream_push(req_id, 'error', str(e))
+
+async def _abort_fetch(page, req_id):
+    try:
+        return await asyncio.wait_for(page.evaluate(CANCEL_JS, req_id), timeout=5)
+    except Exception as e:
+        logger.warning(f"Cancel failed: {e}")
+        return False
+
+def _caller_deadline():
+    # app.py sends how long it will wait; past that the answer is wasted
+    timeout = REQUEST_TIMEOUT
+    try:
+        timeout = min(timeout, float(request.headers.get('X-Request-Timeout', timeout)))
+    except ValueError:
+        pass
+    return time.monotonic() + timeout
+
+def _overloaded_response(e):
+    logger.warning(f"Rejecting proxy request: {e} ({admission.active} active, {admission.waiting} waiting)")
+    return jsonify({'error': 'overloaded', 'reason': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+
+async def _handle_credentials(data):
+    jwt_token = data.get('token')
+    req_cookies = data.get('cookies') or worker_state["cookies"]
+    if not req_cookies or not jwt_token:
+        return {'error': 'missing cookies or token'}
+
+    key = _page_key(data)
+    page = None
+    try:
+        page = await _get_or_create_page(key, req_cookies)
+        async with _page_slot(key):
+            minted = await page.evaluate(CREDENTIALS_JS, DK_TTL * 1000)
+            cookies = await page.context.cookies("https://zai.is")
+    except Exception as e:
+        logger.error(f"Credential export error: {e}")
+        await _drop_if_dead(key, page, e)
         return {'error': str(e)}
+    if not minted.get('darkknight'):
+        return {'error': 'no x-zai-darkknight header captured yet'}
+    expires_in = DK_TTL - minted['ageMs'] / 1000
+    if expires_in <= 0:
+        return {'error': 'captured x-zai-darkknight header has expired'}
+    return {
+        'darkknight': minted['darkknight'],
+        'user_agent': minted['userAgent'],
+        'cookies': {c['name']: c['value'] for c in cookies},
+        'expires_in': expires_in
+    }
+
+async def _read_json():
+    # app.py gzips large message histories
+    body = await request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return json.loads(body)
 
 @app.route('/init', methods=['POST'])
-def init_route():
-    req_id = str(uuid.uuid4())
-    q = queue.Queue()
-    response_queues[req_id] = q
-    request_queue.put((req_id, 'init', request.json))
+async def init_route():
+    return jsonify(_handle_init(await _read_json()))
+
+@app.route('/proxy', methods=['POST'])
+async def proxy_route():
+    data = await _read_json()
+    logger.info(f"Received proxy request from app.py: {data.get('url')}")
+    deadline = _caller_deadline()
     try:
-        result = q.get(timeout=30)
-        del response_queues[req_id]
-        return jsonify(result)
-    except:
+        async with admission.slot(deadline):
+            result = await asyncio.wait_for(_handle_proxy(data), timeout=max(deadline - time.monotonic(), 0))
+    except Overloaded as e:
+        return _overloaded_response(e)
+    except asyncio.TimeoutError:
         return jsonify({'error': 'timeout'}), 504
+    return jsonify(result)
 
-@app.route('/proxy', methods=['POST'])
-def proxy_route():
-    logger.info(f"Received proxy request from app.py: {request.json.get('url')}")
+@app.route('/proxy/cancel', methods=['POST'])
+async def proxy_cancel_route():
+    data = await _read_json()
+    page = _cached_page(_page_key(data))
+    if not page: return jsonify({'cancelled': False})
+    return jsonify({'cancelled': await _abort_fetch(page, data.get('request_id'))})
+
+@app.route('/proxy/stream', methods=['POST'])
+async def proxy_stream_route():
+    data = await _read_json()
+    logger.info(f"Received stream proxy request from app.py: {data.get('url')}")
+    deadline = _caller_deadline()
+    try:
+        await admission.acquire(deadline)
+    except Overloaded as e:
+        return _overloaded_response(e)
     req_id = str(uuid.uuid4())
-    q = queue.Queue()
-    response_queues[req_id] = q
-    request_queue.put((req_id, 'proxy', request.json))
+    q = asyncio.Queue()
+    task = None
+    try:
+        stream_queues[req_id] = q
+        task = asyncio.create_task(_handle_proxy_stream(req_id, data))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        # The admission slot is held until the page stops reading from upstream
+        started = time.monotonic()
+        task.add_done_callback(lambda t: admission.release(time.monotonic() - started))
+
+        # The first event is either the upstream status or an error
+        try:
+            kind, value = await asyncio.wait_for(q.get(), timeout=max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            stream_queues.pop(req_id, None)
+            task.cancel()
+            return jsonify({'error': 'timeout'}), 504
+        if kind != 'status':
+            stream_queues.pop(req_id, None)
+            return jsonify({'error': value or 'stream closed before response'}), 502
+        upstream_status = value
+
+        async def relay():
+            try:
+                while True:
+                    try:
+                        kind, value = await asyncio.wait_for(q.get(), timeout=REQUEST_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        logger.warning(f"Stream {req_id} stalled, closing")
+                        break
+                    if kind != 'chunk':
+                        break
+                    yield value.encode()
+            finally:
+                # Once the queue is gone the page stops reading from upstream;
+                # cancelling the task also aborts a fetch stuck waiting on it
+                stream_queues.pop(req_id, None)
+                task.cancel()
+
+        response = Response(relay(), mimetype='text/event-stream', headers={'X-Upstream-Status': str(upstream_status), 'Cache-Control': 'no-cache'})
+        response.timeout = None
+        return response
+    except BaseException:
+        # Caller went away (CancelledError) or the handler failed: without its
+        # queue the page stops reading the completion
+        stream_queues.pop(req_id, None)
+        if task is not None: task.cancel()
+        raise
+
+@app.route('/credentials', methods=['POST'])
+async def credentials_route():
     try:
-        result = q.get(timeout=120) 
-        del response_queues[req_id]
-        return jsonify(result)
-    except:
+        result = await asyncio.wait_for(_handle_credentials(await _read_json()), timeout=REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
         return jsonify({'error': 'timeout'}), 504
+    return jsonify(result)
+
+@app.route('/warm', methods=['POST'])
+async def warm_route():
+    # Takes the full set of tokens to keep warm. Up to MAX_PAGES of them are
+    # accepted; their missing pages are opened and changed cookies pushed in
+    # the background. The reply lists the accepted keys and those already
+    # open, so app.py resends until every accepted token has a page.
+    items = [item for item in (await _read_json()).get('tokens') or [] if _page_key(item)][:MAX_PAGES]
+    worker_state["pinned"] = {_page_key(item) for item in items}
+    warming = 0
+    for item in items:
+        key = _page_key(item)
+        req_cookies = item.get('cookies') or worker_state["cookies"]
+        entry = worker_state["pages"].get(key)
+        if not req_cookies or key in worker_state["warming"]: continue
+        if entry and entry['cookies'] == req_cookies and not entry['page'].is_closed(): continue
+        worker_state["warming"].add(key)
+        task = asyncio.create_task(_warm_page(key, req_cookies))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        warming += 1
+    return jsonify({'warming': warming, 'accepted': [_page_key(item) for item in items], 'open': [key for key in worker_state["pinned"] if key in worker_state["pages"]]})
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_route():
+    cdp = dict(worker_state["cdp_stats"], connected=worker_state["browser"] is not None and worker_state["browser"].is_connected())
+    return jsonify({'admission': admission.stats(), 'pages': await _page_metrics(), 'cdp': cdp})
 
 if __name__ == '__main__':
-    t = threading.Thread(target=browser_worker, daemon=True)
-    t.start()
-    app.run(host='0.0.0.0', port=PORT, threaded=True, use_reloader=False)
\ No newline at end of file
+    config = Config()
+    config.bind = [f"0.0.0.0:{PORT}"]
+    # Keep pooled connections from app.py open between bursts
+    config.keep_alive_timeout = 75
+    asyncio.run(serve(app, config))
@@ -0,0 +1,99 @@
+import gzip
+import json
+import logging
+import os
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+class BrowserBusy(Exception):
+    """browser_server turned the request away (429); it can take it again in retry_after seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"browser service overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class BrowserServiceClient:
+    """Pooled keep-alive HTTP client for the app.py -> browser_server hop."""
+
+    def __init__(self, pool_size=64, connect_timeout=3.0, read_timeout=120.0, gzip_min_bytes=65536):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # 0 disables request compression
+        self.gzip_min_bytes = gzip_min_bytes
+
+        self.session = requests.Session()
+        # BYPASS PROXY for localhost communication
+        self.session.trust_env = False
+        # Callers beyond pool_size wait for a pooled socket instead of opening
+        # (and then discarding) an extra one
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self._lock = Lock()
+        self._stats = {'requests': 0, 'errors': 0, 'busy': 0, 'gzip_requests': 0, 'bytes_raw': 0, 'bytes_sent': 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            # One socket per gateway worker thread unless set
+            pool_size=int(os.environ.get('BROWSER_POOL_SIZE', os.environ.get('APP_THREADS', 64))),
+            connect_timeout=float(os.environ.get('BROWSER_CONNECT_TIMEOUT', 3)),
+            read_timeout=float(os.environ.get('BROWSER_READ_TIMEOUT', 120)),
+            gzip_min_bytes=int(os.environ.get('BROWSER_GZIP_MIN_BYTES', 65536)),
+        )
+
+    def _encode(self, body):
+        data = json.dumps(body, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        # Lets browser_server drop the request if it cannot start before we give up
+        headers = {'Content-Type': 'application/json', 'X-Request-Timeout': str(self.read_timeout)}
+        raw_size = len(data)
+        if self.gzip_min_bytes and raw_size >= self.gzip_min_bytes:
+            data = gzip.compress(data, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+        return data, headers, raw_size
+
+    def post(self, url, body, stream=False):
+        data, headers, raw_size = self._encode(body)
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['bytes_raw'] += raw_size
+            self._stats['bytes_sent'] += len(data)
+            if 'Content-Encoding' in headers: self._stats['gzip_requests'] += 1
+        try:
+            resp = self.session.post(url, data=data, headers=headers, stream=stream, timeout=(self.connect_timeout, self.read_timeout))
+        except Exception:
+            with self._lock: self._stats['errors'] += 1
+            raise
+        if resp.status_code == 429:
+            resp.close()
+            with self._lock: self._stats['busy'] += 1
+            try:
+                retry_after = max(int(resp.headers.get('Retry-After', 1)), 1)
+            except ValueError:
+                retry_after = 1
+            raise BrowserBusy(retry_after)
+        return resp
+
+    def stats(self):
+        # urllib3 counts every new socket per host pool; the rest were reused
+        new_connections = 0
+        pool_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None: continue
+            new_connections += pool.num_connections
+            pool_requests += pool.num_requests
+        with self._lock:
+            result = dict(self._stats)
+        result['new_connections'] = new_connections
+        result['reused_connections'] = max(pool_requests - new_connections, 0)
+        result['reuse_ratio'] = round(result['reused_connections'] / pool_requests, 4) if pool_requests else 0.0
+        result['pool_size'] = self.pool_size
+        return result
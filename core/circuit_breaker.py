@@ -0,0 +1,66 @@
+import os
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+# (consecutive failures, times opened in a row, open until, probe started), epoch seconds
+CLOSED_STATE = (0, 0, 0.0, 0.0)
+
+class CircuitBreaker:
+    """Per-token breaker transitions; the state tuples live on token records or in shared state.
+
+    closed: requests flow; threshold consecutive failures open the circuit.
+    open: the token is skipped until its cooldown ends. Cooldowns double
+    each time the circuit reopens, up to max_cooldown.
+    half_open: one probe request is let through. Success closes the
+    circuit, failure reopens it. A probe that never reports back is
+    given up on after probe_timeout.
+    """
+
+    def __init__(self, base_cooldown=30.0, max_cooldown=1800.0, probe_timeout=300.0):
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_timeout = probe_timeout
+
+    def cooldown(self, opens):
+        return min(self.base_cooldown * 2 ** max(opens - 1, 0), self.max_cooldown)
+
+    def state(self, breaker, now):
+        open_until = breaker[2]
+        if not open_until: return CLOSED
+        return OPEN if now < open_until else HALF_OPEN
+
+    def _probing(self, breaker, now):
+        return bool(breaker[3]) and now - breaker[3] < self.probe_timeout
+
+    def selectable(self, breaker, now):
+        state = self.state(breaker, now)
+        return state == CLOSED or (state == HALF_OPEN and not self._probing(breaker, now))
+
+    def on_failure(self, breaker, now, threshold):
+        failures, opens, open_until, probe = breaker
+        if open_until:
+            # A late failure from a request that started before the circuit opened
+            if now < open_until: return breaker
+            # The probe failed
+            return (0, opens + 1, now + self.cooldown(opens + 1), 0.0)
+        failures += 1
+        if failures >= max(threshold or 1, 1):
+            return (0, 1, now + self.cooldown(1), 0.0)
+        return (failures, 0, 0.0, 0.0)
+
+    def on_success(self, breaker, now):
+        return CLOSED_STATE
+
+    def start_probe(self, breaker, now):
+        """New state with the probe claimed, or None if this token cannot take a probe now."""
+        if self.state(breaker, now) != HALF_OPEN or self._probing(breaker, now): return None
+        return breaker[:3] + (now,)
+
+    def end_probe(self, breaker, now):
+        return breaker[:3] + (0.0,)
+
+def breaker_from_env():
+    return CircuitBreaker(
+        base_cooldown=float(os.environ.get('BREAKER_BASE_COOLDOWN', 30)),
+        max_cooldown=float(os.environ.get('BREAKER_MAX_COOLDOWN', 1800)),
+    )
@@ -0,0 +1,148 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from core.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Statuses that mean zai.is no longer accepts the header or session
+REJECTED_STATUSES = (401, 403, 428)
+
+class DirectTransport:
+    """Sends zai.is API calls straight from the gateway, keeping Chrome off the hot path.
+
+    browser_server mints the credentials: the x-zai-darkknight header its
+    page captured, the page's cookies and user agent, valid for
+    expires_in seconds. They are cached per token and replayed through a
+    pool of TLS-fingerprinted tls_client sessions. request() returns None
+    whenever the browser path should be used instead: credentials could
+    not be minted, the request failed, or zai.is rejected them (which also
+    drops them, so the next call mints fresh ones).
+    """
+
+    def __init__(self, client, url, enabled=False, pool_size=64, tls_profile='chrome_120', timeout=120.0, margin=10.0, slot_timeout=2.0, session_factory=None):
+        self.client = client
+        self.url = url
+        self.enabled = enabled
+        self.tls_profile = tls_profile
+        self.timeout = timeout
+        # Credentials this close to expiry are minted again before use
+        self.margin = margin
+        self._session_factory = session_factory or self._new_session
+        self._sessions = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        # A request that finds every session busy for this long takes the browser path
+        self.slot_timeout = slot_timeout
+        self._lock = threading.Lock()
+        # token_id -> (expires_at, credentials)
+        self._credentials = {}
+        # A token whose page cannot mint a header is not asked again for a few seconds
+        self._mint_flight = SingleFlight(success_ttl=0, failure_ttl=5.0)
+        self._stats = {'requests': 0, 'fallbacks': 0, 'rejected': 0, 'errors': 0, 'mints': 0, 'pool_full': 0}
+
+    def _new_session(self):
+        import tls_client
+        return tls_client.Session(client_identifier=self.tls_profile, random_tls_extension_order=True)
+
+    def _count(self, name):
+        with self._lock: self._stats[name] += 1
+
+    def _mint(self, token_obj):
+        resp = self.client.post(self.url, {'token': token_obj.zai_token, 'token_id': token_obj.id, 'cookies': token_obj.cookies})
+        data = resp.json() if resp.status_code == 200 else {'error': f"HTTP {resp.status_code}"}
+        if 'error' in data: return False, data['error']
+        # A header that would be minted again before its first use is no header at all
+        if data['expires_in'] <= self.margin: return False, f"header expires in {data['expires_in']:.0f}s"
+        self._count('mints')
+        data['token'] = token_obj.zai_token
+        with self._lock:
+            self._credentials[token_obj.id] = (time.monotonic() + data['expires_in'], data)
+        return True, data
+
+    def credentials(self, token_obj):
+        with self._lock:
+            cached = self._credentials.get(token_obj.id)
+        # A re-login changes the JWT and cookies, so credentials minted before it are stale
+        if cached and cached[0] - self.margin > time.monotonic() and cached[1]['token'] == token_obj.zai_token:
+            return cached[1]
+        ok, result = self._mint_flight.do(token_obj.id, lambda: self._mint(token_obj))
+        if not ok:
+            logger.warning(f"No direct credentials for token {token_obj.id}: {result}")
+            return None
+        return result
+
+    def invalidate(self, token_id):
+        with self._lock: self._credentials.pop(token_id, None)
+
+    def _fallback(self):
+        self._count('fallbacks')
+        return None
+
+    def request(self, token_obj, url, method, payload):
+        """{status, body} like browser_server's /proxy, or None to fall back to the browser."""
+        self._count('requests')
+        creds = self.credentials(token_obj)
+        if creds is None: return self._fallback()
+
+        headers = {
+            'Authorization': f"Bearer {token_obj.zai_token}",
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'x-zai-darkknight': creds['darkknight'],
+            'User-Agent': creds['user_agent'],
+            'Origin': 'https://zai.is',
+            'Referer': 'https://zai.is/chat'
+        }
+        if not self._slots.acquire(timeout=self.slot_timeout):
+            self._count('pool_full')
+            return self._fallback()
+        try:
+            try:
+                session = self._sessions.get_nowait()
+            except queue.Empty:
+                session = self._session_factory()
+            try:
+                # Sessions are shared across tokens, so none may keep cookies from the last one
+                session.cookies.clear()
+                resp = session.execute_request(method, url, headers=headers, cookies=creds['cookies'], json=payload if payload and method != 'GET' else None, timeout_seconds=self.timeout)
+            except Exception as e:
+                logger.warning(f"Direct request for token {token_obj.id} failed: {e}")
+                self._count('errors')
+                return self._fallback()
+            finally:
+                self._sessions.put(session)
+        finally:
+            self._slots.release()
+
+        if resp.status_code in REJECTED_STATUSES:
+            logger.warning(f"zai.is rejected direct credentials for token {token_obj.id} ({resp.status_code})")
+            self.invalidate(token_obj.id)
+            self._count('rejected')
+            return self._fallback()
+        try:
+            body = resp.json()
+        except ValueError:
+            body = resp.text
+        return {'status': resp.status_code, 'body': body}
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['cached_credentials'] = len(self._credentials)
+        result['enabled'] = self.enabled
+        result['direct_ratio'] = round(1 - result['fallbacks'] / result['requests'], 4) if result['requests'] else 0.0
+        return result
+
+def transport_from_env(client, url):
+    return DirectTransport(
+        client, url,
+        enabled=os.environ.get('ZAI_TRANSPORT', 'browser') == 'direct',
+        # One session per gateway worker thread unless set
+        pool_size=int(os.environ.get('DIRECT_POOL_SIZE', os.environ.get('APP_THREADS', 64))),
+        tls_profile=os.environ.get('DIRECT_TLS_PROFILE', 'chrome_120'),
+        timeout=float(os.environ.get('BROWSER_READ_TIMEOUT', 120)),
+        slot_timeout=float(os.environ.get('DIRECT_SLOT_TIMEOUT', 2)),
+    )
@@ -0,0 +1,73 @@
+import os
+import threading
+from collections import deque
+
+class HedgePolicy:
+    """Decides when a slow request gets a duplicate on a second token.
+
+    The hedge deadline is the given percentile of recent successful
+    latencies, clamped to [min_delay, max_delay]; until min_samples are
+    known max_delay is used. Each request earns `budget` hedge credits
+    and a hedge spends one, so hedges stay under that fraction of traffic
+    even when upstream is uniformly slow.
+    """
+
+    def __init__(self, enabled=False, percentile=95.0, min_delay=2.0, max_delay=60.0, budget=0.05, min_samples=20, window=500):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        # Start with one hedge available; cap how many can be saved up for a burst
+        self._credits = 1.0 if budget > 0 else 0.0
+        self._max_credits = max(1.0, budget * 100)
+        self._stats = {'requests': 0, 'hedges': 0, 'hedge_wins': 0, 'budget_denied': 0}
+
+    def observe(self, duration):
+        with self._lock: self._latencies.append(duration)
+
+    def delay(self):
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.min_samples: return self.max_delay
+        index = min(int(len(samples) * self.percentile / 100), len(samples) - 1)
+        return min(max(samples[index], self.min_delay), self.max_delay)
+
+    def record_request(self):
+        with self._lock:
+            self._stats['requests'] += 1
+            self._credits = min(self._credits + self.budget, self._max_credits)
+
+    def try_hedge(self):
+        """Spend one hedge credit; False when hedging would exceed the budget."""
+        with self._lock:
+            if self._credits < 1:
+                self._stats['budget_denied'] += 1
+                return False
+            self._credits -= 1
+            self._stats['hedges'] += 1
+            return True
+
+    def record_win(self):
+        with self._lock: self._stats['hedge_wins'] += 1
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['samples'] = len(self._latencies)
+        result['enabled'] = self.enabled
+        result['delay'] = round(self.delay(), 3)
+        result['hedge_ratio'] = round(result['hedges'] / result['requests'], 4) if result['requests'] else 0.0
+        return result
+
+def policy_from_env():
+    return HedgePolicy(
+        enabled=os.environ.get('HEDGE_ENABLED', '0') == '1',
+        percentile=float(os.environ.get('HEDGE_PERCENTILE', 95)),
+        min_delay=float(os.environ.get('HEDGE_MIN_DELAY', 2)),
+        max_delay=float(os.environ.get('HEDGE_MAX_DELAY', 60)),
+        budget=float(os.environ.get('HEDGE_BUDGET', 0.05)),
+    )
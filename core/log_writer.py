@@ -0,0 +1,107 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from .extensions import db
+from .models import RequestLog
+
+logger = logging.getLogger(__name__)
+
+class RequestLogWriter:
+    """Buffers RequestLog rows in memory and bulk-inserts them from a background thread.
+
+    A batch is written once it reaches max_batch rows or flush_interval
+    seconds after its first row, whichever comes first. submit() never
+    blocks; when max_pending rows are already waiting the row is dropped
+    and counted.
+    """
+
+    def __init__(self, max_batch=200, flush_interval=1.0, max_pending=10000):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.app = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._stats = {'written': 0, 'dropped': 0, 'failed': 0, 'batches': 0}
+        self._writing = 0
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self._thread = threading.Thread(target=self._run, daemon=True, name='request-log-writer')
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, **fields):
+        fields.setdefault('created_at', datetime.now())
+        try:
+            self._queue.put_nowait(fields)
+        except queue.Full:
+            with self._lock: self._stats['dropped'] += 1
+
+    def flush(self, timeout=10):
+        """Block until every row submitted before this call has been written."""
+        if not self._thread or not self._thread.is_alive(): return False
+        marker = threading.Event()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.wait(timeout)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['pending'] = self._queue.qsize() + self._writing
+        return result
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch, markers = [], []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, threading.Event):
+                    markers.append(item)
+                    break
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch or remaining <= 0: break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch: self._write(batch)
+            for marker in markers: marker.set()
+
+    def _write(self, batch):
+        with self._lock: self._writing = len(batch)
+        with self.app.app_context():
+            try:
+                db.session.execute(insert(RequestLog), batch)
+                db.session.commit()
+                with self._lock:
+                    self._stats['written'] += len(batch)
+                    self._stats['batches'] += 1
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Failed to write {len(batch)} request logs: {e}")
+                with self._lock: self._stats['failed'] += len(batch)
+            finally:
+                with self._lock: self._writing = 0
+
+log_writer = RequestLogWriter(
+    max_batch=int(os.environ.get('LOG_BATCH_SIZE', 200)),
+    flush_interval=float(os.environ.get('LOG_FLUSH_INTERVAL', 1.0)),
+    max_pending=int(os.environ.get('LOG_QUEUE_MAX', 10000)),
+)
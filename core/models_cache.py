@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ModelListCache:
+    """Stale-while-revalidate cache for the upstream model list.
+
+    A fresh value is returned as is. Once it is older than ttl the stale
+    value is still returned and a single background refresh is started.
+    Only the very first call (nothing cached yet) waits for the fetch.
+    fetch() returns the model list body, or None on failure.
+    """
+
+    def __init__(self, fetch, ttl=300.0):
+        self.fetch = fetch
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cold_lock = threading.Lock()
+        self._value = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_failures': 0}
+
+    def get(self):
+        with self._lock:
+            if self._value is not None:
+                if time.monotonic() - self._fetched_at < self.ttl:
+                    self._stats['hits'] += 1
+                    return self._value
+                self._stats['stale_hits'] += 1
+                self._start_refresh()
+                return self._value
+            self._stats['misses'] += 1
+        # Cold cache: callers queue on one fetch instead of stampeding upstream
+        with self._cold_lock:
+            with self._lock:
+                if self._value is not None: return self._value
+            return self._refresh()
+
+    def _start_refresh(self):
+        # Called with self._lock held
+        if self._refreshing: return
+        self._refreshing = True
+        threading.Thread(target=self._refresh, daemon=True, name='models-refresh').start()
+
+    def _refresh(self):
+        try:
+            value = self.fetch()
+        except Exception as e:
+            logger.error(f"Model list refresh failed: {e}")
+            value = None
+        with self._lock:
+            self._refreshing = False
+            if value is None:
+                self._stats['refresh_failures'] += 1
+                return self._value
+            self._value = value
+            self._fetched_at = time.monotonic()
+            self._stats['refreshes'] += 1
+        return value
+
+    def refresh(self):
+        """Refresh now, e.g. from a scheduled job; keeps the old value on failure."""
+        with self._lock:
+            if self._refreshing: return self._value
+            self._refreshing = True
+        return self._refresh()
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._fetched_at = 0.0
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['cached'] = self._value is not None
+            result['age'] = round(time.monotonic() - self._fetched_at, 1) if self._value is not None else None
+        return result
@@ -0,0 +1,94 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class PageWarmer:
+    """Keeps a warm browser page open for every usable token.
+
+    Registered as a token pool listener, so it sees every token at startup
+    and again after each refresh. The full set of usable tokens is posted
+    to /warm, which accepts as many as it has pages for, pins those against
+    idle eviction, opens the missing ones in the background and replies
+    with the accepted and already open pages. A change is posted after
+    `delay` seconds; while some accepted token still has no page (or the
+    post failed) the set is posted again after retry_delay, and otherwise
+    every `interval` seconds, which reopens pages lost to LRU eviction or a
+    browser restart.
+    """
+
+    def __init__(self, client, url, delay=1.0, retry_delay=10.0, interval=60.0):
+        self.client = client
+        self.url = url
+        self.delay = delay
+        self.retry_delay = retry_delay
+        self.interval = interval
+        self._lock = threading.Lock()
+        # token_id -> /warm item for every usable token
+        self._desired = {}
+        # Page keys browser_server accepted, and reported open, in its last reply
+        self._accepted = set()
+        self._open = set()
+        self._timer = None
+        self._due = None
+        self._stats = {'batches': 0, 'errors': 0}
+
+    def on_token_change(self, token_id, record):
+        with self._lock:
+            if record is None or not record.usable or not record.zai_token:
+                if self._desired.pop(token_id, None) is None: return
+            else:
+                item = {'token_id': token_id, 'token': record.zai_token, 'cookies': record.cookies}
+                # An unrelated update (e.g. an error count) leaves the page as it is
+                if self._desired.get(token_id) == item: return
+                self._desired[token_id] = item
+            self._schedule(self.delay)
+
+    def _schedule(self, delay):
+        # Called with self._lock held; an earlier due time replaces a later one
+        due = time.monotonic() + delay
+        if self._timer is not None:
+            if self._due <= due: return
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._due = due
+        self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None: self._timer.cancel()
+            self._timer = self._due = None
+            batch = list(self._desired.values())
+        try:
+            resp = self.client.post(self.url, {'tokens': batch})
+            try:
+                if resp.status_code != 200: raise Exception(f"HTTP {resp.status_code}")
+                reply = resp.json()
+                accepted, opened = set(reply.get('accepted') or []), set(reply.get('open') or [])
+            finally:
+                resp.close()
+        except Exception as e:
+            logger.warning(f"Pre-warming {len(batch)} browser pages failed: {e}")
+            with self._lock:
+                self._stats['errors'] += 1
+                self._schedule(self.retry_delay)
+            return
+        with self._lock:
+            self._stats['batches'] += 1
+            self._accepted, self._open = accepted, opened
+            # A token counts as warm only once browser_server reports its page
+            # open; tokens beyond its page limit are not waited for
+            missing = accepted - opened
+            if missing: self._schedule(self.retry_delay)
+            elif self._desired: self._schedule(self.interval)
+        if missing: logger.info(f"Waiting for the browser service to open {len(missing)} of {len(accepted)} warm pages")
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['tokens'] = len(self._desired)
+            result['accepted'] = sum(1 for token_id in self._desired if f"id:{token_id}" in self._accepted)
+            result['open'] = sum(1 for token_id in self._desired if f"id:{token_id}" in self._open)
+        return result
@@ -0,0 +1,146 @@
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ExpiryScheduler:
+    """Refreshes each token shortly before its at_expires, driven by a priority queue.
+
+    A token is due lead_time seconds before it expires, minus a random
+    jitter so tokens that were refreshed together drift apart. Due tokens
+    are handed to refresh(token_ids) in batches. If a refresh does not move
+    at_expires forward the token is retried with exponential backoff.
+    poll() runs at least every poll_interval seconds so changes made by
+    other processes are picked up. While enabled() is false due tokens
+    stay queued untouched and are refreshed once it turns true again.
+    """
+
+    def __init__(self, refresh, lead_time=600.0, jitter=300.0, retry_delay=60.0, max_retry_delay=900.0, poll=None, poll_interval=30.0, enabled=None):
+        self.refresh = refresh
+        self.lead_time = lead_time
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.enabled = enabled
+        self._cond = threading.Condition()
+        self._heap = []
+        # token_id -> (due, expires_at) of its live heap entry
+        self._entries = {}
+        # token_id -> (retry not before, next backoff) after an attempt
+        self._retries = {}
+        self._random = random.Random()
+        self._thread = None
+
+    def start(self):
+        if self._thread: return
+        self._thread = threading.Thread(target=self._run, daemon=True, name='token-expiry-scheduler')
+        self._thread.start()
+
+    def track(self, token_id, expires_at, active=True):
+        """(Re)schedule a token from its at_expires epoch seconds; untracks inactive tokens."""
+        with self._cond:
+            if not active or expires_at is None:
+                self._entries.pop(token_id, None)
+                self._retries.pop(token_id, None)
+                return
+            current = self._entries.get(token_id)
+            if current and current[1] == expires_at: return
+            if current and expires_at > current[1]:
+                # Refreshed successfully
+                self._retries.pop(token_id, None)
+            due = expires_at - self.lead_time - self._random.uniform(0, self.jitter)
+            retry = self._retries.get(token_id)
+            if retry: due = max(due, retry[0])
+            self._entries[token_id] = (due, expires_at)
+            heapq.heappush(self._heap, (due, token_id))
+            self._cond.notify()
+
+    def untrack(self, token_id):
+        self.track(token_id, None, active=False)
+
+    def scheduled(self, token_id):
+        """(due, expires_at) of a tracked token, or None."""
+        with self._cond: return self._entries.get(token_id)
+
+    def wake(self):
+        """Re-check due tokens now, e.g. after refreshing was switched back on."""
+        with self._cond: self._cond.notify()
+
+    def _enabled(self):
+        if self.enabled is None: return True
+        try:
+            return bool(self.enabled())
+        except Exception as e:
+            logger.error(f"Token auto-refresh setting could not be read: {e}")
+            return False
+
+    def next_due(self):
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0] if self._heap else None
+
+    def _drop_stale(self):
+        while self._heap:
+            due, token_id = self._heap[0]
+            entry = self._entries.get(token_id)
+            if entry and entry[0] == due: return
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now):
+        batch = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, token_id = heapq.heappop(self._heap)
+            expires_at = self._entries.pop(token_id)[1]
+            backoff = self._retries.get(token_id, (0, self.retry_delay))[1]
+            self._retries[token_id] = (now + backoff, min(backoff * 2, self.max_retry_delay))
+            # Keep it queued for the retry; a successful refresh moves it forward
+            retry_due = now + backoff
+            self._entries[token_id] = (retry_due, expires_at)
+            heapq.heappush(self._heap, (retry_due, token_id))
+            batch.append(token_id)
+            self._drop_stale()
+        return batch
+
+    def run_due(self, now=None):
+        """Refresh every token that is due now; returns their ids."""
+        if not self._enabled(): return []
+        with self._cond:
+            batch = self._pop_due(time.time() if now is None else now)
+        if batch:
+            logger.info(f"Refreshing {len(batch)} tokens ahead of expiry")
+            try:
+                self.refresh(batch)
+            except Exception as e:
+                logger.error(f"Scheduled token refresh failed: {e}")
+        return batch
+
+    def _run(self):
+        last_poll = 0.0
+        while True:
+            if self.poll and time.monotonic() - last_poll >= self.poll_interval:
+                last_poll = time.monotonic()
+                try: self.poll()
+                except Exception as e: logger.error(f"Token expiry poll failed: {e}")
+            enabled = self._enabled()
+            with self._cond:
+                self._drop_stale()
+                wait = self.poll_interval
+                if self._heap and enabled: wait = min(wait, max(self._heap[0][0] - time.time(), 0))
+                if wait > 0: self._cond.wait(wait)
+            self.run_due()
+
+def scheduler_from_env(refresh, poll=None, enabled=None):
+    return ExpiryScheduler(
+        refresh,
+        lead_time=float(os.environ.get('REFRESH_LEAD_TIME', 600)),
+        jitter=float(os.environ.get('REFRESH_LEAD_JITTER', 300)),
+        poll=poll,
+        enabled=enabled,
+    )
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Request fields that do not change the completion itself
+_IGNORED_FIELDS = ('stream', 'stream_options', 'user')
+
+def cache_key(payload):
+    """Canonical hash of a chat completion request: model, messages and sampling params."""
+    canonical = {k: v for k, v in payload.items() if k not in _IGNORED_FIELDS}
+    data = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Bounded in-memory LRU with an optional on-disk tier, both with per-entry TTL."""
+
+    def __init__(self, max_entries=512, disk_dir=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        if disk_dir: os.makedirs(disk_dir, exist_ok=True)
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, body = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return body
+                del self._entries[key]
+                self._stats['expired'] += 1
+
+        body = self._disk_get(key, now) if self.disk_dir else None
+        with self._lock:
+            if body is None:
+                self._stats['misses'] += 1
+            else:
+                self._stats['hits'] += 1
+                self._stats['disk_hits'] += 1
+        return body
+
+    def _disk_get(self, key, now):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unreadable response cache file {path}: {e}")
+            return None
+        if entry.get('expires_at', 0) <= now:
+            try: os.remove(path)
+            except OSError: pass
+            with self._lock: self._stats['expired'] += 1
+            return None
+        # Promote to memory for the rest of its lifetime
+        self._memory_put(key, entry['expires_at'], entry['body'])
+        return entry['body']
+
+    def _memory_put(self, key, expires_at, body):
+        with self._lock:
+            self._entries[key] = (expires_at, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def put(self, key, body, ttl):
+        if not ttl or ttl <= 0: return
+        expires_at = time.time() + ttl
+        self._memory_put(key, expires_at, body)
+        with self._lock: self._stats['stores'] += 1
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump({'expires_at': expires_at, 'body': body}, f, ensure_ascii=False)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.warning(f"Failed to write response cache file {path}: {e}")
+
+    def clear(self):
+        with self._lock: self._entries.clear()
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.json'):
+                    try: os.remove(os.path.join(self.disk_dir, name))
+                    except OSError: pass
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['entries'] = len(self._entries)
+        lookups = result['hits'] + result['misses']
+        result['hit_ratio'] = round(result['hits'] / lookups, 4) if lookups else 0.0
+        return result
+
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 512)),
+    disk_dir=os.environ.get('RESPONSE_CACHE_DIR') or None,
+)
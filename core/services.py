@@ -1,19 +1,53 @@
 import logging
+import os
 import time
 import json
 from datetime import datetime, timedelta
+from threading import Lock
+from types import SimpleNamespace
 from .extensions import db
 from .models import SystemConfig, Token, RequestLog
 from .zai_token import DiscordOAuthHandler
+from .token_pool import token_pool
+from .shared_state import shared_state
+from .token_refresher import token_refresher
+from .single_flight import SingleFlight
 import jwt # pyjwt
 from flask import current_app
 
 logger = logging.getLogger(__name__)
 
-def get_zai_handler():
+_config_lock = Lock()
+_config_cache = {'config': None, 'version': None}
+
+def get_config():
+    """Read-only snapshot of SystemConfig, cached until invalidate_config() is called in any gateway process."""
+    version = shared_state.version('config')
+    config = _config_cache['config']
+    if config is not None and _config_cache['version'] == version:
+        return config
+    with _config_lock:
+        config = _config_cache['config']
+        if config is None or _config_cache['version'] != version:
+            row = SystemConfig.query.first()
+            if row is None:
+                return None
+            config = SimpleNamespace(**{c.name: getattr(row, c.name) for c in SystemConfig.__table__.columns})
+            _config_cache['config'] = config
+            _config_cache['version'] = version
+    return config
+
+def invalidate_config():
+    # Must be called after every commit that changes SystemConfig
+    _config_cache['config'] = None
+    shared_state.bump('config')
+
+def get_zai_handler(rate_limited=False):
     # Assume we are in app context so we can query SystemConfig
-    config = SystemConfig.query.first()
+    config = get_config()
     handler = DiscordOAuthHandler()
+    # Bulk refreshes share per-host request budgets
+    if rate_limited: token_refresher.mount(handler.session)
     if config and config.proxy_enabled and config.proxy_url:
         handler.session.proxies = {
             'http': config.proxy_url,
@@ -21,13 +55,50 @@ def get_zai_handler():
         }
     return handler
 
-def update_token_info(token_id, use_oauth=False):
+# One backend login per token at a time, shared by every caller that needs it
+reauth_flight = SingleFlight(success_ttl=float(os.environ.get('REAUTH_SUCCESS_TTL', 5)), failure_ttl=float(os.environ.get('REAUTH_FAILURE_TTL', 30)))
+
+# With several gateway processes, how long the others wait on one process's login before taking it over
+REAUTH_LEASE_TTL = float(os.environ.get('REAUTH_LEASE_TTL', 120))
+
+def update_token_info(token_id, use_oauth=False, rate_limited=False, force=False):
+    """Re-login a token. Concurrent calls for one token share a single login; force skips the recent-result cache."""
     # Caller must ensure app context
+    if use_oauth: return _update_token_info(token_id, use_oauth=True)
+    return reauth_flight.do(token_id, lambda: _relogin_once(token_id, rate_limited), use_cache=not force)
+
+def _relogin_once(token_id, rate_limited=False):
+    # reauth_flight only covers this process; through the shared state the
+    # other gateway processes wait for this login instead of running their own
+    if not shared_state.shared: return _update_token_info(token_id, rate_limited=rate_limited)
+    name = f"reauth:{token_id}"
+    started = time.time()
+    while not shared_state.take_lease(name, REAUTH_LEASE_TTL, since=started):
+        result = shared_state.lease_result(name, started)
+        if result is not None:
+            _reload_token(token_id)
+            return result
+        time.sleep(0.2)
+    result = (False, 'Login did not finish')
+    try:
+        result = _update_token_info(token_id, rate_limited=rate_limited)
+    finally:
+        shared_state.finish_lease(name, result)
+    return result
+
+def _reload_token(token_id):
+    # Another process logged the token in; this process's record still holds the old JWT
+    token = db.session.get(Token, token_id)
+    if not token: return
+    db.session.refresh(token)
+    token_pool.upsert(token)
+
+def _update_token_info(token_id, use_oauth=False, rate_limited=False):
     token = db.session.get(Token, token_id)
     if not token:
         return False, "Token not found"
 
-    handler = get_zai_handler()
+    handler = get_zai_handler(rate_limited)
     
     # 如果使用 OAuth 登录
     if use_oauth:
@@ -43,6 +114,7 @@ def update_token_info(token_id, use_oauth=False):
         token.error_count += 1
         token.remark = f"Refresh failed: {result['error']}"
         db.session.commit()
+        token_pool.upsert(token)
         return False, result['error']
 
     # Save cookies
@@ -59,10 +131,11 @@ def update_token_info(token_id, use_oauth=False):
          token.zai_token = "SESSION_AUTH_COOKIE"
          token.remark = f"Updated via {source} (Session Auth)"
          # For SESSION_AUTH, set expiry based on system config
-         config = SystemConfig.query.first()
+         config = get_config()
          refresh_interval = config.token_refresh_interval if config else 3600
          token.at_expires = datetime.now() + timedelta(seconds=refresh_interval)
          db.session.commit()
+         token_pool.upsert(token)
          return True, f"Session Auth Active ({source})"
     
     token.zai_token = at
@@ -70,7 +143,7 @@ def update_token_info(token_id, use_oauth=False):
     token.remark = f"Updated via {source}"
     
     # Get system config for fallback expiry
-    config = SystemConfig.query.first()
+    config = get_config()
     refresh_interval = config.token_refresh_interval if config else 3600
     now = datetime.now()
     desired_exp = now + timedelta(seconds=refresh_interval)
@@ -90,6 +163,7 @@ def update_token_info(token_id, use_oauth=False):
     token.at_expires = min(jwt_exp_dt, desired_exp) if jwt_exp_dt else desired_exp
     
     db.session.commit()
+    token_pool.upsert(token)
     return True, f"Success ({source})"
 
 def create_or_update_token_from_oauth():
@@ -152,13 +226,14 @@ def create_or_update_token_from_oauth():
     token.remark = f"Updated via OAuth login ({source})"
     
     # 设置过期时间（与配置刷新间隔对齐）
-    config = SystemConfig.query.first()
+    config = get_config()
     refresh_interval = config.token_refresh_interval if config else 3600
     now = datetime.now()
     desired_exp = now + timedelta(seconds=refresh_interval)
     token.at_expires = min(at_expires, desired_exp) if at_expires else desired_exp
     
     db.session.commit()
+    token_pool.upsert(token)
     
     return {
         'success': True,
@@ -168,15 +243,12 @@ def create_or_update_token_from_oauth():
         'expires': token.at_expires.isoformat() if token.at_expires else None
     }
 
-def refresh_all_tokens(force=False):
+def refresh_all_tokens(force=False, background=False):
+    """Refresh active tokens in parallel; returns the run's progress/summary dict."""
     # Caller must ensure app context
+    soon = datetime.now() + timedelta(minutes=10)
     tokens = Token.query.filter_by(is_active=True).all()
-    for token in tokens:
-        if not force and token.at_expires and token.at_expires > datetime.now() + timedelta(minutes=10):
-            continue
-        
-        try:
-            success, msg = update_token_info(token.id)
-            logger.info(f"Refreshed token {token.id}: {msg}")
-        except Exception as e:
-            logger.error(f"Error refreshing token {token.id}: {e}")
+    token_ids = [t.id for t in tokens if force or not t.at_expires or t.at_expires <= soon]
+    app = current_app._get_current_object()
+    if background: return token_refresher.start(app, token_ids)
+    return token_refresher.run(app, token_ids)
@@ -0,0 +1,215 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class LocalState:
+    """Process-local routing state, for a single gateway process.
+
+    The token pool keeps in-flight counts and scores on its own records,
+    so only the round-robin cursor and change versions live here.
+    """
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def next_index(self, name, n, advance=True):
+        with self._lock:
+            value = self._counters.get(name, 0)
+            if advance: self._counters[name] = value + 1
+        return value % n
+
+    def version(self, name):
+        return self._counters.get(f"version:{name}", 0)
+
+    def bump(self, name):
+        with self._lock:
+            value = self._counters[f"version:{name}"] = self._counters.get(f"version:{name}", 0) + 1
+        return value
+
+def _pid_alive(pid):
+    if os.name != 'posix': return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class SqliteState:
+    """Routing state shared by every gateway process on a host through one SQLite file.
+
+    Holds the round-robin cursor, per-process in-flight counts (summed on
+    read, so a crashed process's requests can be purged by pid), token
+    latency/error scores, circuit breaker states, change versions that
+    tell other processes to reload their token pool or config, and named
+    leases that let one process do some work while the others wait for
+    its result.
+    """
+    shared = True
+    PURGE_INTERVAL = 30.0
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._last_purge = 0.0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS inflight (token_id INTEGER NOT NULL, kind TEXT NOT NULL, pid INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (token_id, kind, pid))")
+        conn.execute("CREATE TABLE IF NOT EXISTS health (token_id INTEGER PRIMARY KEY, ewma_latency REAL, ewma_error REAL NOT NULL DEFAULT 0)")
+        conn.execute("CREATE TABLE IF NOT EXISTS breaker (token_id INTEGER PRIMARY KEY, failures INTEGER NOT NULL, opens INTEGER NOT NULL, open_until REAL NOT NULL, probe_started REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, pid INTEGER NOT NULL, expires REAL NOT NULL, finished REAL, ok INTEGER, message TEXT)")
+        # A new process may reuse the pid of one that died mid-request
+        conn.execute("DELETE FROM inflight WHERE pid = ?", (os.getpid(),))
+        self.purge_dead()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def next_index(self, name, n, advance=True):
+        conn = self._conn()
+        if not advance:
+            row = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+            return (row[0] if row else 0) % n
+        row = conn.execute("INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1 RETURNING value", (name,)).fetchone()
+        return (row[0] - 1) % n
+
+    def version(self, name):
+        row = self._conn().execute("SELECT value FROM counters WHERE name = ?", (f"version:{name}",)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name):
+        return self._conn().execute("INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1 RETURNING value", (f"version:{name}",)).fetchone()[0]
+
+    def acquire(self, token_id, kind, limit):
+        """Reserve a slot unless the token already has limit requests of kind in flight on this host."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if limit is not None and limit >= 0:
+                total = conn.execute("SELECT COALESCE(SUM(count), 0) FROM inflight WHERE token_id = ? AND kind = ?", (token_id, kind)).fetchone()[0]
+                if total >= limit:
+                    conn.execute("ROLLBACK")
+                    return False
+            conn.execute("INSERT INTO inflight (token_id, kind, pid, count) VALUES (?, ?, ?, 1) ON CONFLICT(token_id, kind, pid) DO UPDATE SET count = count + 1", (token_id, kind, os.getpid()))
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release(self, token_id, kind):
+        self._conn().execute("UPDATE inflight SET count = MAX(count - 1, 0) WHERE token_id = ? AND kind = ? AND pid = ?", (token_id, kind, os.getpid()))
+
+    def observe(self, token_id, duration, ok, alpha):
+        """Fold one attempt into the shared scores and return the new (ewma_latency, ewma_error)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT ewma_latency, ewma_error FROM health WHERE token_id = ?", (token_id,)).fetchone()
+            latency, error = row if row else (None, 0.0)
+            if ok and duration is not None:
+                latency = duration if latency is None else (1 - alpha) * latency + alpha * duration
+            error = (1 - alpha) * error + alpha * (0.0 if ok else 1.0)
+            conn.execute("INSERT OR REPLACE INTO health (token_id, ewma_latency, ewma_error) VALUES (?, ?, ?)", (token_id, latency, error))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return latency, error
+
+    def update_breaker(self, token_id, transition, default):
+        """Atomically apply transition(state) to a token's breaker; None from transition leaves it unchanged."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT failures, opens, open_until, probe_started FROM breaker WHERE token_id = ?", (token_id,)).fetchone()
+            new = transition(tuple(row) if row else default)
+            if new is None:
+                conn.execute("ROLLBACK")
+                return None
+            conn.execute("INSERT OR REPLACE INTO breaker (token_id, failures, opens, open_until, probe_started) VALUES (?, ?, ?, ?, ?)", (token_id, *new))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return new
+
+    def take_lease(self, name, ttl, since=None):
+        """Take the named lease for ttl seconds unless a live process holds it unfinished; True if taken.
+
+        A lease finished at or after since is not taken either: its result,
+        from lease_result(), is what the caller was waiting for.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT pid, expires, finished FROM leases WHERE name = ?", (name,)).fetchone()
+            now = time.time()
+            held = row and row[2] is None and row[1] > now and _pid_alive(row[0])
+            if held or (row and since is not None and row[2] is not None and row[2] >= since):
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases (name, pid, expires, finished, ok, message) VALUES (?, ?, ?, NULL, NULL, NULL)", (name, os.getpid(), now + ttl))
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def finish_lease(self, name, result):
+        """Release a lease this process holds, leaving its (ok, message) result for the processes waiting on it."""
+        ok, message = result
+        self._conn().execute("UPDATE leases SET finished = ?, ok = ?, message = ? WHERE name = ? AND pid = ?", (time.time(), int(bool(ok)), str(message), name, os.getpid()))
+
+    def lease_result(self, name, since):
+        """(ok, message) left by the lease's last holder if it finished at or after since, else None."""
+        row = self._conn().execute("SELECT finished, ok, message FROM leases WHERE name = ?", (name,)).fetchone()
+        if row and row[0] is not None and row[0] >= since: return bool(row[1]), row[2]
+        return None
+
+    def snapshot(self):
+        """{token_id: ({kind: inflight}, ewma_latency, ewma_error, breaker)} across all processes; breaker may be None."""
+        if time.monotonic() - self._last_purge > self.PURGE_INTERVAL: self.purge_dead()
+        conn = self._conn()
+        result = {}
+        def entry(token_id):
+            if token_id not in result: result[token_id] = [{}, None, 0.0, None]
+            return result[token_id]
+        for token_id, latency, error in conn.execute("SELECT token_id, ewma_latency, ewma_error FROM health"):
+            entry(token_id)[1:3] = [latency, error]
+        for token_id, kind, count in conn.execute("SELECT token_id, kind, SUM(count) FROM inflight GROUP BY token_id, kind"):
+            entry(token_id)[0][kind] = count
+        for token_id, *breaker in conn.execute("SELECT token_id, failures, opens, open_until, probe_started FROM breaker"):
+            entry(token_id)[3] = tuple(breaker)
+        return result
+
+    def purge_dead(self):
+        """Drop in-flight counts held by processes that no longer exist."""
+        self._last_purge = time.monotonic()
+        conn = self._conn()
+        for (pid,) in conn.execute("SELECT DISTINCT pid FROM inflight").fetchall():
+            if not _pid_alive(pid):
+                conn.execute("DELETE FROM inflight WHERE pid = ?", (pid,))
+                logger.info(f"Purged in-flight counts of exited gateway process {pid}")
+
+def create_state(path=None):
+    return SqliteState(path) if path else LocalState()
+
+# Set SHARED_STATE_PATH when several gateway processes serve one host
+shared_state = create_state(os.environ.get('SHARED_STATE_PATH') or None)
@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class _Call:
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers wait for it and share its result.
+
+    Results are (ok, message) tuples. A finished result is also reused for
+    success_ttl seconds if it succeeded, or failure_ttl seconds if it
+    failed, so a burst of callers that arrive just after it does not start
+    the work again.
+    """
+
+    def __init__(self, success_ttl=5.0, failure_ttl=30.0):
+        self.success_ttl = success_ttl
+        self.failure_ttl = failure_ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        # key -> (expires_at, result)
+        self._recent = {}
+        self._stats = {'runs': 0, 'shared': 0, 'cached': 0}
+
+    def do(self, key, fn, use_cache=True):
+        with self._lock:
+            recent = self._recent.get(key)
+            if recent and use_cache and recent[0] > time.monotonic():
+                self._stats['cached'] += 1
+                return recent[1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._stats['runs'] += 1
+            else:
+                self._stats['shared'] += 1
+
+        if not leader:
+            call.done.wait()
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            logger.error(f"Single-flight call for {key} failed: {e}")
+            call.result = (False, str(e))
+        finally:
+            ok = bool(call.result and call.result[0])
+            ttl = self.success_ttl if ok else self.failure_ttl
+            with self._lock:
+                self._calls.pop(key, None)
+                if ttl > 0: self._recent[key] = (time.monotonic() + ttl, call.result)
+                # Keep the result cache from growing with every key ever seen
+                if len(self._recent) > 1024:
+                    now = time.monotonic()
+                    self._recent = {k: v for k, v in self._recent.items() if v[0] > now}
+            call.done.set()
+        return call.result
+
+    def forget(self, key):
+        with self._lock: self._recent.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['inflight'] = len(self._calls)
+        return result
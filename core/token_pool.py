@@ -0,0 +1,353 @@
+import json
+import logging
+import os
+import random
+import time
+from threading import Lock
+
+import jwt
+
+from .shared_state import LocalState, shared_state
+from .circuit_breaker import CLOSED, CLOSED_STATE, OPEN, HALF_OPEN, CircuitBreaker, breaker_from_env
+
+logger = logging.getLogger(__name__)
+
+_VIDEO_MARKERS = ('video', 'veo', 'sora')
+_IMAGE_MARKERS = ('image', 'imagen', 'dall-e')
+
+def jwt_expiry(token):
+    """exp claim of a JWT as epoch seconds, or None if it has none or is not a JWT."""
+    if not token: return None
+    try:
+        exp = jwt.decode(token, options={"verify_signature": False}).get('exp')
+    except jwt.PyJWTError:
+        return None
+    return float(exp) if exp else None
+
+def request_kind(model):
+    """Classify a request by model name as 'video', 'image' or 'chat'."""
+    name = str(model or '').lower()
+    if any(m in name for m in _VIDEO_MARKERS): return 'video'
+    if any(m in name for m in _IMAGE_MARKERS): return 'image'
+    return 'chat'
+
+class TokenRecord:
+    """Compact, process-local view of a Token row used on the request hot path."""
+    __slots__ = ('id', 'email', 'discord_token', 'zai_token', 'cookies', 'is_active', 'error_count',
+                 'image_enabled', 'video_enabled', 'image_concurrency', 'video_concurrency', 'inflight', 'inflight_by_kind',
+                 'ewma_latency', 'ewma_error', 'at_expires', 'jwt_expires', 'breaker')
+
+    def __init__(self, id):
+        self.id = id
+        self.email = None
+        self.discord_token = None
+        self.zai_token = None
+        self.cookies = None
+        self.is_active = False
+        self.error_count = 0
+        self.image_enabled = True
+        self.video_enabled = True
+        # -1 means unlimited
+        self.image_concurrency = -1
+        self.video_concurrency = -1
+        self.inflight = 0
+        self.inflight_by_kind = {}
+        # Exponentially weighted upstream latency (seconds) and failure rate
+        self.ewma_latency = None
+        self.ewma_error = 0.0
+        # Epoch seconds: scheduled refresh deadline and the JWT's own exp
+        self.at_expires = None
+        self.jwt_expires = None
+        # Circuit breaker state, see CircuitBreaker
+        self.breaker = CLOSED_STATE
+
+    @property
+    def usable(self):
+        return bool(self.is_active and self.zai_token and not str(self.zai_token).startswith('SESSION'))
+
+    def allows(self, kind):
+        if kind == 'image': return self.image_enabled
+        if kind == 'video': return self.video_enabled
+        return True
+
+    def limit(self, kind):
+        if kind == 'image': return self.image_concurrency
+        if kind == 'video': return self.video_concurrency
+        return -1
+
+    def has_capacity(self, kind):
+        limit = self.limit(kind)
+        return limit is None or limit < 0 or self.inflight_by_kind.get(kind, 0) < limit
+
+class TokenLease:
+    """One in-flight request on a token; release() is idempotent."""
+
+    def __init__(self, pool, record, kind):
+        self.pool = pool
+        self.record = record
+        self.kind = kind
+        self.released = False
+        # Set when a streaming response takes over releasing the lease
+        self.handed_off = False
+        # True for the single trial request of a half-open circuit
+        self.probe = False
+
+    def release(self):
+        if self.released: return
+        self.released = True
+        self.pool._release(self.record, self.kind, self.probe)
+
+class TokenPool:
+    """Registry of tokens kept in sync by the code paths that write Token rows.
+
+    Records are updated in place, so a record handed out by candidates()
+    always reflects the latest refresh or error state.
+
+    With a shared state backend the round-robin cursor, in-flight counts
+    and scores are read from and written to the backend, so every gateway
+    process on the host routes from the same numbers; records are
+    refreshed from it on each candidates() call.
+    """
+
+    def __init__(self, mode='least_loaded', ewma_alpha=0.2, state=None, breaker=None):
+        self._lock = Lock()
+        self._records = {}
+        self._usable_ids = []
+        self._random = random.Random()
+        self.state = state or LocalState()
+        self.breaker = breaker or CircuitBreaker()
+        # Called as listener(token_id, record) after a token changes, record=None once removed
+        self.listeners = []
+        # Version of the token set this process last loaded
+        self._version = None
+        # 'least_loaded' or 'latency'
+        self.mode = mode
+        self.ewma_alpha = ewma_alpha
+        self.loaded = False
+
+    def _apply(self, record, token):
+        record.email = token.email
+        record.discord_token = token.discord_token
+        if token.zai_token != record.zai_token:
+            record.jwt_expires = jwt_expiry(token.zai_token)
+        record.zai_token = token.zai_token
+        record.at_expires = token.at_expires.timestamp() if token.at_expires else None
+        try:
+            record.cookies = json.loads(token.cookies_json) if token.cookies_json else None
+        except ValueError:
+            logger.warning(f"Token {token.id} has malformed cookies_json")
+            record.cookies = None
+        record.is_active = bool(token.is_active)
+        record.error_count = int(token.error_count or 0)
+        record.image_enabled = token.image_enabled is not False
+        record.video_enabled = token.video_enabled is not False
+        record.image_concurrency = -1 if token.image_concurrency is None else int(token.image_concurrency)
+        record.video_concurrency = -1 if token.video_concurrency is None else int(token.video_concurrency)
+
+    def _reindex(self):
+        self._usable_ids = sorted(tid for tid, r in self._records.items() if r.usable)
+
+    @property
+    def stale(self):
+        """True once another process has changed tokens since load()."""
+        return self._version != self.state.version('tokens')
+
+    def _changed(self):
+        # Tell other processes to reload, without reloading this one
+        before = self._version
+        after = self.state.bump('tokens')
+        if before is not None and after == before + 1: self._version = after
+
+    def _notify(self, token_id, record):
+        for listener in self.listeners:
+            try: listener(token_id, record)
+            except Exception as e: logger.error(f"Token pool listener failed for token {token_id}: {e}")
+
+    def load(self, tokens):
+        # Read the version first so a concurrent change is never missed
+        version = self.state.version('tokens')
+        with self._lock:
+            removed = set(self._records)
+            self._records = {}
+            for token in tokens:
+                record = TokenRecord(token.id)
+                self._apply(record, token)
+                self._records[token.id] = record
+            self._reindex()
+            self.loaded = True
+            self._version = version
+            removed -= set(self._records)
+            records = list(self._records.values())
+        for token_id in removed: self._notify(token_id, None)
+        for record in records: self._notify(record.id, record)
+        logger.info(f"Token pool loaded {len(records)} tokens ({len(self._usable_ids)} usable)")
+
+    def upsert(self, token):
+        with self._lock:
+            record = self._records.get(token.id)
+            if record is None:
+                record = self._records[token.id] = TokenRecord(token.id)
+            self._apply(record, token)
+            self._reindex()
+        self._changed()
+        self._notify(record.id, record)
+        return record
+
+    def update(self, token_id, **fields):
+        with self._lock:
+            record = self._records.get(token_id)
+            if record is None: return None
+            for key, value in fields.items():
+                setattr(record, key, value)
+            if 'is_active' in fields or 'zai_token' in fields:
+                self._reindex()
+        return record
+
+    def remove(self, token_id):
+        with self._lock:
+            self._records.pop(token_id, None)
+            self._reindex()
+        self._changed()
+        self._notify(token_id, None)
+
+    def get(self, token_id):
+        return self._records.get(token_id)
+
+    def candidates(self, kind=None, rotate=True):
+        """Usable tokens with spare capacity for kind, least outstanding requests first.
+
+        Ties keep round-robin order, starting one further on each call, so
+        idle tokens still take turns. Tokens whose JWT has expired are never
+        returned, even before their refresh lands, nor are tokens whose
+        circuit is open or already has its half-open probe in flight.
+        """
+        ids = self._usable_ids
+        if not ids: return []
+        start = self.state.next_index('rr', len(ids), advance=rotate)
+        if self.state.shared: self._sync(self.state.snapshot())
+        now = time.time()
+        with self._lock:
+            ordered = [self._records[tid] for tid in ids[start:] + ids[:start] if tid in self._records]
+            ordered = [r for r in ordered if (r.jwt_expires is None or r.jwt_expires > now) and self.breaker.selectable(r.breaker, now)]
+            if kind is not None:
+                ordered = [r for r in ordered if r.allows(kind) and r.has_capacity(kind)]
+            if self.mode == 'latency':
+                return self._latency_order(ordered)
+            ordered.sort(key=lambda r: r.inflight)
+            return ordered
+
+    def expired(self):
+        """Usable tokens left out of candidates() only because their JWT has expired."""
+        now = time.time()
+        with self._lock:
+            records = [self._records[tid] for tid in self._usable_ids if tid in self._records]
+            return [r for r in records if r.jwt_expires is not None and r.jwt_expires <= now and self.breaker.selectable(r.breaker, now)]
+
+    def _sync(self, snapshot):
+        with self._lock:
+            for record in self._records.values():
+                by_kind, latency, error, breaker = snapshot.get(record.id, ({}, None, 0.0, None))
+                record.inflight_by_kind = by_kind
+                record.inflight = sum(by_kind.values())
+                record.ewma_latency = latency
+                record.ewma_error = error
+                record.breaker = breaker or CLOSED_STATE
+
+    def _cost(self, record, prior):
+        latency = record.ewma_latency if record.ewma_latency is not None else prior
+        return latency * (1 + record.inflight) * (1 + 4 * record.ewma_error)
+
+    def _latency_order(self, records):
+        # Power of two choices: the better of two random tokens goes first, so
+        # the single fastest token is not stampeded. The rest follow by cost
+        # as failover order.
+        if len(records) < 2: return records
+        known = [r.ewma_latency for r in records if r.ewma_latency is not None]
+        prior = sum(known) / len(known) if known else 1.0
+        a, b = self._random.sample(records, 2)
+        first = a if self._cost(a, prior) <= self._cost(b, prior) else b
+        rest = sorted((r for r in records if r is not first), key=lambda r: self._cost(r, prior))
+        return [first] + rest
+
+    def observe(self, record, duration, ok):
+        """Fold one finished upstream attempt into the token's latency and error scores."""
+        alpha = self.ewma_alpha
+        if self.state.shared:
+            latency, error = self.state.observe(record.id, duration, ok, alpha)
+            with self._lock:
+                record.ewma_latency = latency
+                record.ewma_error = error
+            return
+        with self._lock:
+            if ok and duration is not None:
+                record.ewma_latency = duration if record.ewma_latency is None else (1 - alpha) * record.ewma_latency + alpha * duration
+            record.ewma_error = (1 - alpha) * record.ewma_error + alpha * (0.0 if ok else 1.0)
+
+    def seed(self, samples):
+        """Warm the scores from historical (token_email, duration, status_code) rows, oldest first."""
+        if self.state.shared: self._sync(self.state.snapshot())
+        # Scores already shared by another process are not seeded twice
+        by_email = {r.email: r for r in self._records.values() if r.email and r.ewma_latency is None and not r.ewma_error}
+        for email, duration, status_code in samples:
+            record = by_email.get(email)
+            if record: self.observe(record, duration, bool(status_code) and status_code < 400)
+
+    def acquire(self, record, kind):
+        """Reserve a request slot on record, or return None if it is at its limit or its circuit is open."""
+        if self.breaker.state(record.breaker, time.time()) == OPEN: return None
+        if self.state.shared:
+            if not record.allows(kind) or not self.state.acquire(record.id, kind, record.limit(kind)):
+                return None
+        with self._lock:
+            if not self.state.shared and (not record.allows(kind) or not record.has_capacity(kind)):
+                return None
+            record.inflight += 1
+            record.inflight_by_kind[kind] = record.inflight_by_kind.get(kind, 0) + 1
+        lease = TokenLease(self, record, kind)
+        now = time.time()
+        if self.breaker.state(record.breaker, now) == HALF_OPEN:
+            # Only one request may test a recovering token
+            if self._update_breaker(record, lambda b: self.breaker.start_probe(b, now)) is None:
+                lease.release()
+                return None
+            lease.probe = True
+        return lease
+
+    def _release(self, record, kind, probe=False):
+        if self.state.shared: self.state.release(record.id, kind)
+        with self._lock:
+            record.inflight = max(record.inflight - 1, 0)
+            record.inflight_by_kind[kind] = max(record.inflight_by_kind.get(kind, 0) - 1, 0)
+        # A probe that ended without reporting lets the next request probe
+        if probe: self._update_breaker(record, lambda b: self.breaker.end_probe(b, time.time()) if b[3] else None)
+
+    def _update_breaker(self, record, transition):
+        if self.state.shared:
+            new = self.state.update_breaker(record.id, transition, CLOSED_STATE)
+            if new is not None:
+                with self._lock: record.breaker = new
+            return new
+        with self._lock:
+            new = transition(record.breaker)
+            if new is not None: record.breaker = new
+        return new
+
+    def record_failure(self, record, threshold):
+        """Count a failed request against the token's circuit; returns the new breaker state."""
+        now = time.time()
+        return self._update_breaker(record, lambda b: self.breaker.on_failure(b, now, threshold))
+
+    def record_success(self, record):
+        if record.breaker == CLOSED_STATE: return
+        self._update_breaker(record, lambda b: None if b == CLOSED_STATE else self.breaker.on_success(b, time.time()))
+
+    def circuit(self, record):
+        return self.breaker.state(record.breaker, time.time())
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return {'tokens': len(self._records), 'usable': len(self._usable_ids), 'inflight': sum(r.inflight for r in self._records.values()),
+                    'open_circuits': sum(1 for r in self._records.values() if self.breaker.state(r.breaker, now) != CLOSED)}
+
+token_pool = TokenPool(mode=os.environ.get('TOKEN_SCHEDULER', 'least_loaded'), ewma_alpha=float(os.environ.get('TOKEN_EWMA_ALPHA', 0.2)), state=shared_state, breaker=breaker_from_env())
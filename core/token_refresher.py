@@ -0,0 +1,153 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+class HostRateLimiter:
+    """Token bucket per host, shared by every refresh worker.
+
+    wait() blocks until the host has budget, plus a random jitter so
+    workers do not fire in lockstep. A 429 pauses the whole host for its
+    Retry-After.
+    """
+
+    def __init__(self, rate=2.0, burst=2, jitter=0.5):
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        # host -> [available tokens, last update, paused until]
+        self._buckets = {}
+
+    def wait(self, host):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._buckets.setdefault(host, [float(self.burst), now, 0.0])
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                if now >= bucket[2] and bucket[0] >= 1:
+                    bucket[0] -= 1
+                    break
+                delay = max(bucket[2] - now, (1 - bucket[0]) / self.rate)
+            time.sleep(delay)
+        if self.jitter: time.sleep(random.uniform(0, self.jitter))
+
+    def pause(self, host, seconds):
+        with self._lock:
+            bucket = self._buckets.setdefault(host, [0.0, time.monotonic(), 0.0])
+            bucket[2] = max(bucket[2], time.monotonic() + seconds)
+        logger.warning(f"Rate limited by {host}, pausing refreshes to it for {seconds:.1f}s")
+
+class RateLimitedAdapter(HTTPAdapter):
+    """Transport adapter that spends a HostRateLimiter budget on every request, redirects included."""
+
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        self.limiter.wait(host)
+        response = super().send(request, **kwargs)
+        if response.status_code == 429:
+            try: retry_after = float(response.headers.get('Retry-After', 5))
+            except ValueError: retry_after = 5.0
+            self.limiter.pause(host, retry_after)
+        return response
+
+class TokenRefresher:
+    """Refreshes many tokens in parallel with bounded concurrency and per-host rate limits.
+
+    One refresh run is active at a time; start() runs it in the background
+    and returns immediately, run() blocks. status() reports the progress of
+    the current or last run.
+    """
+
+    def __init__(self, max_workers=4, host_rate=2.0, host_burst=2, jitter=0.5):
+        self.max_workers = max_workers
+        self.limiter = HostRateLimiter(rate=host_rate, burst=host_burst, jitter=jitter)
+        self._lock = threading.Lock()
+        self._job = None
+        self._thread = None
+
+    def mount(self, session):
+        adapter = RateLimitedAdapter(self.limiter, pool_maxsize=self.max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    def start(self, app, token_ids):
+        """Begin a background run unless one is already running; returns its status."""
+        with self._lock:
+            if self._job and self._job['running']: return dict(self._job)
+            self._job = self._new_job(token_ids)
+            self._thread = threading.Thread(target=self._run, args=(app, token_ids, self._job), daemon=True, name='token-refresh')
+            self._thread.start()
+            return dict(self._job)
+
+    def run(self, app, token_ids):
+        with self._lock:
+            if self._job and self._job['running']:
+                logger.info("Token refresh already running, skipping this run")
+                return dict(self._job)
+            self._job = job = self._new_job(token_ids)
+        self._run(app, token_ids, job)
+        return self.status()
+
+    def status(self):
+        with self._lock:
+            if self._job is None: return None
+            result = dict(self._job)
+            result['errors'] = list(self._job['errors'])
+        return result
+
+    def _new_job(self, token_ids):
+        return {'running': True, 'total': len(token_ids), 'done': 0, 'succeeded': 0, 'failed': 0, 'errors': [],
+                'started_at': datetime.now().isoformat(timespec='seconds'), 'finished_at': None, 'duration': None}
+
+    def _run(self, app, token_ids, job):
+        from .services import update_token_info
+        started = time.monotonic()
+        logger.info(f"Refreshing {len(token_ids)} tokens with {self.max_workers} workers")
+
+        def refresh_one(token_id):
+            try:
+                with app.app_context():
+                    success, msg = update_token_info(token_id, rate_limited=True)
+            except Exception as e:
+                success, msg = False, str(e)
+            with self._lock:
+                job['done'] += 1
+                if success:
+                    job['succeeded'] += 1
+                else:
+                    job['failed'] += 1
+                    # Keep the status payload small
+                    if len(job['errors']) < 50: job['errors'].append({'token_id': token_id, 'message': str(msg)[:200]})
+                done, total = job['done'], job['total']
+            logger.info(f"Refreshed token {token_id} ({done}/{total}): {msg}")
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='token-refresh') as pool:
+                list(pool.map(refresh_one, token_ids))
+        finally:
+            with self._lock:
+                job['running'] = False
+                job['finished_at'] = datetime.now().isoformat(timespec='seconds')
+                job['duration'] = round(time.monotonic() - started, 2)
+            logger.info(f"Token refresh finished in {job['duration']}s: {job['succeeded']} succeeded, {job['failed']} failed")
+
+token_refresher = TokenRefresher(
+    max_workers=int(os.environ.get('REFRESH_CONCURRENCY', 4)),
+    host_rate=float(os.environ.get('REFRESH_HOST_RATE', 2)),
+    host_burst=int(os.environ.get('REFRESH_HOST_BURST', 2)),
+    jitter=float(os.environ.get('REFRESH_JITTER', 0.5)),
+)
@@ -25,7 +25,7 @@ check_env() {
     fi
     
     # 检查是否需要安装依赖
-    if [ ! -d "venv" ] && ! python3 -c "import flask, playwright, requests" 2>/dev/null; then
+    if [ ! -d "venv" ] && ! python3 -c "import flask, quart, playwright, requests" 2>/dev/null; then
         echo -e "${BLUE}[*] 检测到依赖缺失，正在安装...${NC}"
         python3 -m pip install -r requirements.txt
         python3 -m playwright install chromium
@@ -0,0 +1,85 @@
+import sys
+import os
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the test database out of instance/ so test runs never touch real data
+_db_dir = tempfile.mkdtemp(prefix='zai2api-test-')
+os.environ.setdefault('DATABASE_URI', f"sqlite:///{os.path.join(_db_dir, 'test.db')}")
+os.environ.setdefault('SECRET_KEY', 'zai2api-test-secret-key-0123456789abcdef')
+from app import app, init_db
+init_db()
+
+# Tests drive the expiry scheduler directly instead of letting it log in for real
+with app.app_context():
+    from core import services
+    from core.extensions import db
+    from core.models import SystemConfig
+    SystemConfig.query.first().at_auto_refresh_enabled = False
+    db.session.commit()
+    services.invalidate_config()
+
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+def make_token(st, **fields):
+    """The Token for Discord token `st` (created on first use) saved with `fields` and loaded into the token pool.
+
+    Call it inside an app context.
+    """
+    from core.models import Token
+    from core.token_pool import token_pool
+
+    token = Token.query.filter_by(discord_token=st).first()
+    if not token:
+        token = Token(discord_token=st, zai_token=f'jwt-{st}', is_active=True)
+        db.session.add(token)
+    for name, value in fields.items(): setattr(token, name, value)
+    db.session.commit()
+    token_pool.upsert(token)
+    return token
+
+@pytest.fixture
+def stub_page(monkeypatch):
+    """Call with a page object to have browser_server hand it out for every token."""
+    import browser_server
+
+    def install(page):
+        async def get_page(key, req_cookies):
+            return page
+        monkeypatch.setattr(browser_server, '_get_or_create_page', get_page)
+        return page
+    return install
+
+@pytest.fixture(scope='module')
+def browser_service():
+    """Serves browser_server.app on a free localhost port and yields its base URL."""
+    import browser_server
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.loglevel = 'WARNING'
+
+    loop = asyncio.new_event_loop()
+    stop = asyncio.Event()
+    thread = threading.Thread(target=loop.run_until_complete, args=(serve(browser_server.app, config, shutdown_trigger=stop.wait),), daemon=True)
+    thread.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    yield f"http://127.0.0.1:{port}"
+    loop.call_soon_threadsafe(stop.set)
+    thread.join(timeout=5)
@@ -0,0 +1,60 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as app_module
+from app import app
+from conftest import make_token
+from core import services
+from core.extensions import db
+from core.models import Token
+
+@pytest.fixture
+def admin():
+    client = app.test_client()
+    token = client.post('/api/login', json={'username': 'admin', 'password': 'admin'}).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+    with app.app_context():
+        original = services.get_config()
+    yield client, headers
+    client.post('/api/admin/apikey', json={'new_api_key': original.api_key}, headers=headers)
+    client.post('/api/admin/debug', json={'enabled': original.debug_enabled, 'token_refresh_interval': original.token_refresh_interval}, headers=headers)
+
+def test_config_is_cached_until_changed(admin):
+    client, headers = admin
+    with app.app_context():
+        first = services.get_config()
+        assert services.get_config() is first
+
+    assert client.post('/api/admin/config', json={'error_ban_threshold': 7}, headers=headers).get_json()['success']
+    with app.app_context():
+        assert services.get_config() is not first
+        assert services.get_config().error_ban_threshold == 7
+    assert client.get('/api/admin/config', headers=headers).get_json()['error_ban_threshold'] == 7
+
+def test_api_key_change_applies_immediately(admin):
+    client, headers = admin
+    old_key = client.get('/api/admin/config', headers=headers).get_json()['api_key']
+    assert client.post('/api/admin/apikey', json={'new_api_key': 'sk-rotated'}, headers=headers).get_json()['success']
+
+    assert client.get('/v1/models', headers={'Authorization': f'Bearer {old_key}'}).status_code == 401
+    assert client.get('/v1/models', headers={'Authorization': 'Bearer sk-rotated'}).status_code != 401
+
+def test_shorter_refresh_interval_reschedules_tokens_now(admin):
+    client, headers = admin
+    assert client.post('/api/admin/debug', json={'enabled': False, 'token_refresh_interval': 3600}, headers=headers).get_json()['success']
+    with app.app_context():
+        token_id = make_token('interval-test-st', at_expires=datetime.now() + timedelta(seconds=3600)).id
+    assert app_module.expiry_scheduler.scheduled(token_id)[1] > time.time() + 3000
+
+    assert client.post('/api/admin/debug', json={'enabled': False, 'token_refresh_interval': 600}, headers=headers).get_json()['success']
+    with app.app_context():
+        assert services.get_config().token_refresh_interval == 600
+        assert db.session.get(Token, token_id).at_expires <= datetime.now() + timedelta(seconds=600)
+    # Due lead time before the new deadline, not the old one
+    assert app_module.expiry_scheduler.scheduled(token_id)[1] <= time.time() + 600
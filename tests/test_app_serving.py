@@ -0,0 +1,94 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import app as app_module
+from app import app, serve_gateway
+from conftest import make_token
+from core.models import SystemConfig
+
+UPSTREAM_DELAY = 0.5
+CONCURRENCY = 16
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """Runs the production server on a free port with a slow fake upstream."""
+    active = {'now': 0, 'peak': 0}
+    lock = threading.Lock()
+
+    def slow_proxy(url, method, payload, token_obj=None, retry_on_auth_fail=True, request_id=None):
+        with lock:
+            active['now'] += 1
+            active['peak'] = max(active['peak'], active['now'])
+        time.sleep(UPSTREAM_DELAY)
+        with lock: active['now'] -= 1
+        return {'status': 200, 'body': {'choices': [{'message': {'role': 'assistant', 'content': 'ok'}}]}}
+    monkeypatch.setattr(app_module, '_browser_proxy_request', slow_proxy)
+
+    with app.app_context():
+        make_token('serving-test-st')
+        api_key = SystemConfig.query.first().api_key
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    loop = asyncio.new_event_loop()
+    stop = asyncio.Event()
+    thread = threading.Thread(target=loop.run_until_complete, args=(serve_gateway(f"127.0.0.1:{port}", threads=CONCURRENCY * 2, shutdown_trigger=stop.wait),), daemon=True)
+    thread.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    yield f"http://127.0.0.1:{port}", api_key, active
+    loop.call_soon_threadsafe(stop.set)
+    thread.join(timeout=5)
+
+def test_concurrent_requests_overlap(gateway):
+    base_url, api_key, active = gateway
+    headers = {'Authorization': f'Bearer {api_key}'}
+    body = {'model': 'gemini-3-flash-preview', 'messages': [{'role': 'user', 'content': 'hi'}]}
+
+    def call(_):
+        with requests.Session() as session:
+            session.trust_env = False
+            return session.post(f"{base_url}/v1/chat/completions", json=body, headers=headers, timeout=30).status_code
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        statuses = list(pool.map(call, range(CONCURRENCY)))
+    elapsed = time.monotonic() - start
+    summary = (f"{CONCURRENCY} requests x {UPSTREAM_DELAY}s upstream: {elapsed:.2f}s wall, peak concurrency {active['peak']}, "
+               f"{CONCURRENCY / elapsed:.1f} req/s (serial would be {CONCURRENCY * UPSTREAM_DELAY:.1f}s)")
+
+    assert statuses == [200] * CONCURRENCY
+    assert active['peak'] > CONCURRENCY // 2, summary
+    # Serial handling would take CONCURRENCY * UPSTREAM_DELAY
+    assert elapsed < CONCURRENCY * UPSTREAM_DELAY / 4, summary
+
+def test_admin_ui_answers_during_long_completions(gateway):
+    base_url, api_key, _ = gateway
+    headers = {'Authorization': f'Bearer {api_key}'}
+    body = {'model': 'gemini-3-flash-preview', 'messages': [{'role': 'user', 'content': 'hi'}]}
+    session = requests.Session()
+    session.trust_env = False
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        pending = [pool.submit(session.post, f"{base_url}/v1/chat/completions", json=body, headers=headers, timeout=30) for _ in range(4)]
+        time.sleep(0.1)
+        start = time.monotonic()
+        page = requests.get(f"{base_url}/login", timeout=5, proxies={'http': None})
+        assert time.monotonic() - start < UPSTREAM_DELAY / 2
+        assert page.status_code == 200
+        assert all(f.result().status_code == 200 for f in pending)
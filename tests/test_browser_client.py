@@ -0,0 +1,70 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import browser_server
+from core.browser_client import BrowserServiceClient, BrowserBusy
+
+class EchoPage:
+    async def evaluate(self, script, args):
+        return {'status': 200, 'body': {'messages': len(args['payload']['messages'])}}
+
+@pytest.fixture
+def echo_pages(stub_page):
+    stub_page(EchoPage())
+
+def _proxy_body(messages):
+    return {'url': 'https://zai.is/api/v1/chat/completions', 'method': 'POST', 'payload': {'messages': messages}, 'token': 'jwt', 'cookies': {'token': 'x'}}
+
+def test_connections_are_reused(browser_service, echo_pages):
+    client = BrowserServiceClient(pool_size=4)
+    for _ in range(10):
+        assert client.post(f"{browser_service}/proxy", _proxy_body([{'role': 'user', 'content': 'hi'}])).json()['status'] == 200
+
+    stats = client.stats()
+    assert stats['requests'] == 10
+    assert stats['new_connections'] == 1
+    assert stats['reused_connections'] == 9
+
+def test_callers_beyond_the_pool_wait_for_a_pooled_connection(browser_service, stub_page):
+    class SlowEchoPage:
+        async def evaluate(self, script, args):
+            await asyncio.sleep(0.1)
+            return {'status': 200, 'body': None}
+    stub_page(SlowEchoPage())
+    client = BrowserServiceClient(pool_size=2)
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        statuses = list(pool.map(lambda _: client.post(f"{browser_service}/proxy", _proxy_body([])).json()['status'], range(6)))
+
+    assert statuses == [200] * 6
+    # No socket is opened past the pool and thrown away
+    assert client.stats()['new_connections'] == 2
+
+def test_default_pool_matches_the_gateway_threads(monkeypatch):
+    monkeypatch.delenv('BROWSER_POOL_SIZE', raising=False)
+    monkeypatch.setenv('APP_THREADS', '48')
+    assert BrowserServiceClient.from_env().pool_size == 48
+
+def test_large_histories_are_gzipped(browser_service, echo_pages):
+    client = BrowserServiceClient(gzip_min_bytes=1024)
+    history = [{'role': 'user', 'content': 'lorem ipsum ' * 50} for _ in range(40)]
+    resp = client.post(f"{browser_service}/proxy", _proxy_body(history))
+
+    assert resp.json()['body'] == {'messages': 40}
+    stats = client.stats()
+    assert stats['gzip_requests'] == 1
+    assert stats['bytes_sent'] < stats['bytes_raw'] / 5
+
+def test_overloaded_service_raises_browser_busy(browser_service, echo_pages, monkeypatch):
+    monkeypatch.setattr(browser_server, 'admission', browser_server.AdmissionQueue(max_active=1, max_queue=0))
+    browser_server.admission.active = 1
+    client = BrowserServiceClient()
+    with pytest.raises(BrowserBusy) as excinfo:
+        client.post(f"{browser_service}/proxy", _proxy_body([{'role': 'user', 'content': 'hi'}]))
+    assert excinfo.value.retry_after >= 1
+    assert client.stats()['busy'] == 1
@@ -0,0 +1,153 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import browser_server
+
+PAGE_LATENCY = 0.25
+REQUESTS = 32
+
+class StubPage:
+    """A warm page whose fetch takes a fixed time, like a zai.is completion."""
+    async def evaluate(self, script, args):
+        await asyncio.sleep(PAGE_LATENCY)
+        return {'status': 200, 'body': {'token': args['token']}}
+
+def test_inflight_fetches_share_the_event_loop(browser_service, stub_page):
+    stub_page(StubPage())
+    def call(i):
+        resp = requests.post(f"{browser_service}/proxy", json={'url': 'https://zai.is/api/v1/chat/completions', 'method': 'POST', 'payload': {}, 'token': f'jwt-{i}', 'cookies': {'token': 'x'}}, proxies={'http': None, 'https': None})
+        return resp.json()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=REQUESTS) as pool:
+        results = list(pool.map(call, range(REQUESTS)))
+    elapsed = time.time() - start
+
+    assert [r['body']['token'] for r in results] == [f'jwt-{i}' for i in range(REQUESTS)]
+    # Serial execution would take REQUESTS * PAGE_LATENCY
+    assert elapsed < PAGE_LATENCY * REQUESTS / 4, f"{REQUESTS} requests in {elapsed:.2f}s ({REQUESTS / elapsed:.1f} req/s)"
+
+def test_proxy_timeout_returns_504(browser_service, monkeypatch):
+    async def hang(data):
+        await asyncio.sleep(5)
+    monkeypatch.setattr(browser_server, '_handle_proxy', hang)
+    monkeypatch.setattr(browser_server, 'REQUEST_TIMEOUT', 0.2)
+    resp = requests.post(f"{browser_service}/proxy", json={'url': 'https://zai.is/api/v1/models', 'token': 'jwt', 'cookies': {'token': 'x'}}, proxies={'http': None, 'https': None})
+    assert resp.status_code == 504
+
+def test_one_page_multiplexes_up_to_the_page_limit(browser_service, stub_page, monkeypatch):
+    state = {'active': 0, 'peak': 0}
+
+    class CountingPage:
+        async def evaluate(self, script, args):
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+            await asyncio.sleep(PAGE_LATENCY)
+            state['active'] -= 1
+            return {'status': 200, 'body': {}}
+
+    stub_page(CountingPage())
+    monkeypatch.setattr(browser_server, 'PAGE_CONCURRENCY', 3)
+    browser_server.worker_state['page_slots'].pop('jwt-shared', None)
+
+    def call(i):
+        return requests.post(f"{browser_service}/proxy", json={'url': 'https://zai.is/api/v1/chat/completions', 'method': 'POST', 'payload': {}, 'token': 'jwt-shared', 'cookies': {'token': 'x'}}, proxies={'http': None, 'https': None}).json()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=9) as pool:
+        results = list(pool.map(call, range(9)))
+    elapsed = time.time() - start
+
+    assert all(r['status'] == 200 for r in results)
+    assert state['peak'] == 3
+    # Three waves of three concurrent fetches on the one page
+    assert PAGE_LATENCY * 3 <= elapsed < PAGE_LATENCY * 6
+
+def test_cancel_aborts_a_running_fetch(browser_service, stub_page, monkeypatch):
+    class AbortablePage:
+        """Mimics the AbortController registry that PROXY_JS keeps in the page."""
+        def __init__(self):
+            self.aborts = {}
+        async def evaluate(self, script, args):
+            if script == browser_server.CANCEL_JS:
+                event = self.aborts.get(args)
+                if event: event.set()
+                return event is not None
+            event = self.aborts[args['reqId']] = asyncio.Event()
+            try:
+                await asyncio.wait_for(event.wait(), timeout=5)
+                return {'status': 499, 'body': None, 'cancelled': True}
+            except asyncio.TimeoutError:
+                return {'status': 200, 'body': {}}
+            finally:
+                del self.aborts[args['reqId']]
+    page = stub_page(AbortablePage())
+    monkeypatch.setattr(browser_server, '_cached_page', lambda jwt_token: page)
+
+    proxies = {'http': None, 'https': None}
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        start = time.time()
+        pending = pool.submit(requests.post, f"{browser_service}/proxy", json={'url': 'https://zai.is/api/v1/chat/completions', 'method': 'POST', 'token': 'jwt', 'cookies': {'token': 'x'}, 'request_id': 'req-1'}, proxies=proxies)
+        while 'req-1' not in page.aborts: time.sleep(0.01)
+        assert requests.post(f"{browser_service}/proxy/cancel", json={'request_id': 'req-1', 'token': 'jwt'}, proxies=proxies).json() == {'cancelled': True}
+        assert pending.result().json()['cancelled'] is True
+        assert time.time() - start < 2
+
+@pytest.fixture
+def one_slot(stub_page, monkeypatch):
+    """A browser service that runs one request at a time and queues at most one more."""
+    calls = []
+    class SlowPage:
+        async def evaluate(self, script, args):
+            calls.append(args['token'])
+            await asyncio.sleep(0.5)
+            return {'status': 200, 'body': {}}
+    stub_page(SlowPage())
+    monkeypatch.setattr(browser_server, 'admission', browser_server.AdmissionQueue(max_active=1, max_queue=1, max_wait=5))
+    return calls
+
+def _post_proxy(url, token, headers=None):
+    return requests.post(f"{url}/proxy", json={'url': 'https://zai.is/api/v1/chat/completions', 'method': 'POST', 'token': token, 'cookies': {'token': 'x'}}, headers=headers, proxies={'http': None, 'https': None})
+
+def test_full_queue_is_rejected_with_retry_after(browser_service, one_slot):
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        running = pool.submit(_post_proxy, browser_service, 'jwt-1')
+        while browser_server.admission.active == 0: time.sleep(0.01)
+        queued = pool.submit(_post_proxy, browser_service, 'jwt-2')
+        while browser_server.admission.waiting == 0: time.sleep(0.01)
+
+        start = time.time()
+        rejected = _post_proxy(browser_service, 'jwt-3')
+        assert rejected.status_code == 429
+        assert int(rejected.headers['Retry-After']) >= 1
+        assert time.time() - start < 0.3
+
+        assert running.result().status_code == 200
+        assert queued.result().status_code == 200
+    assert one_slot == ['jwt-1', 'jwt-2']
+    assert browser_server.admission.stats()['rejected_full'] == 1
+
+def test_request_whose_caller_gave_up_is_dropped(browser_service, one_slot):
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        running = pool.submit(_post_proxy, browser_service, 'jwt-1')
+        while browser_server.admission.active == 0: time.sleep(0.01)
+        start = time.time()
+        # The caller only waits 0.2s, far less than the running request needs
+        expired = _post_proxy(browser_service, 'jwt-2', headers={'X-Request-Timeout': '0.2'})
+        assert expired.status_code == 429
+        assert time.time() - start < 0.45
+        assert running.result().status_code == 200
+
+    time.sleep(0.1)
+    # The abandoned request never reached the page
+    assert one_slot == ['jwt-1']
+    stats = browser_server.admission.stats()
+    assert stats['expired'] == 1 and stats['active'] == 0 and stats['waiting'] == 0
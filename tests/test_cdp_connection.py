@@ -0,0 +1,122 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+import browser_server
+
+class FakeBrowser:
+    def __init__(self):
+        self.connected = True
+        self.handlers = []
+        self.contexts = []
+    def is_connected(self):
+        return self.connected
+    def on(self, event, handler):
+        assert event == 'disconnected'
+        self.handlers.append(handler)
+    def drop(self):
+        self.connected = False
+        for handler in self.handlers: handler(self)
+
+class FakeChromium:
+    def __init__(self):
+        self.browsers = []
+    async def connect_over_cdp(self, url):
+        # A websocket handshake plus target discovery
+        await asyncio.sleep(0.05)
+        browser = FakeBrowser()
+        self.browsers.append(browser)
+        return browser
+
+@pytest.fixture
+def chromium(monkeypatch):
+    chromium = FakeChromium()
+    async def get_playwright():
+        return type('Playwright', (), {'chromium': chromium})()
+    monkeypatch.setattr(browser_server, '_get_playwright', get_playwright)
+    monkeypatch.setitem(browser_server.worker_state, 'browser', None)
+    monkeypatch.setitem(browser_server.worker_state, 'browser_lock', asyncio.Lock())
+    monkeypatch.setitem(browser_server.worker_state, 'cdp_stats', {'connects': 0, 'disconnects': 0, 'contexts_created': 0, 'contexts_reused': 0})
+    monkeypatch.setitem(browser_server.worker_state, 'pages', OrderedDict())
+    return chromium
+
+def test_pages_share_one_connection(chromium):
+    async def scenario():
+        return await asyncio.gather(*(browser_server._get_browser() for _ in range(10)))
+    browsers = asyncio.run(scenario())
+    assert len(chromium.browsers) == 1
+    assert all(b is chromium.browsers[0] for b in browsers)
+
+def test_dropped_connection_reconnects_and_forgets_its_pages(chromium):
+    async def scenario():
+        first = await browser_server._get_browser()
+        browser_server.worker_state['pages']['id:1'] = {'browser': first, 'page': None, 'last_used': 0}
+        first.drop()
+        assert browser_server.worker_state['pages'] == {}
+        return first, await browser_server._get_browser()
+    first, second = asyncio.run(scenario())
+    assert second is not first and second.is_connected()
+    assert browser_server.worker_state['cdp_stats']['connects'] == 2
+    assert browser_server.worker_state['cdp_stats']['disconnects'] == 1
+
+class FakeContext:
+    def __init__(self, browser, cookies=None):
+        self.browser = browser
+        self.jar = list(cookies or [])
+        self.closed = False
+    async def cookies(self):
+        return list(self.jar)
+    async def add_cookies(self, cookies):
+        self.jar.extend(cookies)
+    async def clear_cookies(self):
+        self.jar = []
+    async def close(self):
+        self.closed = True
+
+def test_each_token_gets_its_own_context_from_a_bounded_pool(chromium, monkeypatch):
+    monkeypatch.setitem(browser_server.worker_state, 'idle_contexts', OrderedDict())
+    monkeypatch.setattr(browser_server, 'IDLE_CONTEXTS', 1)
+    clearance = {'name': 'cf_clearance', 'value': 'ok', 'domain': '.zai.is', 'path': '/'}
+    bot_check = {'name': '__cf_bm', 'value': 'bm', 'domain': '.zai.is', 'path': '/'}
+    profile_session = {'name': 'token', 'value': 'jwt-profile', 'domain': 'zai.is', 'path': '/'}
+    tracking = {'name': '_ga', 'value': 'GA1', 'domain': '.zai.is', 'path': '/'}
+
+    async def scenario():
+        browser = await browser_server._get_browser()
+        browser.contexts = [FakeContext(browser, [clearance, profile_session, bot_check, tracking])]
+        async def new_context():
+            context = FakeContext(browser)
+            browser.contexts.append(context)
+            return context
+        browser.new_context = new_context
+
+        a = await browser_server._token_context(browser, 'id:1')
+        b = await browser_server._token_context(browser, 'id:2')
+        await a.add_cookies([{'name': 'token', 'value': 'jwt-a', 'domain': 'zai.is', 'path': '/'}])
+        await b.add_cookies([{'name': 'token', 'value': 'jwt-b', 'domain': 'zai.is', 'path': '/'}])
+        assert a is not b and browser.contexts[0] not in (a, b)
+        # Only the profile's Cloudflare cookies are shared; its own session and other cookies are not
+        assert a.jar[:2] == [clearance, bot_check] and b.jar[:2] == [clearance, bot_check]
+        assert profile_session not in a.jar and tracking not in a.jar
+        assert [c['value'] for c in a.jar if c['name'] == 'token'] == ['jwt-a']
+        assert [c['value'] for c in b.jar if c['name'] == 'token'] == ['jwt-b']
+
+        await browser_server._release_context('id:1', a)
+        await browser_server._release_context('id:2', b)
+        # The most recent spare is kept with its cookies cleared, the older one is closed
+        assert browser_server.worker_state['idle_contexts'] == {'id:2': b} and b.jar == []
+        assert a.closed
+        # A spare still holds its token's site storage, so another token never gets it
+        c = await browser_server._token_context(browser, 'id:3')
+        assert c is not b
+        d = await browser_server._token_context(browser, 'id:2')
+        assert d is b and d.jar == [clearance, bot_check]
+
+    asyncio.run(scenario())
+    stats = browser_server.worker_state['cdp_stats']
+    assert stats['contexts_created'] == 3 and stats['contexts_reused'] == 1
@@ -0,0 +1,125 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app as app_module
+from app import app
+from conftest import make_token
+from core import services
+from core.circuit_breaker import CLOSED, CLOSED_STATE, HALF_OPEN, OPEN, CircuitBreaker
+from core.extensions import db
+from core.models import Token
+from core.shared_state import SqliteState
+from core.token_pool import TokenPool, token_pool
+from tests.test_token_pool import _row
+
+def test_transitions_and_backoff():
+    breaker = CircuitBreaker(base_cooldown=10, max_cooldown=35)
+    state = CLOSED_STATE
+    for now in (0, 1):
+        state = breaker.on_failure(state, now, threshold=3)
+        assert breaker.state(state, now) == CLOSED
+    state = breaker.on_failure(state, 2, threshold=3)
+    assert breaker.state(state, 2) == OPEN and state[2] == 12
+    # Failures of requests that started earlier do not extend the cooldown
+    assert breaker.on_failure(state, 5, threshold=3) == state
+
+    assert breaker.state(state, 12) == HALF_OPEN
+    probing = breaker.start_probe(state, 12)
+    assert breaker.start_probe(probing, 12) is None
+    assert not breaker.selectable(probing, 12)
+    # Failed probes reopen with doubling cooldowns, capped
+    state = breaker.on_failure(probing, 13, threshold=3)
+    assert state[2] == 13 + 20
+    state = breaker.on_failure(breaker.start_probe(state, 33), 33, threshold=3)
+    assert state[2] == 33 + 35
+    assert breaker.on_success(state, 70) == CLOSED_STATE
+
+def test_pool_skips_open_circuits_and_lets_one_probe_through():
+    pool = TokenPool(breaker=CircuitBreaker(base_cooldown=0.1))
+    pool.load([_row(1), _row(2)])
+    record = pool.get(1)
+    for _ in range(2): pool.record_failure(record, threshold=2)
+    assert [r.id for r in pool.candidates()] == [2]
+    assert pool.acquire(record, 'chat') is None
+    assert pool.stats()['open_circuits'] == 1
+
+    time.sleep(0.12)
+    assert 1 in [r.id for r in pool.candidates()]
+    probe = pool.acquire(record, 'chat')
+    assert probe.probe
+    assert pool.acquire(record, 'chat') is None
+    assert [r.id for r in pool.candidates()] == [2]
+    # The probe went away without a verdict, so the next request may probe
+    probe.release()
+    probe = pool.acquire(record, 'chat')
+    assert probe.probe
+    pool.record_success(record)
+    probe.release()
+    assert pool.circuit(record) == CLOSED
+    assert pool.acquire(record, 'chat').probe is False
+
+def test_circuit_state_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'state.db')
+    a = TokenPool(state=SqliteState(path), breaker=CircuitBreaker(base_cooldown=60))
+    b = TokenPool(state=SqliteState(path), breaker=CircuitBreaker(base_cooldown=60))
+    a.load([_row(1), _row(2)])
+    b.load([_row(1), _row(2)])
+    a.record_failure(a.get(1), threshold=1)
+    assert [r.id for r in b.candidates()] == [2]
+
+def test_transient_errors_open_the_circuit_but_confirmed_auth_failures_ban():
+    with app.app_context():
+        token = make_token('breaker-test-st')
+        record = token_pool.get(token.id)
+        config = services.get_config()
+        for _ in range((config.error_ban_threshold or 3) + 2):
+            app_module._mark_token_error(record, config, 'upstream 502')
+        token = db.session.get(Token, token.id)
+        assert token.is_active
+        assert token.remark.startswith('Circuit open')
+        assert token_pool.circuit(record) == OPEN
+
+        # A 401/403 without a confirmed re-login only counts towards the circuit
+        app_module._mark_token_error(record, config, 'forbidden')
+        assert db.session.get(Token, token.id).is_active
+
+        app_module._mark_token_error(record, config, 'unauthorized', auth_rejected=True)
+        assert not db.session.get(Token, token.id).is_active
+        assert record.id not in [r.id for r in token_pool.candidates()]
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Browser service answering with queued upstream statuses; re-login outcome is set per test."""
+    statuses = []
+    relogins = []
+    def post(url, body, stream=False):
+        status = statuses.pop(0)
+        return SimpleNamespace(status_code=200, json=lambda: {'status': status, 'body': {}})
+    monkeypatch.setattr(app_module.browser_client, 'post', post)
+    monkeypatch.setattr(services, 'update_token_info', lambda token_id: relogins.pop(0))
+    return statuses, relogins
+
+def _proxy(token_id=1):
+    record = SimpleNamespace(id=token_id, zai_token='jwt', cookies={'token': 'x'})
+    return app_module._browser_proxy_request("https://zai.is/api/v1/chat/completions", "POST", {}, token_obj=record)
+
+def test_failed_relogin_is_not_an_auth_rejection(upstream):
+    statuses, relogins = upstream
+    statuses.append(401)
+    relogins.append((False, 'ConnectionError: discord.com timed out'))
+    res = _proxy()
+    assert res['status'] == 401 and not res.get('auth_rejected')
+
+def test_refusal_after_successful_relogin_is_an_auth_rejection(upstream):
+    statuses, relogins = upstream
+    statuses.extend([403, 403, 401, 200])
+    relogins.extend([(True, 'ok'), (True, 'ok')])
+    assert _proxy()['auth_rejected'] is True
+    res = _proxy()
+    assert res['status'] == 200 and not res.get('auth_rejected')
@@ -0,0 +1,129 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+from types import SimpleNamespace
+
+import requests
+
+import browser_server
+from core.direct_transport import DirectTransport, transport_from_env
+
+class FakeMinter:
+    """Stands in for browser_server's /credentials."""
+    def __init__(self, expires_in=300, error=None):
+        self.expires_in = expires_in
+        self.error = error
+        self.calls = 0
+    def post(self, url, body):
+        self.calls += 1
+        data = {'error': self.error} if self.error else {'darkknight': f"dk-{self.calls}", 'user_agent': 'Chrome/120', 'cookies': {'cf_clearance': 'ok', 'token': body['token']}, 'expires_in': self.expires_in}
+        return SimpleNamespace(status_code=200, json=lambda: data)
+
+class FakeSession:
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.cookies = SimpleNamespace(clear=lambda: None)
+        self.sent = []
+    def execute_request(self, method, url, headers=None, cookies=None, json=None, timeout_seconds=None):
+        self.sent.append({'method': method, 'headers': headers, 'cookies': cookies, 'json': json})
+        return SimpleNamespace(status_code=self.statuses.pop(0), json=lambda: {'choices': []}, text='')
+
+def _token(jwt='jwt-a'):
+    return SimpleNamespace(id=1, zai_token=jwt, cookies={'token': jwt})
+
+def _transport(minter, session):
+    return DirectTransport(minter, 'http://browser/credentials', enabled=True, session_factory=lambda: session)
+
+def test_minted_credentials_are_reused_until_they_expire():
+    minter = FakeMinter()
+    session = FakeSession([200, 200, 200])
+    transport = _transport(minter, session)
+    for _ in range(3):
+        assert transport.request(_token(), 'https://zai.is/api/v1/chat/completions', 'POST', {'model': 'm'}) == {'status': 200, 'body': {'choices': []}}
+
+    assert minter.calls == 1
+    sent = session.sent[0]
+    assert sent['headers']['x-zai-darkknight'] == 'dk-1'
+    assert sent['headers']['Authorization'] == 'Bearer jwt-a'
+    assert sent['cookies'] == {'cf_clearance': 'ok', 'token': 'jwt-a'}
+    assert transport.stats()['direct_ratio'] == 1.0
+
+    # Credentials minted for an older JWT are minted again
+    transport.request(_token('jwt-b'), 'https://zai.is/api/v1/models', 'GET', None)
+    assert minter.calls == 2
+
+def test_rejected_credentials_fall_back_and_are_dropped():
+    minter = FakeMinter()
+    transport = _transport(minter, FakeSession([403, 200]))
+    assert transport.request(_token(), 'https://zai.is/api/v1/chat/completions', 'POST', {}) is None
+    assert transport.request(_token(), 'https://zai.is/api/v1/chat/completions', 'POST', {})['status'] == 200
+    assert minter.calls == 2
+    stats = transport.stats()
+    assert stats['rejected'] == 1 and stats['fallbacks'] == 1
+
+def test_header_about_to_expire_means_browser_path():
+    minter = FakeMinter(expires_in=5)
+    transport = _transport(minter, FakeSession([]))
+    assert transport.request(_token(), 'https://zai.is/api/v1/models', 'GET', None) is None
+    assert transport.request(_token(), 'https://zai.is/api/v1/models', 'GET', None) is None
+    # Neither cached nor asked for again right away
+    assert minter.calls == 1
+    stats = transport.stats()
+    assert stats['fallbacks'] == 2 and stats['mints'] == 0 and stats['cached_credentials'] == 0
+
+def test_full_session_pool_falls_back_instead_of_queueing():
+    entered, release = threading.Event(), threading.Event()
+    class BlockingSession(FakeSession):
+        def execute_request(self, *args, **kwargs):
+            entered.set()
+            release.wait(5)
+            return super().execute_request(*args, **kwargs)
+    transport = DirectTransport(FakeMinter(), 'http://browser/credentials', enabled=True, pool_size=1, slot_timeout=0.1, session_factory=lambda: BlockingSession([200]))
+    busy = threading.Thread(target=transport.request, args=(_token(), 'https://zai.is/api/v1/models', 'GET', None))
+    busy.start()
+    assert entered.wait(2)
+
+    start = time.monotonic()
+    assert transport.request(_token(), 'https://zai.is/api/v1/models', 'GET', None) is None
+    assert time.monotonic() - start < 1
+    release.set()
+    busy.join()
+    stats = transport.stats()
+    assert stats['pool_full'] == 1 and stats['fallbacks'] == 1
+
+def test_default_pool_matches_the_gateway_threads(monkeypatch):
+    monkeypatch.delenv('DIRECT_POOL_SIZE', raising=False)
+    monkeypatch.setenv('APP_THREADS', '48')
+    transport = transport_from_env(FakeMinter(), 'http://browser/credentials')
+    for _ in range(48): assert transport._slots.acquire(blocking=False)
+    assert not transport._slots.acquire(blocking=False)
+
+def test_no_header_means_browser_path():
+    transport = _transport(FakeMinter(error='no x-zai-darkknight header captured yet'), FakeSession([]))
+    assert transport.request(_token(), 'https://zai.is/api/v1/models', 'GET', None) is None
+    assert transport.stats()['fallbacks'] == 1
+
+class CredentialPage:
+    def __init__(self, age_ms=60000):
+        self.context = self
+        self.age_ms = age_ms
+    async def evaluate(self, script, max_age_ms):
+        assert script == browser_server.CREDENTIALS_JS
+        return {'darkknight': 'dk-live', 'ageMs': self.age_ms, 'userAgent': 'Chrome/120'}
+    async def cookies(self, url):
+        return [{'name': 'token', 'value': 'jwt-a'}, {'name': 'cf_clearance', 'value': 'ok'}]
+
+def test_browser_exports_header_with_validity_window(browser_service, stub_page, monkeypatch):
+    stub_page(CredentialPage())
+    monkeypatch.setattr(browser_server, 'DK_TTL', 300)
+    resp = requests.post(f"{browser_service}/credentials", json={'token': 'jwt-a', 'token_id': 1, 'cookies': {'token': 'jwt-a'}}, proxies={'http': None, 'https': None})
+    assert resp.json() == {'darkknight': 'dk-live', 'user_agent': 'Chrome/120', 'cookies': {'token': 'jwt-a', 'cf_clearance': 'ok'}, 'expires_in': 240}
+
+def test_browser_refuses_an_expired_header(browser_service, stub_page, monkeypatch):
+    stub_page(CredentialPage(age_ms=300000))
+    monkeypatch.setattr(browser_server, 'DK_TTL', 300)
+    resp = requests.post(f"{browser_service}/credentials", json={'token': 'jwt-a', 'token_id': 1, 'cookies': {'token': 'jwt-a'}}, proxies={'http': None, 'https': None})
+    assert 'error' in resp.json()
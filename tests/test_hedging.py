@@ -0,0 +1,84 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from app import app
+from conftest import make_token
+from core.hedging import HedgePolicy
+from core.models import SystemConfig
+from core.token_pool import token_pool
+
+def test_deadline_follows_the_latency_percentile():
+    policy = HedgePolicy(percentile=90, min_delay=0.5, max_delay=30, min_samples=10)
+    assert policy.delay() == 30
+    for i in range(1, 101): policy.observe(i / 10)
+    assert policy.delay() == pytest.approx(9.1)
+    for _ in range(500): policy.observe(0.01)
+    assert policy.delay() == 0.5
+
+def test_budget_caps_the_hedge_ratio():
+    policy = HedgePolicy(budget=0.1)
+    for _ in range(1000):
+        policy.record_request()
+        policy.try_hedge()
+    stats = policy.stats()
+    assert stats['hedges'] <= 0.1 * 1000 + 1
+    assert stats['budget_denied'] > 0
+    assert HedgePolicy(budget=0).try_hedge() is False
+
+@pytest.fixture
+def hedged_gateway(monkeypatch):
+    calls = []
+    cancelled = []
+    lock = threading.Lock()
+
+    def fake_proxy(url, method, payload, token_obj=None, retry_on_auth_fail=True, request_id=None):
+        with lock:
+            calls.append(token_obj.id)
+            first = len(calls) == 1
+        # The first attempt hangs until it is cancelled, later ones answer quickly
+        deadline = time.time() + (2.0 if first else 0.05)
+        while time.time() < deadline and request_id not in cancelled: time.sleep(0.01)
+        return {'status': 200, 'body': {'choices': [{'message': {'role': 'assistant', 'content': 'slow' if first else 'fast'}}]}}
+
+    def fake_cancel(attempt):
+        attempt.cancelled = True
+        cancelled.append(attempt.request_id)
+
+    monkeypatch.setattr(app_module, '_browser_proxy_request', fake_proxy)
+    monkeypatch.setattr(app_module, '_cancel_attempt', fake_cancel)
+    monkeypatch.setattr(app_module, 'hedge_policy', HedgePolicy(enabled=True, min_delay=0.1, max_delay=0.1, budget=1.0))
+    with app.app_context():
+        for st in ('hedge-test-st-1', 'hedge-test-st-2'): make_token(st)
+        api_key = SystemConfig.query.first().api_key
+    return calls, cancelled, {'Authorization': f'Bearer {api_key}'}
+
+def test_slow_request_is_hedged_and_loser_cancelled(hedged_gateway):
+    calls, cancelled, headers = hedged_gateway
+    client = app.test_client()
+    start = time.monotonic()
+    res = client.post('/v1/chat/completions', json={'model': 'gemini-3-flash-preview', 'messages': [{'role': 'user', 'content': 'hi'}]}, headers=headers)
+    elapsed = time.monotonic() - start
+
+    assert res.status_code == 200
+    assert res.get_json()['choices'][0]['message']['content'] == 'fast'
+    assert elapsed < 1.0
+    assert len(calls) == 2 and calls[0] != calls[1]
+    # Cancellation is sent in the background after the response
+    deadline = time.time() + 2
+    while not cancelled and time.time() < deadline: time.sleep(0.01)
+    assert len(cancelled) == 1
+    stats = app_module.hedge_policy.stats()
+    assert stats['hedges'] == 1 and stats['hedge_wins'] == 1
+
+    # The cancelled attempt is not held against its token
+    deadline = time.time() + 2
+    while token_pool.get(calls[0]).inflight and time.time() < deadline: time.sleep(0.02)
+    assert token_pool.get(calls[0]).inflight == 0
+    assert token_pool.get(calls[0]).error_count == 0
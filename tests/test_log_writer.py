@@ -0,0 +1,30 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from core.log_writer import RequestLogWriter
+from core.models import RequestLog
+
+def test_rows_are_written_in_batches():
+    writer = RequestLogWriter(max_batch=10, flush_interval=0.2)
+    writer.init_app(app)
+    for i in range(25):
+        writer.submit(operation='log-writer-test', status_code=200, duration=i / 10)
+
+    assert writer.flush()
+    with app.app_context():
+        assert RequestLog.query.filter_by(operation='log-writer-test').count() == 25
+    stats = writer.stats()
+    assert stats['written'] == 25
+    assert stats['batches'] >= 3
+    assert stats['pending'] == 0
+
+def test_full_buffer_drops_instead_of_blocking():
+    writer = RequestLogWriter(max_pending=3)
+    for i in range(5):
+        writer.submit(operation='log-writer-drop', status_code=200, duration=0.0)
+
+    stats = writer.stats()
+    assert stats['dropped'] == 2
+    assert stats['pending'] == 3
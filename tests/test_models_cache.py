@@ -0,0 +1,66 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+
+from core.models_cache import ModelListCache
+
+def _fetcher(delay=0.0, results=None):
+    calls = []
+    def fetch():
+        calls.append(time.monotonic())
+        time.sleep(delay)
+        if results: return results.pop(0)
+        return {'object': 'list', 'data': [{'id': f'model-{len(calls)}'}]}
+    return fetch, calls
+
+def _wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate(): return True
+        time.sleep(0.01)
+    return False
+
+def test_cold_cache_fetches_once_for_concurrent_callers():
+    fetch, calls = _fetcher(delay=0.2)
+    cache = ModelListCache(fetch, ttl=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+
+def test_fresh_value_is_served_without_fetching():
+    fetch, calls = _fetcher()
+    cache = ModelListCache(fetch, ttl=60)
+    cache.get()
+    for _ in range(100): cache.get()
+    assert len(calls) == 1
+    assert cache.stats()['hits'] == 100
+
+def test_stale_value_is_served_while_refreshing():
+    fetch, calls = _fetcher(delay=0.3)
+    cache = ModelListCache(fetch, ttl=0.05)
+    first = cache.get()
+    time.sleep(0.1)
+
+    start = time.monotonic()
+    stale = cache.get()
+    assert time.monotonic() - start < 0.05
+    assert stale == first
+    cache.get()  # does not start a second refresh
+    assert _wait_for(lambda: cache.stats()['refreshes'] == 2)
+    assert len(calls) == 2
+    assert cache.get()['data'][0]['id'] == 'model-2'
+
+def test_failed_refresh_keeps_the_old_list():
+    fetch, calls = _fetcher(results=[{'data': ['a']}, None])
+    cache = ModelListCache(fetch, ttl=0.05)
+    assert cache.get() == {'data': ['a']}
+    time.sleep(0.1)
+    assert cache.get() == {'data': ['a']}
+    assert _wait_for(lambda: cache.stats()['refresh_failures'] == 1)
+    assert cache.get() == {'data': ['a']}
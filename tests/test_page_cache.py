@@ -0,0 +1,143 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import time
+from collections import OrderedDict
+
+import pytest
+
+import browser_server
+
+class FakePage:
+    def __init__(self, heap=1000):
+        self.closed = False
+        self.heap = heap
+    def is_closed(self):
+        return self.closed
+    async def close(self):
+        self.closed = True
+    async def evaluate(self, script, args=None):
+        return self.heap
+
+class FakeContext:
+    browser = None
+    def __init__(self):
+        self.cookies = []
+        self.closed = False
+    async def add_cookies(self, cookies):
+        self.cookies.extend(cookies)
+    async def close(self):
+        self.closed = True
+
+@pytest.fixture
+def page_cache(monkeypatch):
+    monkeypatch.setitem(browser_server.worker_state, 'pages', OrderedDict())
+    monkeypatch.setitem(browser_server.worker_state, 'inflight', {})
+    monkeypatch.setitem(browser_server.worker_state, 'page_slots', {})
+    monkeypatch.setitem(browser_server.worker_state, 'page_locks', {})
+    monkeypatch.setitem(browser_server.worker_state, 'pinned', set())
+    monkeypatch.setitem(browser_server.worker_state, 'page_stats', {'created': 0, 'evicted_lru': 0, 'evicted_idle': 0, 'dropped': 0})
+    monkeypatch.setattr(browser_server, 'MAX_PAGES', 3)
+    monkeypatch.setattr(browser_server, 'PAGE_IDLE_TTL', 60)
+
+    async def create_page(key, req_cookies):
+        await browser_server._evict_for_new_page()
+        page = FakePage()
+        browser_server.worker_state['pages'][key] = {'context': FakeContext(), 'page': page, 'cookies': req_cookies, 'last_used': time.monotonic()}
+        return page
+    monkeypatch.setattr(browser_server, '_create_page', create_page)
+    return browser_server.worker_state['pages']
+
+def test_pages_are_keyed_by_token_id():
+    assert browser_server._page_key({'token_id': 7, 'token': 'jwt-a'}) == browser_server._page_key({'token_id': 7, 'token': 'jwt-b'})
+    assert browser_server._page_key({'token': 'jwt-a'}) == 'jwt-a'
+
+def test_least_recently_used_idle_page_is_evicted(page_cache):
+    async def scenario():
+        first = await browser_server._get_or_create_page('id:1', {'token': 'a'})
+        await browser_server._get_or_create_page('id:2', {'token': 'b'})
+        await browser_server._get_or_create_page('id:3', {'token': 'c'})
+        # Touching 1 makes 2 the least recently used, but 2 is busy
+        await browser_server._get_or_create_page('id:1', {'token': 'a'})
+        browser_server.worker_state['inflight']['id:2'] = 1
+        await browser_server._get_or_create_page('id:4', {'token': 'd'})
+        return first
+
+    first = asyncio.run(scenario())
+    assert list(page_cache) == ['id:2', 'id:1', 'id:4']
+    assert not first.closed
+    assert browser_server.worker_state['page_stats']['evicted_lru'] == 1
+
+def test_pages_kept_warm_are_evicted_last(page_cache):
+    async def scenario():
+        await browser_server._get_or_create_page('id:1', {'token': 'a'})
+        await browser_server._get_or_create_page('id:2', {'token': 'b'})
+        await browser_server._get_or_create_page('id:3', {'token': 'c'})
+        browser_server.worker_state['pinned'] = {'id:1', 'id:2'}
+        # Ordinary traffic for an unpinned token pushes out the unpinned page, not the older pinned ones
+        await browser_server._get_or_create_page('id:4', {'token': 'd'})
+        await browser_server._get_or_create_page('id:5', {'token': 'e'})
+
+    asyncio.run(scenario())
+    assert list(page_cache) == ['id:1', 'id:2', 'id:5']
+
+def test_rotated_cookies_reach_the_open_page(page_cache):
+    async def scenario():
+        await browser_server._get_or_create_page('id:1', {'token': 'old'})
+        await browser_server._get_or_create_page('id:1', {'token': 'new'})
+    asyncio.run(scenario())
+    entry = page_cache['id:1']
+    assert entry['cookies'] == {'token': 'new'}
+    assert entry['context'].cookies == [{'name': 'token', 'value': 'new', 'domain': 'zai.is', 'path': '/'}]
+
+def test_idle_pages_are_closed_and_reported(page_cache):
+    async def scenario():
+        stale = await browser_server._get_or_create_page('id:1', {'token': 'a'})
+        await browser_server._get_or_create_page('id:2', {'token': 'b'})
+        page_cache['id:1']['last_used'] -= 120
+        await browser_server._close_idle_pages()
+        return stale, await browser_server._page_metrics()
+
+    stale, metrics = asyncio.run(scenario())
+    assert stale.closed
+    assert list(page_cache) == ['id:2']
+    assert metrics['pages'] == 1 and metrics['evicted_idle'] == 1
+    assert metrics['js_heap_bytes'] == 1000
+
+def test_warmed_pages_are_not_closed_for_being_idle(page_cache):
+    async def scenario():
+        warm = await browser_server._get_or_create_page('id:1', {'token': 'a'})
+        stale = await browser_server._get_or_create_page('id:2', {'token': 'b'})
+        browser_server.worker_state['pinned'] = {'id:1'}
+        page_cache['id:1']['last_used'] -= 120
+        page_cache['id:2']['last_used'] -= 120
+        await browser_server._close_idle_pages()
+        return warm, stale
+
+    warm, stale = asyncio.run(scenario())
+    assert not warm.closed and stale.closed
+    assert list(page_cache) == ['id:1']
+
+def test_failed_fetch_keeps_the_shared_page_but_a_dead_page_is_dropped(page_cache):
+    class FailingPage(FakePage):
+        def __init__(self, error):
+            super().__init__()
+            self.error = error
+        async def evaluate(self, script, args=None):
+            raise Exception(self.error)
+
+    data = {'url': 'https://zai.is/api/v1/models', 'token': 'jwt', 'token_id': 1, 'cookies': {'token': 'a'}}
+    async def scenario(page):
+        await browser_server._get_or_create_page('id:1', {'token': 'a'})
+        page_cache['id:1']['page'] = page
+        return await browser_server._handle_proxy(data)
+
+    # A transient fetch error leaves the page to the other requests on it
+    assert asyncio.run(scenario(FailingPage('TypeError: Failed to fetch'))) == {'error': 'TypeError: Failed to fetch'}
+    assert 'id:1' in page_cache and browser_server.worker_state['page_stats']['dropped'] == 0
+
+    result = asyncio.run(scenario(FailingPage('Target page, context or browser has been closed')))
+    assert 'error' in result and 'id:1' not in page_cache
+    assert browser_server.worker_state['page_stats']['dropped'] == 1
@@ -0,0 +1,129 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import requests
+
+import browser_server
+from core.page_warmer import PageWarmer
+
+class FakeClient:
+    """Stands in for browser_server's /warm, accepting up to max_pages tokens."""
+    def __init__(self, status=200, max_pages=32):
+        self.status = status
+        self.max_pages = max_pages
+        self.batches = []
+        self.open = []
+    def post(self, url, body):
+        self.batches.append(body['tokens'])
+        accepted = [f"id:{item['token_id']}" for item in body['tokens'][:self.max_pages]]
+        return SimpleNamespace(status_code=self.status, json=lambda: {'warming': 0, 'accepted': accepted, 'open': list(self.open)}, close=lambda: None)
+
+def _record(token_id, jwt, active=True, cookies=None):
+    return SimpleNamespace(id=token_id, zai_token=jwt, cookies=cookies or {'token': jwt}, usable=active)
+
+def _warmer(client):
+    return PageWarmer(client, 'http://browser/warm', delay=30, retry_delay=60, interval=120)
+
+def test_every_usable_token_is_sent_and_changes_resend_the_set():
+    client = FakeClient()
+    warmer = _warmer(client)
+    warmer.on_token_change(1, _record(1, 'jwt-a'))
+    warmer.on_token_change(2, _record(2, 'jwt-b'))
+    warmer.on_token_change(3, _record(3, 'jwt-c', active=False))
+    warmer.flush()
+    assert [item['token_id'] for item in client.batches[0]] == [1, 2]
+
+    # An unrelated update (e.g. an error count) keeps the retry; a new JWT or removal sends sooner
+    retry_due = warmer._due
+    warmer.on_token_change(1, _record(1, 'jwt-a'))
+    assert warmer._due == retry_due
+    warmer.on_token_change(2, _record(2, 'jwt-b2'))
+    warmer.on_token_change(1, None)
+    assert warmer._due < retry_due
+    warmer.flush()
+    assert client.batches[1] == [{'token_id': 2, 'token': 'jwt-b2', 'cookies': {'token': 'jwt-b2'}}]
+    warmer._timer.cancel()
+
+def test_token_counts_as_warm_only_once_its_page_is_open():
+    client = FakeClient(status=503)
+    warmer = _warmer(client)
+    warmer.on_token_change(1, _record(1, 'jwt-a'))
+    warmer.on_token_change(2, _record(2, 'jwt-b'))
+    warmer.flush()
+    assert warmer.stats() == {'batches': 0, 'errors': 1, 'tokens': 2, 'accepted': 0, 'open': 0}
+
+    # Accepted, but only one page exists yet: the set is sent again
+    client.status = 200
+    client.open = ['id:1']
+    warmer.flush()
+    assert warmer.stats() == {'batches': 1, 'errors': 1, 'tokens': 2, 'accepted': 2, 'open': 1}
+    assert warmer._due - time.monotonic() <= warmer.retry_delay
+
+    # Once every page is open the set is resent every interval, so a page lost
+    # later (LRU eviction, a browser restart) is reopened
+    client.open = ['id:1', 'id:2']
+    warmer.flush()
+    assert warmer.stats()['open'] == 2
+    assert warmer._due - time.monotonic() > warmer.retry_delay
+    client.open = ['id:2']
+    warmer.flush()
+    assert warmer.stats()['open'] == 1 and warmer._due - time.monotonic() <= warmer.retry_delay
+    warmer._timer.cancel()
+
+def test_tokens_beyond_the_page_limit_are_not_waited_for():
+    client = FakeClient(max_pages=2)
+    warmer = _warmer(client)
+    for token_id in (1, 2, 3): warmer.on_token_change(token_id, _record(token_id, f'jwt-{token_id}'))
+    client.open = ['id:1', 'id:2']
+    warmer.flush()
+    assert warmer.stats() == {'batches': 1, 'errors': 0, 'tokens': 3, 'accepted': 2, 'open': 2}
+    # Token 3 has no page and never will: no quick resend for it
+    assert warmer._due - time.monotonic() > warmer.retry_delay
+    warmer._timer.cancel()
+
+class ReadyPage:
+    def __init__(self, signal, delay=0.0):
+        self.signal = signal
+        self.delay = delay
+    async def evaluate(self, script, timeout_ms):
+        assert script == browser_server.READY_JS
+        await asyncio.sleep(self.delay)
+        return self.signal
+
+def test_page_serves_as_soon_as_it_is_ready():
+    start = time.monotonic()
+    assert asyncio.run(browser_server._wait_until_ready(ReadyPage('darkknight', delay=0.05), 'test')) == 'darkknight'
+    assert time.monotonic() - start < 1
+
+def test_page_without_signal_is_counted(monkeypatch):
+    monkeypatch.setitem(browser_server.worker_state, 'page_stats', dict(browser_server.worker_state['page_stats'], not_ready=0))
+    assert asyncio.run(browser_server._wait_until_ready(ReadyPage(None), 'test')) is None
+    assert browser_server.worker_state['page_stats']['not_ready'] == 1
+
+def test_warm_route_opens_missing_pages_in_the_background(browser_service, monkeypatch):
+    opened = []
+    async def get_page(key, req_cookies):
+        opened.append((key, req_cookies))
+        browser_server.worker_state['pages'][key] = {'page': SimpleNamespace(is_closed=lambda: False), 'cookies': req_cookies, 'last_used': time.monotonic()}
+    monkeypatch.setattr(browser_server, '_get_or_create_page', get_page)
+    monkeypatch.setitem(browser_server.worker_state, 'pages', OrderedDict())
+    monkeypatch.setitem(browser_server.worker_state, 'pinned', set())
+    monkeypatch.setitem(browser_server.worker_state, 'warming', set())
+    tokens = [{'token_id': i, 'token': f'jwt-{i}', 'cookies': {'token': f'c{i}'}} for i in range(3)]
+    warm = lambda: requests.post(f"{browser_service}/warm", json={'tokens': tokens}, proxies={'http': None, 'https': None}).json()
+    assert warm() == {'warming': 3, 'accepted': ['id:0', 'id:1', 'id:2'], 'open': []}
+    deadline = time.time() + 2
+    while len(opened) < 3 and time.time() < deadline: time.sleep(0.01)
+    assert sorted(opened) == [(f'id:{i}', {'token': f'c{i}'}) for i in range(3)]
+    assert browser_server.worker_state['pinned'] == {'id:0', 'id:1', 'id:2'}
+
+    # Pages already open with the same cookies are only reported
+    result = warm()
+    assert result['warming'] == 0 and sorted(result['open']) == ['id:0', 'id:1', 'id:2']
+    assert len(opened) == 3
@@ -0,0 +1,107 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+
+import jwt
+
+from core.refresh_scheduler import ExpiryScheduler
+from core.token_pool import TokenPool
+from tests.test_token_pool import _row
+
+def _scheduler(**kwargs):
+    refreshed = []
+    return ExpiryScheduler(refreshed.extend, **kwargs), refreshed
+
+def test_tokens_are_due_lead_time_before_expiry():
+    scheduler, refreshed = _scheduler(lead_time=600, jitter=0)
+    now = 1_000_000.0
+    scheduler.track(1, now + 3600)
+    scheduler.track(2, now + 900)
+    scheduler.track(3, now + 7200, active=False)
+
+    assert scheduler.run_due(now) == []
+    assert scheduler.run_due(now + 300) == [2]
+    # The refresh moved token 2's expiry forward
+    scheduler.track(2, now + 4500)
+    assert scheduler.run_due(now + 3000) == [1]
+    assert refreshed == [2, 1]
+
+def test_jitter_spreads_tokens_that_expire_together():
+    scheduler, _ = _scheduler(lead_time=600, jitter=300)
+    for token_id in range(50): scheduler.track(token_id, 10_000.0)
+    dues = sorted(due for due, _ in scheduler._entries.values())
+    assert 10_000 - 900 <= dues[0] and dues[-1] <= 10_000 - 600
+    assert dues[-1] - dues[0] > 150
+
+def test_failed_refresh_backs_off_and_success_reschedules():
+    scheduler, refreshed = _scheduler(lead_time=600, jitter=0, retry_delay=60, max_retry_delay=200)
+    scheduler.track(1, 1000.0)
+    assert scheduler.run_due(400) == [1]
+    # The refresh failed: at_expires did not move, so the retry waits
+    scheduler.track(1, 1000.0)
+    assert scheduler.run_due(450) == []
+    assert scheduler.run_due(460) == [1]
+    assert scheduler.run_due(579) == []
+    assert scheduler.run_due(580) == [1]
+
+    scheduler.track(1, 5000.0)
+    assert scheduler.run_due(600) == []
+    assert scheduler.next_due() == (4400.0, 1)
+
+def test_background_thread_refreshes_due_tokens():
+    done = threading.Event()
+    scheduler = ExpiryScheduler(lambda ids: done.set(), lead_time=0, jitter=0)
+    scheduler.start()
+    scheduler.track(1, time.time() + 0.1)
+    assert done.wait(2)
+
+def test_expired_jwt_is_never_a_candidate():
+    pool = TokenPool()
+    expired = jwt.encode({'exp': int(time.time()) - 5}, 'test-signing-key-0123456789abcdef', algorithm='HS256')
+    valid = jwt.encode({'exp': int(time.time()) + 3600}, 'test-signing-key-0123456789abcdef', algorithm='HS256')
+    pool.load([_row(1, zai_token=expired), _row(2, zai_token=valid), _row(3)])
+    assert [r.id for r in pool.candidates(rotate=False)] == [2, 3]
+    assert [r.id for r in pool.expired()] == [1]
+
+def test_request_with_only_expired_tokens_logs_one_in_again(monkeypatch):
+    import app as app_module
+    from core import services
+
+    pool = TokenPool()
+    expired = jwt.encode({'exp': int(time.time()) - 5}, 'test-signing-key-0123456789abcdef', algorithm='HS256')
+    pool.load([_row(1, zai_token=expired), _row(2, zai_token=expired)])
+    relogins = []
+    def relogin(token_id):
+        relogins.append(token_id)
+        if token_id == 1: return False, 'discord.com timed out'
+        pool.update(token_id, jwt_expires=time.time() + 3600)
+        return True, 'ok'
+    monkeypatch.setattr(app_module, 'token_pool', pool)
+    monkeypatch.setattr(services, 'update_token_info', relogin)
+
+    assert [r.id for r in app_module._get_token_candidates()] == [2]
+    assert relogins == [1, 2]
+
+def test_pool_changes_drive_the_schedule():
+    scheduler, _ = _scheduler(lead_time=600, jitter=0)
+    pool = TokenPool()
+    pool.listeners.append(lambda token_id, record: scheduler.track(token_id, record.at_expires, record.is_active) if record else scheduler.untrack(token_id))
+    from datetime import datetime
+    pool.load([_row(1, at_expires=datetime.fromtimestamp(5000)), _row(2, at_expires=datetime.fromtimestamp(9000))])
+    assert scheduler.next_due() == (4400.0, 1)
+    pool.remove(1)
+    assert scheduler.next_due() == (8400.0, 2)
+
+def test_disabled_auto_refresh_leaves_tokens_queued():
+    enabled = [False]
+    scheduler, refreshed = _scheduler(lead_time=600, jitter=0, enabled=lambda: enabled[0])
+    now = 1_000_000.0
+    scheduler.track(1, now + 300)
+    assert scheduler.run_due(now) == []
+    assert scheduler.scheduled(1)[1] == now + 300
+    enabled[0] = True
+    assert scheduler.run_due(now) == [1]
+    assert refreshed == [1]
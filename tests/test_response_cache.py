@@ -0,0 +1,87 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+
+import pytest
+
+import app as app_module
+from app import app
+from conftest import make_token
+from core import services
+from core.extensions import db
+from core.models import SystemConfig
+from core.response_cache import ResponseCache, cache_key, response_cache
+
+BODY = {'choices': [{'message': {'role': 'assistant', 'content': 'hi'}}]}
+
+def test_key_is_canonical():
+    a = {'model': 'm', 'messages': [{'role': 'user', 'content': 'x'}], 'temperature': 0, 'stream': False}
+    b = {'temperature': 0, 'messages': [{'content': 'x', 'role': 'user'}], 'model': 'm', 'stream': True}
+    assert cache_key(a) == cache_key(b)
+    assert cache_key(a) != cache_key(dict(a, temperature=0.5))
+
+def test_lru_eviction_and_ttl():
+    cache = ResponseCache(max_entries=2)
+    cache.put('a', BODY, ttl=60)
+    cache.put('b', BODY, ttl=60)
+    cache.get('a')
+    cache.put('c', BODY, ttl=60)
+    assert cache.get('b') is None
+    assert cache.get('a') == BODY
+    assert cache.stats()['evictions'] == 1
+
+    cache.put('short', BODY, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get('short') is None
+    assert cache.stats()['expired'] == 1
+
+def test_disk_tier_survives_restart(tmp_path):
+    ResponseCache(disk_dir=str(tmp_path)).put('k', BODY, ttl=60)
+    fresh = ResponseCache(disk_dir=str(tmp_path))
+    assert fresh.get('k') == BODY
+    assert fresh.stats()['disk_hits'] == 1
+
+@pytest.fixture
+def cache_enabled(monkeypatch):
+    calls = []
+    def fake_proxy(url, method, payload, token_obj=None, retry_on_auth_fail=True, request_id=None):
+        calls.append(payload)
+        return {'status': 200, 'body': BODY}
+    monkeypatch.setattr(app_module, '_browser_proxy_request', fake_proxy)
+    with app.app_context():
+        config = SystemConfig.query.first()
+        config.cache_enabled = True
+        db.session.commit()
+        services.invalidate_config()
+        make_token('cache-test-st')
+        api_key = config.api_key
+    response_cache.clear()
+    yield calls, {'Authorization': f'Bearer {api_key}'}
+    with app.app_context():
+        SystemConfig.query.first().cache_enabled = False
+        db.session.commit()
+        services.invalidate_config()
+
+def test_deterministic_requests_hit_the_cache(cache_enabled):
+    calls, headers = cache_enabled
+    client = app.test_client()
+    request = {'model': 'gemini-3-flash-preview', 'messages': [{'role': 'user', 'content': 'cache me'}], 'temperature': 0}
+
+    first = client.post('/v1/chat/completions', json=request, headers=headers)
+    second = client.post('/v1/chat/completions', json=request, headers=headers)
+    assert first.headers['X-Response-Cache'] == 'MISS'
+    assert second.headers['X-Response-Cache'] == 'HIT'
+    assert second.get_json() == BODY
+    assert len(calls) == 1
+
+    # Sampled requests are only cached when the client opts in
+    sampled = dict(request, temperature=0.7)
+    client.post('/v1/chat/completions', json=sampled, headers=headers)
+    client.post('/v1/chat/completions', json=sampled, headers=headers)
+    assert len(calls) == 3
+    opted_in = dict(headers, **{'X-Response-Cache': 'on'})
+    client.post('/v1/chat/completions', json=sampled, headers=opted_in)
+    client.post('/v1/chat/completions', json=sampled, headers=opted_in)
+    assert len(calls) == 4
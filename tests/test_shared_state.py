@@ -0,0 +1,108 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import subprocess
+import threading
+import time
+
+import pytest
+
+from core.shared_state import SqliteState
+from core.token_pool import TokenPool
+from tests.test_token_pool import _row
+
+@pytest.fixture
+def pools(tmp_path):
+    """Two pools over one state file, standing in for two gateway processes."""
+    path = str(tmp_path / 'state.db')
+    a, b = TokenPool(state=SqliteState(path)), TokenPool(state=SqliteState(path))
+    rows = [_row(1, image_concurrency=1), _row(2, image_concurrency=1)]
+    a.load(rows)
+    b.load(rows)
+    return a, b
+
+def test_round_robin_is_shared(pools):
+    a, b = pools
+    firsts = [pool.candidates()[0].id for pool in (a, b, a, b)]
+    assert firsts == [1, 2, 1, 2]
+
+def test_concurrency_limits_hold_across_processes(pools):
+    a, b = pools
+    lease = a.acquire(a.get(1), 'image')
+    assert lease is not None
+    assert b.acquire(b.get(1), 'image') is None
+    # The other process now routes image requests away from token 1
+    assert [r.id for r in b.candidates('image')] == [2]
+    lease.release()
+    assert b.acquire(b.get(1), 'image') is not None
+
+def test_scores_are_shared(pools):
+    a, b = pools
+    a.observe(a.get(1), 2.0, ok=True)
+    a.observe(a.get(2), 0.5, ok=False)
+    b.candidates()
+    assert b.get(1).ewma_latency == 2.0
+    assert b.get(2).ewma_error == pytest.approx(0.2)
+    # Already shared scores are not seeded again by a starting process
+    b.seed([('user1@example.com', 9.0, 200)])
+    assert b.get(1).ewma_latency == 2.0
+
+def test_token_changes_mark_other_processes_stale(pools):
+    a, b = pools
+    a.upsert(_row(1, is_active=False))
+    assert not a.stale
+    assert b.stale
+    b.load([_row(1, is_active=False), _row(2)])
+    assert not b.stale
+    assert [r.id for r in b.candidates()] == [2]
+
+def test_counts_of_exited_processes_are_purged(tmp_path):
+    state = SqliteState(str(tmp_path / 'state.db'))
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    state._conn().execute("INSERT INTO inflight (token_id, kind, pid, count) VALUES (1, 'chat', ?, 3)", (child.pid,))
+    assert state.snapshot()[1][0] == {'chat': 3}
+    state.purge_dead()
+    assert 1 not in state.snapshot()
+
+def test_lease_makes_other_processes_wait_for_its_result(tmp_path):
+    path = str(tmp_path / 'state.db')
+    a, b = SqliteState(path), SqliteState(path)
+    since = time.time()
+    assert a.take_lease('reauth:1', ttl=60)
+    assert not b.take_lease('reauth:1', ttl=60)
+    assert b.lease_result('reauth:1', since) is None
+    a.finish_lease('reauth:1', (True, 'Success (backend)'))
+    assert b.lease_result('reauth:1', since) == (True, 'Success (backend)')
+    # A finished lease can be taken again, e.g. for the next refresh
+    assert b.take_lease('reauth:1', ttl=60)
+
+def test_lease_of_an_exited_process_is_taken_over(tmp_path):
+    state = SqliteState(str(tmp_path / 'state.db'))
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    state._conn().execute("INSERT INTO leases (name, pid, expires) VALUES ('reauth:1', ?, ?)", (child.pid, time.time() + 60))
+    assert state.take_lease('reauth:1', ttl=60)
+
+def test_relogin_in_another_process_is_shared(tmp_path, monkeypatch):
+    from app import app
+    from core import services
+
+    state = SqliteState(str(tmp_path / 'state.db'))
+    monkeypatch.setattr(services, 'shared_state', state)
+    logins = []
+    monkeypatch.setattr(services, '_update_token_info', lambda token_id, rate_limited=False: logins.append(token_id) or (True, 'ok'))
+    # Another gateway process (the test runner's parent stands in for it) is logging token 1 in
+    state._conn().execute("INSERT INTO leases (name, pid, expires) VALUES ('reauth:1', ?, ?)", (os.getppid(), time.time() + 60))
+    def finish():
+        time.sleep(0.3)
+        state._conn().execute("UPDATE leases SET finished = ?, ok = 1, message = 'Success (backend)' WHERE name = 'reauth:1'", (time.time(),))
+    threading.Thread(target=finish).start()
+
+    with app.app_context():
+        assert services._relogin_once(1) == (True, 'Success (backend)')
+        assert logins == []
+        # Once the lease is free this process logs in itself
+        assert services._relogin_once(1) == (True, 'ok')
+        assert logins == [1]
@@ -0,0 +1,76 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app
+from core import services
+from core.single_flight import SingleFlight
+
+def _slow(result, calls, delay=0.2):
+    def fn():
+        calls.append(1)
+        time.sleep(delay)
+        return result
+    return fn
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    calls = []
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(lambda _: flight.do(1, _slow((True, 'ok'), calls)), range(10)))
+    assert len(calls) == 1
+    assert results == [(True, 'ok')] * 10
+    assert flight.stats()['runs'] == 1 and flight.stats()['shared'] == 9
+
+def test_keys_do_not_block_each_other():
+    flight = SingleFlight()
+    calls = []
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        list(pool.map(lambda key: flight.do(key, _slow((True, 'ok'), calls)), [1, 2, 3]))
+    assert len(calls) == 3
+    assert time.monotonic() - start < 0.5
+
+def test_failures_are_cached_briefly():
+    flight = SingleFlight(success_ttl=0, failure_ttl=0.2)
+    calls = []
+    assert flight.do(1, _slow((False, 'bad'), calls, delay=0)) == (False, 'bad')
+    assert flight.do(1, _slow((False, 'bad'), calls, delay=0)) == (False, 'bad')
+    assert len(calls) == 1
+    # Explicit retries skip the cache
+    flight.do(1, _slow((False, 'bad'), calls, delay=0), use_cache=False)
+    assert len(calls) == 2
+    time.sleep(0.25)
+    flight.do(1, _slow((True, 'ok'), calls, delay=0))
+    assert len(calls) == 3
+    # Successes are not cached with success_ttl=0
+    flight.do(1, _slow((True, 'ok'), calls, delay=0))
+    assert len(calls) == 4
+
+def test_exceptions_become_failures_for_every_waiter():
+    flight = SingleFlight(failure_ttl=0)
+    started = threading.Event()
+    def boom():
+        started.set()
+        time.sleep(0.1)
+        raise RuntimeError('oauth down')
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, 1, boom)
+        started.wait()
+        waiter = pool.submit(flight.do, 1, boom)
+        assert leader.result() == (False, 'oauth down')
+        assert waiter.result() == (False, 'oauth down')
+
+def test_update_token_info_is_single_flight(monkeypatch):
+    calls = []
+    monkeypatch.setattr(services, '_update_token_info', lambda token_id, use_oauth=False, rate_limited=False: _slow((True, 'Success (backend)'), calls)())
+    monkeypatch.setattr(services, 'reauth_flight', SingleFlight())
+    def reauth(_):
+        with app.app_context(): return services.update_token_info(42)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert set(pool.map(reauth, range(8))) == {(True, 'Success (backend)')}
+    assert len(calls) == 1
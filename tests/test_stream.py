@@ -0,0 +1,121 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import json
+import time
+
+import pytest
+
+import browser_server
+import app as app_module
+from app import app
+from conftest import make_token
+from core.models import SystemConfig
+from core.token_pool import token_pool
+
+CHUNKS = [
+    'data: {"choices": [{"delta": {"content": "Hel"}}]}\n\n',
+    'data: {"choices": [{"delta": {"content": "lo"}}]}\n\n',
+    'data: [DONE]\n\n',
+]
+CHUNK_DELAY = 0.4
+
+class StubPage:
+    """Stands in for a zai.is page: answers the streaming fetch with delayed SSE chunks."""
+    async def evaluate(self, script, args):
+        req_id = args['reqId']
+        browser_server._on_stream_push(req_id, 'status', 200)
+        for chunk in CHUNKS:
+            await asyncio.sleep(CHUNK_DELAY)
+            if not browser_server._on_stream_push(req_id, 'chunk', chunk):
+                break
+        return 200
+
+@pytest.fixture
+def stub_browser_service(browser_service, stub_page, monkeypatch):
+    stub_page(StubPage())
+    monkeypatch.setattr(app_module, 'BROWSER_SERVICE_URL', browser_service)
+
+@pytest.fixture(scope='module')
+def api_key():
+    with app.app_context():
+        make_token('stream-test-st', cookies_json=json.dumps({'token': 'abc'}))
+        return SystemConfig.query.first().api_key
+
+def test_stream_first_byte_before_last(stub_browser_service, api_key):
+    client = app.test_client()
+    start = time.time()
+    resp = client.post('/v1/chat/completions', json={
+        'model': 'gemini-3-flash-preview',
+        'messages': [{'role': 'user', 'content': 'Hello'}],
+        'stream': True
+    }, headers={'Authorization': f'Bearer {api_key}'}, buffered=False)
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/event-stream'
+
+    arrivals = []
+    body = b''
+    for chunk in resp.response:
+        if chunk:
+            arrivals.append(time.time() - start)
+            body += chunk
+            # The token counts as busy for as long as the stream is open
+            assert token_pool.stats()['inflight'] == 1
+    resp.close()
+    assert token_pool.stats()['inflight'] == 0
+
+    assert body.decode() == ''.join(CHUNKS)
+    assert len(arrivals) >= 2
+    # The first delta must reach the client while the upstream is still generating
+    assert arrivals[-1] - arrivals[0] >= CHUNK_DELAY * (len(CHUNKS) - 1) * 0.8
+
+def test_caller_leaving_before_first_byte_frees_its_queue(browser_service, stub_page):
+    import requests
+    pushes = []
+
+    class SilentPage:
+        """Takes a while before the upstream status, then keeps pushing chunks."""
+        async def evaluate(self, script, args):
+            await asyncio.sleep(0.5)
+            for _ in range(5):
+                pushes.append(browser_server._on_stream_push(args['reqId'], 'chunk', 'data: x\n\n'))
+                await asyncio.sleep(0.05)
+            return 200
+
+    stub_page(SilentPage())
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        requests.post(f"{browser_service}/proxy/stream", json={'url': 'https://zai.is/api/v1/chat/completions', 'token': 'jwt', 'cookies': {'token': 'x'}}, timeout=0.2, proxies={'http': None, 'https': None})
+    deadline = time.time() + 2
+    while browser_server.stream_queues and time.time() < deadline: time.sleep(0.02)
+    assert browser_server.stream_queues == {}
+    time.sleep(0.6)
+    # The page was told the caller is gone instead of filling an orphaned queue
+    assert True not in pushes
+
+def test_stalled_upstream_is_aborted_and_frees_its_slots(browser_service, stub_page, monkeypatch):
+    import requests
+    aborted = []
+
+    class StalledPage:
+        """Sends the status and one chunk, then zai.is goes quiet with the connection open."""
+        async def evaluate(self, script, args):
+            if script == browser_server.CANCEL_JS:
+                aborted.append(args)
+                return True
+            browser_server._on_stream_push(args['reqId'], 'status', 200)
+            browser_server._on_stream_push(args['reqId'], 'chunk', CHUNKS[0])
+            await asyncio.Event().wait()
+
+    stub_page(StalledPage())
+    monkeypatch.setattr(browser_server, 'REQUEST_TIMEOUT', 0.5)
+    active = browser_server.admission.active
+    resp = requests.post(f"{browser_service}/proxy/stream", json={'url': 'https://zai.is/api/v1/chat/completions', 'token': 'jwt', 'token_id': 'stall', 'cookies': {'token': 'x'}}, stream=True, timeout=5, proxies={'http': None, 'https': None})
+    assert resp.content.decode() == CHUNKS[0]
+
+    deadline = time.time() + 2
+    while browser_server.admission.active > active and time.time() < deadline: time.sleep(0.02)
+    assert browser_server.admission.active == active
+    assert len(aborted) == 1
+    assert not browser_server.worker_state['inflight'].get('id:stall')
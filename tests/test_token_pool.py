@@ -0,0 +1,101 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+from types import SimpleNamespace
+
+from core.token_pool import TokenPool, request_kind
+
+def _row(id, zai_token='jwt', is_active=True, error_count=0, cookies=None, image_enabled=True, image_concurrency=-1, at_expires=None):
+    return SimpleNamespace(id=id, email=f'user{id}@example.com', discord_token=f'st-{id}', zai_token=zai_token, at_expires=at_expires,
+                           cookies_json=json.dumps(cookies) if cookies else None, is_active=is_active, error_count=error_count,
+                           image_enabled=image_enabled, video_enabled=True, image_concurrency=image_concurrency, video_concurrency=-1)
+
+def test_candidates_round_robin_over_usable_tokens():
+    pool = TokenPool()
+    pool.load([_row(3), _row(1), _row(2, is_active=False), _row(4, zai_token='SESSION_AUTH_COOKIE'), _row(5, zai_token=None)])
+
+    assert [r.id for r in pool.candidates()] == [1, 3]
+    assert [r.id for r in pool.candidates()] == [3, 1]
+    assert [r.id for r in pool.candidates(rotate=False)] == [1, 3]
+    assert pool.stats() == {'tokens': 5, 'usable': 2, 'inflight': 0, 'open_circuits': 0}
+
+def test_upsert_updates_records_in_place():
+    pool = TokenPool()
+    pool.load([_row(1, cookies={'token': 'old'})])
+    record = pool.candidates()[0]
+
+    pool.upsert(_row(1, zai_token='jwt-new', cookies={'token': 'new'}))
+    assert record.zai_token == 'jwt-new'
+    assert record.cookies == {'token': 'new'}
+
+    pool.upsert(_row(1, is_active=False))
+    assert pool.candidates() == []
+
+def test_remove_and_update():
+    pool = TokenPool()
+    pool.load([_row(1), _row(2)])
+    pool.update(1, error_count=2)
+    assert pool.get(1).error_count == 2
+    pool.remove(2)
+    assert [r.id for r in pool.candidates()] == [1]
+
+def test_least_outstanding_first():
+    pool = TokenPool()
+    pool.load([_row(1), _row(2), _row(3)])
+    leases = [pool.acquire(pool.get(1), 'chat'), pool.acquire(pool.get(1), 'chat'), pool.acquire(pool.get(2), 'chat')]
+
+    assert [r.id for r in pool.candidates('chat')][0] == 3
+    for lease in leases: lease.release()
+    leases[0].release()
+    assert pool.get(1).inflight == 0
+    assert pool.stats()['inflight'] == 0
+
+def test_burst_spreads_evenly():
+    pool = TokenPool()
+    pool.load([_row(i) for i in range(1, 5)])
+    for _ in range(12):
+        pool.acquire(pool.candidates('chat')[0], 'chat')
+    assert [pool.get(i).inflight for i in range(1, 5)] == [3, 3, 3, 3]
+
+def test_image_limits_are_enforced():
+    pool = TokenPool()
+    pool.load([_row(1, image_concurrency=1), _row(2, image_enabled=False)])
+    assert request_kind('imagen-4') == 'image'
+    assert request_kind('gemini-3-flash-preview') == 'chat'
+
+    assert [r.id for r in pool.candidates('image')] == [1]
+    lease = pool.acquire(pool.get(1), 'image')
+    assert pool.acquire(pool.get(1), 'image') is None
+    assert pool.candidates('image') == []
+    # Chat traffic is not limited by the image slots
+    assert pool.acquire(pool.get(1), 'chat') is not None
+    lease.release()
+    assert [r.id for r in pool.candidates('image')] == [1]
+
+def test_latency_mode_prefers_fast_healthy_tokens():
+    pool = TokenPool(mode='latency')
+    pool.load([_row(1), _row(2), _row(3)])
+    for _ in range(10):
+        pool.observe(pool.get(1), 0.5, ok=True)
+        pool.observe(pool.get(2), 8.0, ok=True)
+        pool.observe(pool.get(3), 0.5, ok=False)
+
+    firsts = [pool.candidates('chat')[0].id for _ in range(300)]
+    # Power of two choices: the fast healthy token wins every pair it is drawn
+    # in but does not take all the traffic; the failing token never goes first.
+    assert 150 <= firsts.count(1) < 300
+    assert firsts.count(2) > 0
+    assert firsts.count(3) == 0
+    assert [r.id for r in pool.candidates('chat')][-1] == 3
+
+def test_seed_from_request_log_history():
+    pool = TokenPool(mode='latency', ewma_alpha=0.5)
+    pool.load([_row(1), _row(2)])
+    pool.seed([('user1@example.com', 2.0, 200), ('user1@example.com', 4.0, 200), ('user2@example.com', 1.0, 502), ('nobody@example.com', 1.0, 200)])
+
+    assert pool.get(1).ewma_latency == 3.0
+    assert pool.get(1).ewma_error == 0.0
+    assert pool.get(2).ewma_latency is None
+    assert pool.get(2).ewma_error == 0.5
@@ -0,0 +1,86 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+
+import pytest
+
+from app import app
+from core import services
+from core.token_refresher import HostRateLimiter, TokenRefresher
+
+def test_rate_limiter_spaces_requests_per_host():
+    limiter = HostRateLimiter(rate=20, burst=1, jitter=0)
+    start = time.monotonic()
+    for _ in range(5): limiter.wait('discord.com')
+    assert time.monotonic() - start >= 0.19
+
+    # Another host has its own budget
+    start = time.monotonic()
+    limiter.wait('zai.is')
+    assert time.monotonic() - start < 0.05
+
+def test_rate_limiter_pause_blocks_host():
+    limiter = HostRateLimiter(rate=100, burst=5, jitter=0)
+    limiter.pause('discord.com', 0.2)
+    start = time.monotonic()
+    limiter.wait('discord.com')
+    assert time.monotonic() - start >= 0.19
+
+@pytest.fixture
+def fake_refresh(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+    active = {'now': 0, 'peak': 0}
+    def update_token_info(token_id, use_oauth=False, rate_limited=False):
+        assert rate_limited
+        with lock:
+            calls.append(token_id)
+            active['now'] += 1
+            active['peak'] = max(active['peak'], active['now'])
+        time.sleep(0.1)
+        with lock: active['now'] -= 1
+        if token_id % 4 == 0: return False, 'bad token'
+        return True, 'Success (backend)'
+    monkeypatch.setattr(services, 'update_token_info', update_token_info)
+    return calls, active
+
+def test_run_refreshes_in_parallel_with_summary(fake_refresh):
+    calls, active = fake_refresh
+    refresher = TokenRefresher(max_workers=4, jitter=0)
+    start = time.monotonic()
+    summary = refresher.run(app, list(range(1, 13)))
+    elapsed = time.monotonic() - start
+
+    assert sorted(calls) == list(range(1, 13))
+    assert active['peak'] == 4
+    assert elapsed < 0.6
+    assert summary['running'] is False
+    assert (summary['done'], summary['succeeded'], summary['failed']) == (12, 9, 3)
+    assert {e['token_id'] for e in summary['errors']} == {4, 8, 12}
+
+def test_start_returns_immediately_and_reports_progress(fake_refresh):
+    refresher = TokenRefresher(max_workers=2, jitter=0)
+    start = time.monotonic()
+    job = refresher.start(app, [1, 2, 3, 4])
+    assert time.monotonic() - start < 0.05
+    assert job['running'] and job['total'] == 4
+    # A second request while running joins the current run
+    assert refresher.start(app, [5])['total'] == 4
+
+    deadline = time.monotonic() + 2
+    while refresher.status()['running'] and time.monotonic() < deadline: time.sleep(0.02)
+    assert refresher.status()['done'] == 4
+
+def test_refresh_all_endpoint_does_not_block(fake_refresh):
+    client = app.test_client()
+    token = client.post('/api/login', json={'username': 'admin', 'password': 'admin'}).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+    res = client.post('/api/tokens/refresh-all', json={}, headers=headers).get_json()
+    assert res['success'] and 'job' in res
+    deadline = time.monotonic() + 5
+    while client.get('/api/tokens/refresh-all', headers=headers).get_json()['job']['running'] and time.monotonic() < deadline: time.sleep(0.02)
+    job = client.get('/api/tokens/refresh-all', headers=headers).get_json()['job']
+    assert job['done'] == job['total']